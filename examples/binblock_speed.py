@@ -0,0 +1,28 @@
+# Script to compare encoding and decoding an AWG waveform sample by sample
+# with struct against the numpy based functions in lib/binblock.py.
+
+import struct
+import time
+import numpy
+from lib import binblock
+
+N = 1000000
+w = numpy.sin(numpy.arange(N) / 100.0)
+m1 = numpy.arange(N) % 2
+m2 = (numpy.arange(N) / 2) % 2
+
+start = time.time()
+m = m1 + 2 * m2
+parts = [struct.pack('<fB', w[i], int(m[i])) for i in range(N)]
+data = binblock.encode_block(''.join(parts))
+print 'struct encode: %.03f sec' % (time.time() - start)
+
+start = time.time()
+data = binblock.encode_tek_wfm(w, m1, m2, 1e9)
+print 'binblock encode: %.03f sec' % (time.time() - start)
+
+start = time.time()
+w2, m12, m22, clock = binblock.decode_tek_wfm(data)
+print 'binblock decode: %.03f sec' % (time.time() - start)
+print 'Equal:', numpy.allclose(w, w2) and (m1 == m12).all() and \
+        (m2 == m22).all()
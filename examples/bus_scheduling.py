@@ -0,0 +1,47 @@
+# Script to show the priority of the measurement thread on a shared bus.
+# Two 'probe' threads keep a simulated GPIB bus busy while the measurement
+# thread reads an instrument on the same bus. Every transaction takes 10 ms;
+# the measurement only waits for the transaction that is running, not for
+# all the queued probe traffic.
+
+import qt
+import time
+import threading
+import visa
+from lib import bus
+
+class SlowInstrument:
+    def ask(self, cmd):
+        time.sleep(0.01)
+        return '1.0'
+
+dmm = visa.BusInstrument(SlowInstrument(), bus.get_bus('GPIB_example'))
+N = 50
+running = True
+
+def probe():
+    bus.set_priority(bus.PRIORITY_BACKGROUND)
+    while running:
+        dmm.ask('READ?')
+
+threads = [threading.Thread(target=probe) for i in range(2)]
+for t in threads:
+    t.start()
+
+qt.mstart()
+start = time.time()
+for i in range(N):
+    dmm.ask('READ?')
+print '%d measurement reads: %.03f sec' % (N, time.time() - start)
+qt.mend()
+
+running = False
+for t in threads:
+    t.join()
+
+stats = qt.get_bus_stats('GPIB_example')
+print 'Utilization: %.02f' % stats['utilization']
+for name, pstats in stats['priorities'].iteritems():
+    print '%s: %d transactions, mean wait %.01f ms, max wait %.01f ms' % \
+        (name, pstats['transactions'], pstats['wait_mean'] * 1000,
+            pstats['wait_max'] * 1000)
@@ -0,0 +1,28 @@
+# Script to compare a measurement that sets and reads every point with one
+# where the instrument performs the sweep itself (see Instrument.add_sweep).
+# The dummy signal generator implements a sweep that steps the amplitude
+# and reads the wave.
+
+import qt
+import time
+from lib.measurement import Measurement
+
+if 'dsgen' not in qt.instruments.get_instrument_names():
+    qt.instruments.create('dsgen', 'dummy_signal_generator')
+ins = qt.instruments.get('dsgen')
+N = 1000
+
+for hw in (False, True):
+    m = Measurement('sweep', hardware_sweep=hw, delay=0)
+    m.add_coordinate(ins, 'amplitude', 0, 1, steps=N)
+    m.add_measurement(ins, 'wave')
+    start = time.time()
+    m.start()
+    stop = time.time()
+    print 'hardware_sweep=%s: %.03f sec for %d points' % (hw, stop - start, N)
+
+# A sweep can also be used directly, e.g. to take 1000 readings at 10 ms
+# intervals with a Keithley 2700:
+#   dmm.run_sweep('buffer', 1000, interval=0.01)
+data = ins.run_sweep('amplitude', N, values=[i / float(N) for i in range(N)])
+print 'run_sweep returned %d points' % len(data)
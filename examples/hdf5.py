@@ -81,3 +81,31 @@ print dat['/my_data/lab air pressure']
 print dat['/my_data/overnight lab volume increase']
 
 dat.close()
+
+
+### Streaming data: dimensions created without data can grow, and are filled
+### row by row like a qtlab Data object. Rows are buffered and written in
+### chunks, so this is cheap also for open-ended sweeps.
+dat = h5.HDF5Data(name='data_number_three', chunk_rows=1024,
+        compression='gzip')
+grp = dat.create_data_group('sweep')
+grp.add_coordinate('x', unit='V')
+grp.add_coordinate('y', unit='V')
+grp.add_value('current', unit='A')
+
+for y in np.arange(10):
+    for x in np.arange(100):
+        grp.add_data_point(x, y, np.random.rand())
+    grp.new_block()
+
+# Complete rows or slices can also be written directly
+grp.add_stream_dimension('traces', 'value', shape=(1000,))
+for i in range(10):
+    grp.append_rows('traces', np.random.rand(1000))
+grp.write_slice('traces', 0, np.zeros(1000))
+
+print dat['/sweep/current']
+print dat['/sweep/traces']
+print dat['/sweep'].attrs['block_sizes']
+
+dat.close()
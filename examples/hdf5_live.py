@@ -0,0 +1,39 @@
+"""
+Example of writing a HDF5 file that can be read while the measurement is
+running (single-writer / multiple-reader mode).
+
+The measurement below streams data to the file. In another process, e.g.
+an analysis notebook, the data can be followed with:
+
+    import hdf5_data as h5
+    r = h5.StreamReader(filepath, '/sweep')
+    rows = r.read()     # only returns rows added since the previous call
+"""
+
+import time
+import numpy as np
+import hdf5_data as h5
+
+dat = h5.HDF5Data(name='live', swmr=True)
+grp = dat.create_data_group('sweep')
+grp.add_coordinate('x', unit='V')
+grp.add_coordinate('y', unit='V')
+grp.add_value('z', unit='A')
+
+# All data sets have to exist before switching to SWMR mode
+dat.start_swmr()
+print 'Writing to %s' % dat.get_filepath()
+
+reader = h5.StreamReader(dat.get_filepath(), '/sweep')
+for y in np.arange(20):
+    for x in np.arange(100):
+        grp.add_data_point(x, y, np.random.rand())
+    grp.new_block()
+
+    rows = reader.read()
+    print 'block %d: read %d new rows, %d blocks complete' % \
+            (y, len(rows['z']), len(reader.get_block_sizes()))
+    time.sleep(0.1)
+
+reader.close()
+dat.close()
@@ -0,0 +1,59 @@
+# Script to measure the transfer of numpy arrays between two processes with
+# the object sharer. Large arrays are sent as raw data after the pickled
+# packet; for comparison they can also be pickled.
+#
+# Run from the examples directory: python object_sharer_arrays.py
+
+import os
+import sys
+import socket
+import subprocess
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'source'))
+from lib.network import object_sharer as objsh
+
+class ArrayServer(objsh.SharedObject):
+
+    def get_array(self, nbytes, raw=True):
+        if raw:
+            objsh.helper.ARRAY_MIN_SIZE = objsh.ObjectSharer.ARRAY_MIN_SIZE
+        else:
+            objsh.helper.ARRAY_MIN_SIZE = 2**62
+        return np.ones(nbytes / 8)
+
+def run_server():
+    ArrayServer('arrays')
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+    print srv.getsockname()[1]
+    sys.stdout.flush()
+
+    conn, addr = srv.accept()
+    while objsh.helper.receive(conn) != 0:
+        pass
+
+if len(sys.argv) > 1 and sys.argv[1] == 'server':
+    run_server()
+    sys.exit(0)
+
+proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'server'],
+        stdout=subprocess.PIPE)
+port = int(proc.stdout.readline())
+sock = socket.create_connection(('127.0.0.1', port))
+
+for nbytes, raw in ((100e6, True), (1e6, True), (1e6, False), (10e6, False)):
+    start = time.time()
+    arr = objsh.helper.call(sock, 'arrays', 'get_array', int(nbytes), raw,
+            timeout=300)
+    t = time.time() - start
+    assert arr.nbytes == nbytes and arr[-1] == 1
+    print '%d MB, %s: %.03f sec, %.01f MB/s' % (nbytes / 1e6,
+        raw and 'raw' or 'pickled', t, nbytes / 1e6 / t)
+
+print objsh.helper.get_connection_stats()
+sock.close()
+proc.wait()
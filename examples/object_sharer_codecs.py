@@ -0,0 +1,45 @@
+# Script to compare the codecs of the object sharer on typical packets:
+# the pickle protocol 0 that was used before, pickle with the highest
+# protocol and the compact codec. Shows the encoded size and the time to
+# encode and decode each packet.
+#
+# Run from the examples directory: python object_sharer_codecs.py
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'source'))
+from lib.network import codec
+
+codecs = (
+    ('pickle 0', codec.PickleCodec(0)),
+    ('pickle', codec.get_codec('pickle')),
+    ('compact', codec.get_codec('compact')),
+)
+
+packets = (
+    ('call', (('call', 1234), ('dsgen', 'get', ('amplitude',), {}))),
+    ('return float', (('return', 1234), 0.123456789)),
+    ('signal', (('signal', ), ('root', 'receive_signal',
+        ('dsgen', 'changed', None, {'amplitude': 0.5}), {}))),
+    ('return list', (('return', 1234), ['dsgen%d' % i for i in range(20)])),
+    ('return array', (('return', 1234), np.arange(500.))),
+)
+
+N = 10000
+for name, packet in packets:
+    for cname, c in codecs:
+        data = c.encode(packet)
+        start = time.time()
+        for i in xrange(N):
+            c.encode(packet)
+        t_enc = (time.time() - start) / N
+        start = time.time()
+        for i in xrange(N):
+            c.decode(data)
+        t_dec = (time.time() - start) / N
+        print '%-13s %-8s %5d bytes, encode %6.1f us, decode %6.1f us' % \
+                (name, cname, len(data), t_enc * 1e6, t_dec * 1e6)
@@ -0,0 +1,62 @@
+# Script to measure the round trip time of object sharer calls over
+# localhost. A blocking call waits for the socket to become readable, and
+# with call_async() many calls can be in progress at the same time.
+#
+# Run from the examples directory: python object_sharer_latency.py
+
+import os
+import sys
+import socket
+import subprocess
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'source'))
+from lib.network import object_sharer as objsh
+from lib.executor import gather
+
+class NullServer(objsh.SharedObject):
+
+    def null(self):
+        return None
+
+def run_server():
+    NullServer('null')
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+    print srv.getsockname()[1]
+    sys.stdout.flush()
+
+    conn, addr = srv.accept()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    while objsh.helper.receive(conn) != 0:
+        pass
+
+if len(sys.argv) > 1 and sys.argv[1] == 'server':
+    run_server()
+    sys.exit(0)
+
+proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'server'],
+        stdout=subprocess.PIPE)
+port = int(proc.stdout.readline())
+sock = socket.create_connection(('127.0.0.1', port))
+sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+N = 2000
+
+start = time.time()
+for i in range(N):
+    objsh.helper.call(sock, 'null', 'null')
+t = time.time() - start
+print 'Sequential: %d calls in %.03f sec, %.01f us per call' % \
+        (N, t, t / N * 1e6)
+
+start = time.time()
+futures = [objsh.helper.call_async(sock, 'null', 'null') for i in range(N)]
+gather(futures, mainloop=False)
+t = time.time() - start
+print 'Pipelined: %d calls in %.03f sec, %.01f us per call' % \
+        (N, t, t / N * 1e6)
+
+sock.close()
+proc.wait()
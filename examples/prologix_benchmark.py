@@ -0,0 +1,95 @@
+# Script to count the packets sent to a prologix controller per ask. A fake
+# controller is started on localhost; it answers every '++read' with the
+# address and the last command of the addressed instrument. Two instruments
+# share one connection; the '++addr' and other settings are only sent when
+# they change, and the read command goes in the same packet as the query.
+
+import socket
+import threading
+import time
+import prologix_ethernet
+
+class FakePrologix(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self.packets = 0
+        self.commands = 0
+        self.conn = None
+
+    def run(self):
+        while True:
+            self.conn, addr = self._server.accept()
+            self._serve(self.conn)
+
+    def _serve(self, conn):
+        addr = None
+        last = {}
+        buf = ''
+        while True:
+            try:
+                data = conn.recv(8192)
+            except socket.error:
+                return
+            if len(data) == 0:
+                return
+            self.packets += 1
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                line = line.strip()
+                cmd = line.split(' ')[0]
+                if cmd.startswith('++'):
+                    self.commands += 1
+                if cmd == '++addr':
+                    addr = int(line.split()[1])
+                elif cmd == '++read':
+                    conn.sendall('%s:%s\n' % (addr, last.get(addr, '')))
+                elif not cmd.startswith('++'):
+                    last[addr] = line
+
+    def drop(self):
+        self.conn.shutdown(socket.SHUT_RDWR)
+        self.conn.close()
+
+server = FakePrologix()
+server.start()
+prologix_ethernet.set_controller_address('127.0.0.1', server.port)
+
+ins1 = prologix_ethernet.instrument('GPIB::1')
+ins2 = prologix_ethernet.instrument('GPIB::2')
+conn = prologix_ethernet.get_connection('127.0.0.1', server.port)
+N = 1000
+
+def bench(name, inslist, reset_state=False):
+    stats = conn.get_stats()
+    packets = server.packets
+    commands = server.commands
+    start = time.time()
+    for i in range(N):
+        if reset_state:
+            # Resend address and settings, as without connection state
+            conn.gpib_address = None
+            conn._settings = {}
+        ins = inslist[i % len(inslist)]
+        assert ins.ask('V%d?' % i) == '%d:V%d?\n' % (ins.gpib_addr, i)
+    t = time.time() - start
+    sends = conn.get_stats()['sends'] - stats['sends']
+    print '%s: %.03f ms per ask, %.02f sends and %.02f ++ commands per ask' % \
+        (name, t / N * 1000, float(sends) / N,
+            float(server.commands - commands) / N)
+
+bench('One instrument', [ins1])
+bench('Two instruments', [ins1, ins2])
+bench('Two instruments, no state', [ins1, ins2], reset_state=True)
+
+# The connection is restored automatically if it is lost
+server.drop()
+time.sleep(0.1)
+print ins1.ask('*IDN?'), conn.get_stats()
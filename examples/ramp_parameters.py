@@ -0,0 +1,40 @@
+# Script to compare ramping parameters one by one with ramping them at the
+# same time. Parameters with a maxstep option are changed in steps of at
+# most maxstep, with at least stepdelay ms between the steps.
+
+import qt
+import time
+import logging
+
+if 'dsgen' not in qt.instruments.get_instrument_names():
+    qt.instruments.create('dsgen', 'dummy_signal_generator')
+ins = qt.instruments.get('dsgen', proxy=False)
+ins.set_parameter_options('amplitude', maxstep=0.1, stepdelay=20)
+ins.set_parameter_options('frequency', maxstep=0.5, stepdelay=20)
+
+def reset():
+    ins.set_parameter_options('amplitude', maxstep=None)
+    ins.set_parameter_options('frequency', maxstep=None)
+    ins.set_amplitude(0)
+    ins.set_frequency(0)
+    ins.set_parameter_options('amplitude', maxstep=0.1)
+    ins.set_parameter_options('frequency', maxstep=0.5)
+
+reset()
+start = time.time()
+ins.set_amplitude(2)
+ins.set_frequency(10)
+print 'One by one: %.03f sec' % (time.time() - start)
+
+reset()
+start = time.time()
+ins.set({'amplitude': 2, 'frequency': 10})
+print 'Together: %.03f sec' % (time.time() - start)
+
+# Ramp in the background, the main loop keeps running
+reset()
+start = time.time()
+r = ins.ramp_parameters({'amplitude': 2, 'frequency': 10}, wait=False)
+r.add_done_callback(lambda r: logging.info('Ramp finished'))
+r.wait()
+print 'Background: %.03f sec, result %s' % (time.time() - start, r.result())
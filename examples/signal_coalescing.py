@@ -0,0 +1,36 @@
+# Script to show how signals to remote clients (e.g. the GUI) are coalesced
+# during a fast sweep. The 'changed' signal of an instrument and the
+# 'new-data-point' signal of a data object are sent to each client at most
+# 10 times per second, so a slow client does not delay the measurement.
+# Run this with the GUI connected.
+
+import qt
+import time
+from lib.network import object_sharer as objsh
+
+if 'dsgen' not in qt.instruments.get_instrument_names():
+    qt.instruments.create('dsgen', 'dummy_signal_generator')
+ins = qt.instruments.get('dsgen')
+N = 2000
+
+# Send at most 5 'changed' signals per second, with the changed parameters
+# of the emissions in between merged.
+objsh.helper.set_signal_coalescing('changed', 5, merge=True)
+objsh.helper.reset_signal_stats()
+
+d = qt.Data(name='coalesce')
+d.add_coordinate('amplitude')
+d.add_value('wave')
+d.create_file()
+
+start = time.time()
+for i in range(N):
+    ins.set_amplitude(i / float(N))
+    d.add_data_point(i / float(N), ins.get_wave())
+    qt.msleep(0)
+print '%d points in %.03f sec' % (N, time.time() - start)
+d.close_file()
+
+for name, stats in objsh.helper.get_signal_stats().iteritems():
+    print '%s: emitted %d, sent %d, merged %d, dropped %d' % (name,
+            stats['emitted'], stats['sent'], stats['merged'], stats['dropped'])
@@ -0,0 +1,60 @@
+# Script to measure the speed of reading binary blocks with TcpIpInstrument.
+# A server on localhost echoes every line, and answers 'BLOCK? <n>' with an
+# IEEE 488.2 block of n bytes (like a scope returning a waveform).
+
+import socket
+import threading
+import time
+import numpy as np
+import visa
+
+class BlockServer(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+
+    def run(self):
+        conn, addr = self._server.accept()
+        buf = ''
+        while True:
+            data = conn.recv(8192)
+            if len(data) == 0:
+                return
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                if line.startswith('BLOCK?'):
+                    n = int(line.split()[1])
+                    data = np.arange(n, dtype=np.uint8).tostring()
+                    length = str(n)
+                    conn.sendall('#%d%s%s\n' % (len(length), length, data))
+                else:
+                    conn.sendall(line + '\n')
+
+server = BlockServer()
+server.start()
+ins = visa.TcpIpInstrument('127.0.0.1', server.port, timeout=5)
+
+N = 1000
+start = time.time()
+for i in range(N):
+    assert ins.ask('LINE %d' % i) == 'LINE %d' % i
+print 'ask: %.03f ms per query' % ((time.time() - start) / N * 1000)
+
+for n in (1000, 100000, 10000000):
+    start = time.time()
+    data = ins.ask_block('BLOCK? %d' % n)
+    t = time.time() - start
+    wave = np.frombuffer(data, dtype=np.uint8)
+    assert len(wave) == n and wave[-1] == (n - 1) % 256
+    print 'block of %d bytes: %.03f sec, %.01f MB/s' % (n, t, n / t / 1e6)
+
+# Replies are still split correctly after a block
+print ins.ask('*IDN?')
+ins.close()
@@ -0,0 +1,22 @@
+# Script to compare reading several instruments one after the other with
+# reading them at the same time using get_async() and gather(). Every
+# instrument (or 'lockclass') has its own I/O thread, so the second method
+# takes about as long as the slowest instrument.
+
+import qt
+import time
+
+names = ['dsgen%d' % i for i in range(3)]
+for name in names:
+    if name not in qt.instruments.get_instrument_names():
+        qt.instruments.create(name, 'dummy_signal_generator')
+inslist = [qt.instruments.get(name) for name in names]
+
+# get_slow_wave takes one second
+start = time.time()
+vals = [ins.get_slow_wave() for ins in inslist]
+print 'Sequential: %.03f sec' % (time.time() - start)
+
+start = time.time()
+vals = qt.gather([ins.get_async('slow_wave') for ins in inslist])
+print 'get_async + gather: %.03f sec' % (time.time() - start)
@@ -0,0 +1,71 @@
+# Script to compare the number of bus transactions and the time needed to
+# read or write several parameters one by one and in a single batch using
+# get([...]) / set({...}), for a driver with do_get_many / do_set_many
+# hooks. The visa instrument of the driver is wrapped to count calls.
+#
+# Set the name and address of a Keithley 2700 below.
+
+import qt
+import time
+
+NAME = 'dmm'
+ADDRESS = 'GPIB::16'
+N = 20
+
+class CountingInstrument(object):
+    '''Wrapper around a visa instrument that counts ask / write calls.'''
+
+    def __init__(self, ins):
+        self._ins = ins
+        self.nask = 0
+        self.nwrite = 0
+
+    def ask(self, *args, **kwargs):
+        self.nask += 1
+        return self._ins.ask(*args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        self.nwrite += 1
+        return self._ins.write(*args, **kwargs)
+
+    def reset(self):
+        self.nask = 0
+        self.nwrite = 0
+
+    def __getattr__(self, name):
+        return getattr(self._ins, name)
+
+if NAME not in qt.instruments.get_instrument_names():
+    qt.instruments.create(NAME, 'Keithley_2700', address=ADDRESS)
+ins = qt.instruments.get(NAME, proxy=False)
+if not isinstance(ins._visainstrument, CountingInstrument):
+    ins._visainstrument = CountingInstrument(ins._visainstrument)
+bus = ins._visainstrument
+
+getnames = ['range', 'digits', 'nplc', 'trigger_count', 'trigger_delay',
+    'trigger_source', 'display', 'autozero', 'averaging', 'autorange']
+setvals = {'digits': 6, 'trigger_count': 1, 'trigger_delay': 0.0,
+    'display': True, 'averaging': False}
+
+def run(label, func):
+    bus.reset()
+    start = time.time()
+    for i in range(N):
+        func()
+    stop = time.time()
+    print '%-20s %6.1f ms/iter, %5.1f asks/iter, %5.1f writes/iter' % \
+        (label, (stop - start) / N * 1e3, float(bus.nask) / N,
+        float(bus.nwrite) / N)
+
+def get_single():
+    for name in getnames:
+        ins.get(name)
+
+def set_single():
+    for name, val in setvals.iteritems():
+        ins.set(name, val)
+
+run('get one by one', get_single)
+run('get([...])', lambda: ins.get(getnames))
+run('set one by one', set_single)
+run('set({...})', lambda: ins.set(setvals))
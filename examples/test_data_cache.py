@@ -0,0 +1,26 @@
+# Script to compare loading a data file with and without the data cache.
+# The first load with a cache parses the file and writes the cache, the
+# following loads use the memory-mapped cache.
+
+import qt
+import time
+import numpy as np
+
+d = qt.Data(name='cachetest')
+d.add_coordinate('X')
+d.add_coordinate('Y')
+d.add_value('Z')
+d.create_file()
+for y in np.arange(500):
+    x = np.arange(1000)
+    d.add_data_point(x, np.ones_like(x) * y, np.random.rand(len(x)))
+    d.new_block()
+d.close_file()
+fn = d.get_filepath()
+
+for mode in (False, 'sidecar', 'temp'):
+    for i in range(3):
+        start = time.time()
+        d2 = qt.Data(fn, cache=mode)
+        stop = time.time()
+        print 'cache=%s, load %d: %.03f sec' % (mode, i + 1, stop - start)
@@ -0,0 +1,28 @@
+# Script to test memory-mapped Data storage. The peak memory use (unix
+# only) should not depend on the number of points.
+
+import qt
+import time
+import resource
+import numpy as np
+
+N = 1e7
+CHUNK = 1e5
+
+d = qt.Data(name='mmaptest', mmap=True)
+d.add_coordinate('time')
+d.add_value('counts')
+d.create_file()
+
+start = time.time()
+for i in np.arange(0, N, CHUNK):
+    t = np.arange(i, i + CHUNK)
+    d.add_data_point(t, np.random.poisson(10, len(t)))
+d.close_file()
+print 'Wrote %d points in %.03f sec' % (N, time.time() - start)
+
+d2 = qt.Data(d.get_filepath(), mmap=True)
+print 'Mean counts: %.03f' % d2.get_data()[:,1].mean()
+
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print 'Peak RSS: %.01f MB' % (rss / 1024.0)
@@ -0,0 +1,20 @@
+# Script to test the cost of adding points to an in-memory Data object.
+# The time per point should stay (roughly) constant with increasing size.
+
+import qt
+import time
+
+for N in (1e3, 1e4, 1e5, 1e6):
+    d = qt.Data(name='speedtest', inmem=True, infile=False)
+    d.add_coordinate('X')
+    d.add_value('Y')
+
+    start = time.time()
+    i = 0
+    while i < N:
+        d.add_data_point(i, 2 * i)
+        i += 1
+    stop = time.time()
+
+    print 'N = %d: %.03f usec / point' % (N, (stop - start) / N * 1e6)
+    assert len(d.get_data()) == N
@@ -0,0 +1,30 @@
+# Script to measure updating the temporary file of a growing data set, as
+# done when plotting an in-memory array repeatedly. Only appended rows are
+# written, unless earlier rows change.
+
+import qt
+import time
+import numpy as np
+
+N = 20000
+STEP = 100
+vals = np.random.rand(N, 2)
+
+for binary in (True, False):
+    d = qt.Data(data=vals[:STEP], tempfile=True, binary=binary)
+    start = time.time()
+    for n in range(2 * STEP, N + 1, STEP):
+        d.update_data(vals[:n])
+    stop = time.time()
+    stats = d.get_tempfile_stats()
+    print 'binary=%s: %d updates in %.03f sec, %d bytes written, %d rewrites' \
+            % (binary, stats['nupdates'], stop - start, stats['total_bytes'],
+                stats['nrewrites'])
+
+    # Changing an earlier row, also in place, requires a full rewrite
+    vals[0, 1] += 1
+    d.update_data(vals)
+    stats = d.get_tempfile_stats()
+    print 'after change: %d bytes written, %d rewrites' \
+            % (stats['last_bytes'], stats['nrewrites'])
+    assert stats['nrewrites'] == 1, 'earlier row change was not rewritten'
@@ -1,32 +1,41 @@
 # Script to test overhead of QTLab framework
+#
+# Compares calling the driver function directly with the parameter accessors
+# (get_<name> / set_<name>), which use a precompiled fast path, and with the
+# generic get() / set() functions. The overhead is the time per call on top
+# of the driver function.
 
 import qt
 import time
 
-ins = qt.instruments['dsgen']
-N = 1e6
+if 'dsgen' not in qt.instruments.get_instrument_names():
+    qt.instruments.create('dsgen', 'dummy_signal_generator')
+ins = qt.instruments.get('dsgen', proxy=False)
+N = 100000
 
-start = time.time()
-i = 0
-while i < N:
-    v = ins._ins.do_get_wave()
-    i += 1
-stop = time.time()
-print 'do_get_wave: %s sec' % (stop - start, )
+def timeit(func):
+    start = time.time()
+    i = 0
+    while i < N:
+        func()
+        i += 1
+    stop = time.time()
+    return (stop - start) / N * 1e6
 
-start = time.time()
-i = 0
-while i < N:
-    v = ins.get_wave(fast=True)
-    i += 1
-stop = time.time()
-print 'get_wave(fast=True): %s sec' % (stop - start, )
+def report(label, t, tref):
+    print '%-30s %6.2f us/call, overhead %6.2f us' % (label, t, t - tref)
 
-start = time.time()
-i = 0
-while i < N:
-    v = ins.get_wave()
-    i += 1
-stop = time.time()
-print 'get_wave: %s sec' % (stop - start, )
+tref = timeit(ins.do_get_wave)
+report('do_get_wave()', tref, tref)
+report("get('wave')", timeit(lambda: ins.get('wave')), tref)
+report("get('wave', fast=True)", timeit(lambda: ins.get('wave', fast=True)), tref)
+report('get_wave()', timeit(ins.get_wave), tref)
+report('get_wave(fast=True)', timeit(lambda: ins.get_wave(fast=True)), tref)
 
+print ''
+tref = timeit(lambda: ins.do_set_amplitude(0.5))
+report('do_set_amplitude(0.5)', tref, tref)
+report("set('amplitude', 0.5)", timeit(lambda: ins.set('amplitude', 0.5)), tref)
+report('set_amplitude(0.5)', timeit(lambda: ins.set_amplitude(0.5)), tref)
+report('set_amplitude(0.5, fast=True)',
+        timeit(lambda: ins.set_amplitude(0.5, fast=True)), tref)
@@ -21,6 +21,7 @@ import visa
 import types
 import logging
 import numpy
+from lib import binblock
 
 class Agilent_81180A(Instrument):
     '''
@@ -212,9 +213,22 @@ class Agilent_81180A(Instrument):
         logging.debug(__name__ + ' : get voltage')
         return float(self._visainstrument.ask('SOUR:VOLT?\n'))
 
+    def send_waveform(self, w, segment=1):
+        '''
+        Upload a waveform to a segment of the active channel, as a binary
+        block of 12 bit values.
 
+        Input:
+            w (float[numpoints]) : waveform, between -1 and 1
+            segment (int) : segment number
 
-
-
-
-
+        Output:
+            None
+        '''
+        logging.debug(__name__ + ' : Sending waveform of %d points to segment %d'
+            % (len(w), segment))
+        data = numpy.round((numpy.clip(w, -1, 1) + 1) * 2047.5)
+        data = data.astype('<u2')
+        self._visainstrument.write('TRAC:DEF %d,%d' % (segment, len(data)))
+        self._visainstrument.write('TRAC:SEL %d' % segment)
+        self._visainstrument.write('TRAC:DATA' + binblock.encode_block(data))
@@ -175,12 +175,11 @@ class IVVI(Instrument):
             None
         '''
         logging.info('Get all')
-        for i in range(self._numdacs):
-            self.get('dac%d' % (i+1))
+        self.get(['dac%d' % (i+1) for i in range(self._numdacs)])
 
     def set_dacs_zero(self):
-        for i in range(self._numdacs):
-            self.set('dac%d' % (i+1), 0)
+        # Ramps all dacs at the same time
+        self.set(dict([('dac%d' % (i+1), 0) for i in range(self._numdacs)]))
 
     # Conversion of data
     def _mvoltage_to_bytes(self, mvoltage):
@@ -224,6 +223,23 @@ class IVVI(Instrument):
         mvoltages = self._get_dacs()
         return mvoltages[channel - 1]
 
+    def do_get_many(self, names):
+        '''
+        Returns the values of all dacs, which are read in one transaction.
+
+        Input:
+            names (list) : names of the requested parameters
+
+        Output:
+            values (dict) : dacvalues in mV, for all dacs
+        '''
+        logging.debug('Reading dacs for %s', names)
+        mvoltages = self._get_dacs()
+        values = {}
+        for i in range(self._numdacs):
+            values['dac%d' % (i+1)] = mvoltages[i]
+        return values
+
     def do_set_dac(self, mvoltage, channel):
         '''
         Sets the specified dac to the specified voltage
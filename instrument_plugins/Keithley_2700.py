@@ -50,6 +50,30 @@ class Keithley_2700(Instrument):
         change_autozero=<bool>)
     '''
 
+    # Parameters that can be combined in a single query or write, as
+    # name -> (mode, SCPI parameter). A mode of None is the current mode.
+    _MULTI_PARS = {
+        'range': (None, 'RANG'),
+        'digits': (None, 'DIG'),
+        'integrationtime': (None, 'APER'),
+        'nplc': (None, 'NPLC'),
+        'trigger_continuous': ('INIT', 'CONT'),
+        'trigger_count': ('TRIG', 'COUN'),
+        'trigger_delay': ('TRIG', 'DEL'),
+        'trigger_source': ('TRIG', 'SOUR'),
+        'trigger_timer': ('TRIG', 'TIM'),
+        'display': ('DISP', 'ENAB'),
+        'autozero': ('SYST', 'AZER:STAT'),
+        'averaging': (None, 'AVER:STAT'),
+        'averaging_window': (None, 'AVER:WIND'),
+        'averaging_count': (None, 'AVER:COUN'),
+        'averaging_type': (None, 'AVER:TCON'),
+        'autorange': (None, 'RANG:AUTO'),
+    }
+
+    # Parameters with a side effect when set, these are set one by one
+    _MULTI_NOSET = ('integrationtime', 'nplc', 'averaging_type')
+
     def __init__(self, name, address, reset=False,
             change_display=True, change_autozero=True):
         '''
@@ -95,7 +119,7 @@ class Keithley_2700(Instrument):
             units='s', minval=0, maxval=999999.999, type=types.FloatType)
         self.add_parameter('trigger_source',
             flags=Instrument.FLAG_GETSET,
-            units='')
+            units='', type=types.StringType)
         self.add_parameter('trigger_timer',
             flags=Instrument.FLAG_GETSET,
             units='s', minval=0.001, maxval=99999.999, type=types.FloatType)
@@ -165,6 +189,11 @@ class Keithley_2700(Instrument):
         self.add_function('send_trigger')
         self.add_function('fetch')
 
+        # Add sweeps to wrapper
+        self.add_sweep('buffer', read_parameters=['readval'],
+            max_points=55000,
+            doc='Store readings in the internal buffer')
+
         # Connect to measurement flow to detect start and stop of measurement
         qt.flow.connect('measurement-start', self._measurement_start_cb)
         qt.flow.connect('measurement-end', self._measurement_end_cb)
@@ -231,23 +260,12 @@ class Keithley_2700(Instrument):
         '''
         logging.info('Get all relevant data from device')
         self.get_mode()
-        self.get_range()
-        self.get_trigger_continuous()
-        self.get_trigger_count()
-        self.get_trigger_delay()
-        self.get_trigger_source()
-        self.get_trigger_timer()
-        self.get_mode()
-        self.get_digits()
-        self.get_integrationtime()
-        self.get_nplc()
-        self.get_display()
-        self.get_autozero()
-        self.get_averaging()
-        self.get_averaging_window()
-        self.get_averaging_count()
-        self.get_averaging_type()
-        self.get_autorange()
+        # The other parameters depend on the mode and are read in one query
+        self.get(['range', 'trigger_continuous', 'trigger_count',
+            'trigger_delay', 'trigger_source', 'trigger_timer', 'digits',
+            'integrationtime', 'nplc', 'display', 'autozero', 'averaging',
+            'averaging_window', 'averaging_count', 'averaging_type',
+            'autorange'])
 
 # Link old read and readlast to new routines:
     # Parameters are for states of the machnine and functions
@@ -1079,10 +1097,160 @@ class Keithley_2700(Instrument):
         elif ans.startswith('MOV'):
             ans='moving'
         return ans
+
+    def do_arm_buffer(self, npoints, interval=None, trigger_source=None,
+            **kwargs):
+        '''
+        Prepare the internal buffer to store <npoints> readings.
+
+        The trigger count is limited to 9999. For more readings the
+        instrument is triggered continuously; the buffer stops storing
+        readings when it is full, after which fetch_buffer() aborts the
+        measurement.
+
+        Input:
+            npoints (int) : number of readings
+            interval (float) : time between readings in seconds, uses the
+                trigger timer
+            trigger_source (string) : trigger source if no interval is
+                given, e.g. 'EXT'. Default is the current trigger source.
+
+        Output:
+            True if the buffer was armed
+        '''
+        logging.debug('Arm buffer for %d readings', npoints)
+        self._buffer_points = npoints
+        self._visainstrument.write(':ABOR;:FORM:ELEM READ;:TRAC:CLE;' +
+            ':TRAC:POIN %d;:TRAC:FEED SENS;:TRAC:FEED:CONT NEXT' % npoints)
+
+        # do_set_many() sends a trigger count above 9999 as INF
+        pars = {'trigger_continuous': False, 'trigger_count': npoints}
+        if interval is not None:
+            pars['trigger_source'] = 'TIM'
+            pars['trigger_timer'] = interval
+        elif trigger_source is not None:
+            pars['trigger_source'] = trigger_source
+        self.set(pars)
+        return True
+
+    def do_trigger_buffer(self):
+        '''
+        Start taking readings into the buffer.
+        '''
+        logging.debug('Trigger buffer')
+        self._visainstrument.write(':INIT')
+
+    def do_fetch_buffer(self):
+        '''
+        Wait until the buffer is filled and return the readings.
+
+        Output:
+            readings (numpy array)
+        '''
+        while int(float(self._visainstrument.ask(':TRAC:POIN:ACT?'))) < \
+                self._buffer_points:
+            qt.msleep(0.05)
+
+        # Stop continuous triggering used for more than 9999 readings
+        if self._buffer_points > 9999:
+            self._visainstrument.write(':ABOR')
+
+        reply = self._visainstrument.ask(':TRAC:DATA?')
+        return numpy.array([float(v[0:15]) for v in reply.split(',')])
+
+    def do_get_many(self, names):
+        '''
+        Read several parameters from the instrument in one compound query.
+        Only parameters in self._MULTI_PARS are handled.
+
+        Input:
+            names (list) : names of the requested parameters
+
+        Output:
+            values (dict) : parameter values
+        '''
+        names = [n for n in names if n in self._MULTI_PARS]
+        if len(names) == 0:
+            return {}
+
+        cmds = []
+        for name in names:
+            mode, par = self._MULTI_PARS[name]
+            cmds.append(':%s:%s?' % (self._determine_mode(mode), par))
+        string = ';'.join(cmds)
+        reply = self._visainstrument.ask(string)
+        logging.debug('ask instrument for %s (result %s)' % (string, reply))
+
+        replies = reply.strip().split(';')
+        if len(replies) != len(names):
+            logging.warning('Unexpected reply to compound query: %r', reply)
+            return {}
+
+        values = {}
+        for name, ans in zip(names, replies):
+            values[name] = self._parse_reply(name, ans)
+        return values
+
+    def do_set_many(self, values):
+        '''
+        Write several parameters to the instrument in one compound command.
+        Only parameters in self._MULTI_PARS without side effects are handled.
+
+        Input:
+            values (dict) : parameter -> value
+
+        Output:
+            names (list) : the parameters that were set
+        '''
+        cmds = []
+        names = []
+        for name, val in values.iteritems():
+            if name not in self._MULTI_PARS or name in self._MULTI_NOSET:
+                continue
+            if type(val) is types.BooleanType:
+                val = bool_to_str(val)
+            elif name == 'trigger_count' and val > 9999:
+                val = 'INF'
+            mode, par = self._MULTI_PARS[name]
+            cmds.append(':%s:%s %s' % (self._determine_mode(mode), par, val))
+            names.append(name)
+
+        if len(cmds) > 0:
+            string = ';'.join(cmds)
+            logging.debug('Set instrument to %s' % string)
+            self._visainstrument.write(string)
+        return names
+
 # --------------------------------------
 #           Internal Routines
 # --------------------------------------
 
+    def _parse_reply(self, name, ans):
+        '''
+        Convert a reply to a query for parameter <name> in the same way as
+        the do_get_<name> functions.
+        '''
+        if name == 'trigger_count':
+            try:
+                return int(ans)
+            except:
+                return 0
+        elif name == 'averaging_type':
+            if ans.startswith('REP'):
+                return 'repeat'
+            elif ans.startswith('MOV'):
+                return 'moving'
+            return ans
+
+        ptype = self.get_parameter_options(name)['type']
+        if ptype is types.BooleanType:
+            return bool(int(ans))
+        elif ptype is types.IntType:
+            return int(ans)
+        elif ptype is types.FloatType:
+            return float(ans)
+        return ans
+
     def _change_units(self, unit):
         self.set_parameter_options('readval', units=unit)
         self.set_parameter_options('readlastval', units=unit)
@@ -20,6 +20,7 @@ from instrument import Instrument
 import visa
 import types
 import logging
+from lib import binblock
 
 class LeCroy_44Xi(Instrument):
     '''
@@ -269,3 +270,30 @@ class LeCroy_44Xi(Instrument):
         result = result.replace('MSIZ ', '')
         result = result.replace(' SAMPLE', '')
         return float(result)
+
+    def _get_inspect(self, channel, name):
+        '''
+        Get a value from the waveform descriptor of a channel.
+        '''
+        result = self._visainstrument.ask('C%s:INSP? "%s"' % (channel, name))
+        return float(result.split(':')[-1].strip(' "\r\n'))
+
+    def get_waveform(self, channel):
+        '''
+        Read the waveform of a channel, transferred as a binary block of
+        16 bit values.
+
+        Input:
+            channel (int) : channel (1,2,3,4)
+
+        Output:
+            data (numpy array) : waveform in Volts
+        '''
+        logging.info(__name__ + ' : Get waveform of channel %s' % channel)
+        self._visainstrument.write('CORD LO; CFMT DEF9,WORD,BIN')
+        gain = self._get_inspect(channel, 'VERTICAL_GAIN')
+        offset = self._get_inspect(channel, 'VERTICAL_OFFSET')
+        self._visainstrument.write('C%s:WF? DAT1' % channel)
+        data = self._visainstrument.read_raw()
+        wave, end = binblock.decode_block(data, '<i2')
+        return wave * gain - offset
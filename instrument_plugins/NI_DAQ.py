@@ -16,6 +16,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import types
+import numpy
 from lib.dll_support import nidaq
 from instrument import Instrument
 import qt
@@ -34,6 +35,8 @@ class NI_DAQ(Instrument):
         Instrument.__init__(self, name, tags=['physical'])
 
         self._id = id
+        self._sweep_settings = {}
+        self._sweep_data = {}
 
         for ch_in in self._get_input_channels():
             ch_in = _get_channel(ch_in)
@@ -44,6 +47,12 @@ class NI_DAQ(Instrument):
                 tags=['measure'],
                 get_func=self.do_get_input,
                 channel=ch_in)
+            self.add_sweep(ch_in,
+                read_parameters=[ch_in],
+                arm_func=self.do_arm_input,
+                trigger_func=self.do_trigger_input,
+                fetch_func=self.do_fetch_input,
+                channel=ch_in)
 
         for ch_out in self._get_output_channels():
             ch_out = _get_channel(ch_out)
@@ -109,6 +118,24 @@ class NI_DAQ(Instrument):
         devchan = '%s/%s' % (self._id, channel)
         return nidaq.read(devchan, config=self._chan_config)
 
+    def do_arm_input(self, npoints, channel, freq=10000.0, **kwargs):
+        '''Prepare reading <npoints> samples at <freq> Hz.'''
+        self._sweep_settings[channel] = (npoints, freq)
+        self._sweep_data[channel] = None
+        return True
+
+    def do_trigger_input(self, channel):
+        npoints, freq = self._sweep_settings[channel]
+        devchan = '%s/%s' % (self._id, channel)
+        self._sweep_data[channel] = nidaq.read(devchan, samples=npoints,
+                freq=freq, config=self._chan_config)
+
+    def do_fetch_input(self, channel):
+        data = self._sweep_data.pop(channel, None)
+        if data is None:
+            return None
+        return numpy.atleast_1d(data)
+
     def do_set_output(self, val, channel):
         devchan = '%s/%s' % (self._id, channel)
         return nidaq.write(devchan, val)
@@ -20,6 +20,9 @@ import visa
 import types
 import logging
 import time
+import math
+import numpy
+import qt
 
 class SR830(Instrument):
     '''
@@ -173,11 +176,67 @@ class SR830(Instrument):
         self.add_function('reset')
         self.add_function('get_all')
 
+        self.add_sweep('buffer', read_parameters=['X', 'Y'],
+            max_points=16383,
+            doc='Store X and Y in the internal data buffer')
+
         if reset:
             self.reset()
         else:
             self.get_all()
 
+    # Sweeps
+    def do_arm_buffer(self, npoints, rate=None, **kwargs):
+        '''
+        Prepare the data buffer to store <npoints> points of X and Y.
+        Note that this changes the display of channel 1 and 2 to X and Y.
+
+        Input:
+            npoints (int) : number of points
+            rate (float) : sample rate in Hz, 0.0625 to 512 in powers of
+                two. If None, a point is stored for each external trigger.
+
+        Output:
+            True if the buffer was armed
+        '''
+        if rate is None:
+            srat = 14
+        else:
+            srat = int(round(math.log(rate, 2))) + 4
+            if srat < 0 or srat > 13:
+                logging.error(__name__ + ' : Invalid sample rate %s', rate)
+                return False
+
+        logging.info(__name__ + ' : Arm buffer for %d points', npoints)
+        self._buffer_points = npoints
+        self._visainstrument.write('REST;DDEF 1,0,0;DDEF 2,0,0;' +
+            'SEND 0;TSTR 0;SRAT %d' % srat)
+        return True
+
+    def do_trigger_buffer(self):
+        '''
+        Start storing data in the buffer.
+        '''
+        self._visainstrument.write('STRT')
+
+    def do_fetch_buffer(self):
+        '''
+        Wait until the buffer has been filled and read X and Y.
+
+        Output:
+            data (numpy array) : X and Y columns
+        '''
+        while int(self._visainstrument.ask('SPTS?')) < self._buffer_points:
+            qt.msleep(0.05)
+        self._visainstrument.write('PAUS')
+
+        data = []
+        for i in (1, 2):
+            reply = self._visainstrument.ask('TRCA? %d,0,%d' % \
+                (i, self._buffer_points))
+            data.append([float(v) for v in reply.split(',') if v.strip()])
+        return numpy.column_stack(data)
+
     # Functions
     def reset(self):
         '''
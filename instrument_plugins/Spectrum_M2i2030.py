@@ -1116,7 +1116,7 @@ class Spectrum_M2i2030(Instrument):
 
     def readout_raw_buffer(self, nr_of_channels=1):
         '''
-        Reads out the buffer, and returns a list with the size of the
+        Reads out the buffer, and returns an int8 array with the size of the
         buffer. Contains only data if the channel is triggered.
 
         Input:
@@ -1148,7 +1148,8 @@ class Spectrum_M2i2030(Instrument):
             self._get_error()
             raise ValueError('Error communicating with device')
 
-        data = p_data.contents[:]
+        # numpy array sharing memory with the ctypes buffer
+        data = numpy.ctypeslib.as_array(a)
         return data
 
     def readout_singlechannel_singlemode_bin(self):
@@ -1185,10 +1186,7 @@ class Spectrum_M2i2030(Instrument):
         offset = float(self.get_input_offset_ch0())
 
         data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.float32)
-        data = []
+        data = data.astype(numpy.float32)
         data = 2.0 * amp * (data / 255.0) + offset
         return data
 
@@ -1199,9 +1197,6 @@ class Spectrum_M2i2030(Instrument):
         lnumber_of_samples = lMemsize / lSegsize
 
         data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
         data = numpy.reshape(data, (lnumber_of_samples, lSegsize))
         return data
 
@@ -1214,9 +1209,7 @@ class Spectrum_M2i2030(Instrument):
         lnumber_of_samples = lMemsize / lSegsize
 
         data = self.readout_raw_buffer()
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.float32)
+        data = data.astype(numpy.float32)
         data = numpy.reshape(data, (lnumber_of_samples, lSegsize))
         data = 2.0 * amp * (data / 255.0) + offset
         return data
@@ -1228,9 +1221,6 @@ class Spectrum_M2i2030(Instrument):
         lnumber_of_samples = lMemsize / lSegsize
 
         data = self.readout_raw_buffer(nr_of_channels=2)
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
         data = numpy.reshape(data, (lMemsize, 2))
         data0 = data[:,0]
         data1 = data[:,1]
@@ -1249,9 +1239,6 @@ class Spectrum_M2i2030(Instrument):
         lnumber_of_samples = lMemsize / lSegsize
 
         data = self.readout_raw_buffer(nr_of_channels=2)
-        if data == 'timeout':
-            return data
-        data = numpy.array(data, numpy.int8)
         data = numpy.reshape(data, (lMemsize, 2))
         data0 = data[:,0]
         data1 = data[:,1]
@@ -22,7 +22,7 @@ import visa
 import types
 import logging
 import numpy
-import struct
+from lib import binblock
 
 class Tektronix_AWG5014(Instrument):
     '''
@@ -664,29 +664,7 @@ class Tektronix_AWG5014(Instrument):
             data = self._visainstrument.ask('MMEM:DATA? "%s"' % name)
             logging.debug(__name__  + ' : File exists on instrument, loading \
             into local memory')
-            # string alsvolgt opgebouwd: '#' <lenlen1> <len> 'MAGIC 1000\r\n' '#' <len waveform> 'CLOCK ' <clockvalue>
-            len1=int(data[1])
-            len2=int(data[2:2+len1])
-            i=len1
-            tekst = ""
-            while (tekst!='#'):
-                tekst=data[i]
-                i=i+1
-            len3=int(data[i])
-            len4=int(data[i+1:i+1+len3])
-
-            w=[]
-            m1=[]
-            m2=[]
-
-            for q in range(i+1+len3, i+1+len3+len4,5):
-                j=int(q)
-                c,d = struct.unpack('<fB', data[j:5+j])
-                w.append(c)
-                m2.append(int(d/2))
-                m1.append(d-2*int(d/2))
-
-            clock = float(data[i+1+len3+len4+5:len(data)])
+            w, m1, m2, clock = binblock.decode_tek_wfm(data)
 
             self._values['files'][name]={}
             self._values['files'][name]['w']=w
@@ -951,21 +929,8 @@ class Tektronix_AWG5014(Instrument):
         self._values['files'][filename]['clock']=clock
         self._values['files'][filename]['numpoints']=len(w)
 
-        m = m1 + numpy.multiply(m2,2)
-        ws = ''
-        for i in range(0,len(w)):
-            ws = ws + struct.pack('<fB', w[i], int(m[i]))
-
-        s1 = 'MMEM:DATA "%s",' % filename
-        s3 = 'MAGIC 1000\n'
-        s5 = ws
-        s6 = 'CLOCK %.10e\n' % clock
-
-        s4 = '#' + str(len(str(len(s5)))) + str(len(s5))
-        lenlen=str(len(str(len(s6) + len(s5) + len(s4) + len(s3))))
-        s2 = '#' + lenlen + str(len(s6) + len(s5) + len(s4) + len(s3))
-
-        mes = s1 + s2 + s3 + s4 + s5 + s6
+        mes = 'MMEM:DATA "%s",' % filename + \
+            binblock.encode_block(binblock.encode_tek_wfm(w, m1, m2, clock))
 
         self._visainstrument.write(mes)
 
@@ -3,6 +3,7 @@ import types
 
 import time
 import math
+import numpy
 
 class dummy_signal_generator(Instrument):
 
@@ -47,6 +48,11 @@ class dummy_signal_generator(Instrument):
                 Arbitrary units. (takes 1sec)
                 """)
 
+        self.add_sweep('amplitude', sweep_parameter='amplitude',
+                read_parameters=['wave'], doc="""
+                Step the amplitude and read the wave at every point.
+                """)
+
         self.add_function('reset')
 
         self.set_wave_type('SIN')
@@ -86,6 +92,23 @@ class dummy_signal_generator(Instrument):
             else:
                 return -(amod - 0.95) * 2 / 0.1 * self._amplitude
 
+    def do_arm_amplitude(self, npoints, values=None, **kwargs):
+        if values is None:
+            values = numpy.ones(npoints) * self._amplitude
+        self._sweep_values = values
+        self._sweep_data = None
+        return True
+
+    def do_trigger_amplitude(self):
+        data = []
+        for val in self._sweep_values:
+            self._amplitude = val
+            data.append(self.do_get_wave())
+        self._sweep_data = numpy.array(data)
+
+    def do_fetch_amplitude(self):
+        return self._sweep_data
+
     def do_get_slow_wave(self):
         time.sleep(1)
         return self.do_get_wave()
@@ -26,10 +26,15 @@ import re
 import logging
 import copy
 import shutil
+import sys
+import threading
+import Queue
+import zlib
 
 from gettext import gettext as _L
 
 from lib import namedlist, temp
+from lib.file_support import datacache
 from lib.misc import dict_to_ordered_tuples, get_arg_type
 from lib.config import get_config
 config = get_config()
@@ -151,6 +156,127 @@ class _DataList(namedlist.NamedList):
         else:
             return name
 
+class _AsyncWriter(threading.Thread):
+    '''
+    Thread that writes data to a file. Data is passed through a bounded
+    queue; when the queue is full the caller blocks until there is room.
+
+    If writing to the file fails, the remaining queued data is discarded
+    and the error is raised from the next call to write() or close().
+    '''
+
+    def __init__(self, f, maxsize=1000, flush_rows=1000, flush_interval=200):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self._file = f
+        self._queue = Queue.Queue(maxsize)
+        self._flush_rows = flush_rows
+        self._flush_interval = flush_interval
+
+        self._nrows = 0
+        self._nblocked = 0
+        self._max_depth = 0
+        self._max_latency = 0
+        self._error = None
+
+        self.start()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def write(self, text, nrows=0, flush=False):
+        '''Queue text containing nrows data lines for writing.'''
+
+        self._raise_error()
+        item = (text, nrows, flush, time.time())
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self._nblocked += 1
+            self._queue.put(item)
+
+        depth = self._queue.qsize()
+        if depth > self._max_depth:
+            self._max_depth = depth
+
+    def close(self):
+        '''Write all queued data and stop the thread.'''
+        self._queue.put(None)
+        self.join()
+        self._raise_error()
+
+    def get_stats(self):
+        '''
+        Return a dictionary with writer statistics:
+            nrows: number of data rows written
+            queue_depth: current number of queued items
+            max_queue_depth: maximum number of queued items
+            nblocked: number of times a write had to wait for the queue
+            max_latency: maximum time (in ms) between queueing and writing
+        '''
+
+        return {
+            'nrows': self._nrows,
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self._max_depth,
+            'nblocked': self._nblocked,
+            'max_latency': self._max_latency * 1000,
+        }
+
+    def _do_file_op(self, func, *args):
+        '''
+        Call a file method; on an error store it, so that it is raised in
+        the calling thread. Returns whether the call succeeded.
+        '''
+
+        if self._error is not None:
+            return False
+        try:
+            func(*args)
+            return True
+        except Exception, e:
+            logging.error('Error writing data: %s', e)
+            self._error = sys.exc_info()
+            return False
+
+    def run(self):
+        nunflushed = 0
+        last_flush = time.time()
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self._flush_interval / 1000.0)
+            except Queue.Empty:
+                if nunflushed > 0:
+                    self._do_file_op(self._file.flush)
+                    nunflushed = 0
+                last_flush = time.time()
+                continue
+
+            if item is None:
+                self._do_file_op(self._file.flush)
+                return
+
+            # After an error the queue is still emptied, so that callers
+            # do not block.
+            text, nrows, flush, ts = item
+            if not self._do_file_op(self._file.write, text):
+                continue
+
+            latency = time.time() - ts
+            if latency > self._max_latency:
+                self._max_latency = latency
+
+            self._nrows += nrows
+            nunflushed += nrows
+            if flush or nunflushed >= self._flush_rows or \
+                    (time.time() - last_flush) * 1000 >= self._flush_interval:
+                self._do_file_op(self._file.flush)
+                nunflushed = 0
+                last_flush = time.time()
+
 class Data(SharedGObject):
     '''
     Data class
@@ -235,6 +361,26 @@ class Data(SharedGObject):
             tempfile (bool), default False. If True create a temporary file
                 for the data.
             binary (bool), default True. Whether tempfile should be binary.
+            npoints (int), expected number of data points. Used to size the
+                in-memory buffer; if omitted it is derived from the sizes of
+                the coordinate dimensions when available.
+            flush_rows (int), flush the data file after this many rows.
+                Default is 'data_flush_rows' from config, or 1000.
+            flush_interval (int), flush the data file if data has been
+                pending for this many ms. Default is 'data_flush_interval'
+                from config, or 200.
+            async_write (bool), default False. If True the data file is
+                written in a separate thread.
+            async_queue_size (int), default 1000. Maximum number of
+                pending writes in async_write mode.
+            cache (string), cache parsed data when loading a file, see
+                lib.file_support.datacache. One of 'sidecar', 'temp' or
+                False. Default is 'data_cache' from config, or False.
+            mmap (bool), default False. If True the data is stored in a
+                memory-mapped binary file (<name>.bin next to the data file,
+                or a temporary file) instead of in memory. When loading a
+                file, an existing .bin file will be mapped instead of
+                parsing the text file, if <name>.bin.json matches it.
         '''
 
         # Init SharedGObject a bit lower
@@ -243,13 +389,49 @@ class Data(SharedGObject):
         infile = kwargs.get('infile', True)
         inmem = kwargs.get('inmem', False)
 
+        # Memory-mapped storage
+        self._mmap = kwargs.get('mmap', False)
+        self._mmap_path = None
+        self._mmap_temp = None
+        if self._mmap:
+            inmem = True
+
         self._inmem = inmem
         self._tempfile = kwargs.get('tempfile', False)
         self._temp_binary = kwargs.get('binary', True)
+        self._temp_nrows = 0
+        self._temp_format = None
+        self._temp_crc = None
+        self._temp_stats = {
+            'nupdates': 0,
+            'nappends': 0,
+            'nrewrites': 0,
+            'last_bytes': 0,
+            'total_bytes': 0,
+        }
         self._options = kwargs
         self._file = None
         self._stop_req_hid = None
 
+        # Preallocated in-memory storage, self._data is a view of the
+        # filled rows.
+        self._buffer = None
+        self._npoints_expected = kwargs.get('npoints', 0)
+
+        # File write buffering
+        self._column_formats = None
+        self._flush_rows = kwargs.get('flush_rows',
+                config.get('data_flush_rows', 1000))
+        self._flush_interval = kwargs.get('flush_interval',
+                config.get('data_flush_interval', 200))
+        self._nrows_unflushed = 0
+        self._last_flush = time.time()
+        self._flush_hid = None
+        self._async_write = kwargs.get('async_write', False)
+        self._writer = None
+        self._write_stats = None
+        self._cache_mode = kwargs.get('cache', config.get('data_cache', False))
+
         # Dimension info
         self._dimensions = []
         self._block_sizes = []
@@ -257,6 +439,7 @@ class Data(SharedGObject):
         self._loopshape = None
         self._complete = False
         self._reshaped_data = None
+        self._reset_shape_tracker()
 
         # Number of coordinate dimensions
         self._ncoordinates = 0
@@ -270,6 +453,8 @@ class Data(SharedGObject):
         self._npoints_max_block = 0
 
         self._comment = []
+        # Comment lines written to the file after the header
+        self._comment_lines = []
         self._localtime = time.localtime()
         self._timestamp = time.asctime(self._localtime)
         self._timemark = time.strftime('%H%M%S', self._localtime)
@@ -422,13 +607,17 @@ class Data(SharedGObject):
 
         return label
 
-    def get_data(self, reshape=False):
+    def get_data(self, reshape=False, completed=False):
         '''
         Return data as a numpy.array.
 
         Normally the data is just a 2D array, with a set of values on each
         'line'. However, if reshape is True, the data will be reshaped into
         the detected dimension sizes.
+
+        While a measurement is running the data set is not complete, and
+        reshaping is not possible. If completed is True, the completed
+        iterations of the outer loop will be returned instead.
         '''
 
         if not self._inmem and self._infile:
@@ -436,15 +625,15 @@ class Data(SharedGObject):
 
         if self._inmem:
             if reshape:
-                return self._reshape_data()
+                return self._reshape_data(completed=completed)
             else:
                 return self._data
         else:
             return None
 
-    def get_reshaped_data(self):
+    def get_reshaped_data(self, completed=False):
         ''''Return data reshaped with the proper dimensions.'''
-        return self.get_data(reshape=True)
+        return self.get_data(reshape=True, completed=completed)
 
     def get_title(self, coorddims, valdim):
         '''
@@ -527,6 +716,7 @@ class Data(SharedGObject):
             kwargs['size'] = 0
         self._ncoordinates += 1
         self._dimensions.append(kwargs)
+        self._column_formats = None
 
     def add_value(self, name, **kwargs):
         '''
@@ -547,17 +737,30 @@ class Data(SharedGObject):
         kwargs['type'] = 'value'
         self._nvalues += 1
         self._dimensions.append(kwargs)
+        self._column_formats = None
 
     def add_comment(self, comment):
         '''Add comment to the Data object.'''
         self._comment.append(comment)
-        if self._file is not None:
-            self._file.write('# %s\n' % comment)
+        line = '# %s' % comment
+        if self._writer is not None:
+            self._writer.write(line + '\n')
+            self._comment_lines.append(line)
+        elif self._file is not None:
+            self._file.write(line + '\n')
+            self._comment_lines.append(line)
 
     def get_comment(self):
         '''Return the comment for the Data object.'''
         return self._comment
 
+    def reserve(self, npoints):
+        '''
+        Inform the Data object of the expected number of data points, so
+        that in-memory storage can be allocated in advance.
+        '''
+        self._npoints_expected = npoints
+
 ### File writing
 
     def create_file(self, name=None, filepath=None, settings_file=True):
@@ -587,10 +790,17 @@ class Data(SharedGObject):
             return False
 
         self._write_header()
+        self._compile_column_formats()
 
         if settings_file and in_qtlab:
             self._write_settings_file()
 
+        if self._async_write:
+            self._writer = _AsyncWriter(self._file,
+                    maxsize=self._options.get('async_queue_size', 1000),
+                    flush_rows=self._flush_rows,
+                    flush_interval=self._flush_interval)
+
         try:
             if in_qtlab:
                 self._stop_req_hid = \
@@ -605,14 +815,32 @@ class Data(SharedGObject):
         Close open data file.
         '''
 
+        # A write error from the writer thread is raised after the file
+        # has been closed.
+        error = None
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                error = sys.exc_info()
+            self._write_stats = self._writer.get_stats()
+            self._writer = None
+
         if self._file is not None:
+            self.flush()
             self._file.close()
             self._file = None
 
+        if self._mmap and self._buffer is not None:
+            self._finish_mmap()
+
         if self._stop_req_hid is not None and in_qtlab:
             qt.flow.disconnect(self._stop_req_hid)
             self._stop_req_hid = None
 
+        if error is not None:
+            raise error[0], error[1], error[2]
+
     def _write_settings_file(self):
         fn = self.get_settings_filepath()
         f = open(fn, 'w+')
@@ -631,6 +859,7 @@ class Data(SharedGObject):
     def _write_header(self):
         self._file.write('# Filename: %s\n' % self._filename)
         self._file.write('# Timestamp: %s\n\n' % self._timestamp)
+        self._comment_lines = []
         for line in self._comment:
             self._file.write('# %s\n' % line)
 
@@ -643,47 +872,143 @@ class Data(SharedGObject):
 
         self._file.write('\n')
 
-    def _format_data_value(self, val, colnum):
-        if type(val) in self._INT_TYPES:
-            return '%d' % val
+    def _compile_column_formats(self):
+        '''
+        Create the format strings for all columns, based on the 'format' or
+        'precision' options of the dimensions.
+        '''
 
-        if colnum < len(self._dimensions):
-            opts = self._dimensions[colnum]
+        precision = config.get('default_precision', 12)
+        self._default_format = '%%.%de' % precision
+
+        formats = []
+        for opts in self._dimensions:
             if 'format' in opts:
-                return opts['format'] % val
+                formats.append(opts['format'])
             elif 'precision' in opts:
-                format = '%%.%de' % opts['precision']
-                return format % val
+                formats.append('%%.%de' % opts['precision'])
+            else:
+                formats.append(self._default_format)
+        self._column_formats = formats
 
-        precision = config.get('default_precision', 12)
-        format = '%%.%de' % precision
-        return format % val
+    def _get_column_formats(self, ncols):
+        if self._column_formats is None:
+            self._compile_column_formats()
 
-    def _write_data_line(self, args):
+        formats = self._column_formats[:ncols]
+        if len(formats) < ncols:
+            formats += [self._default_format] * (ncols - len(formats))
+        return formats
+
+    def _format_data_value(self, val, colnum):
+        if type(val) in self._INT_TYPES:
+            return '%d' % val
+        return self._get_column_formats(colnum + 1)[colnum] % val
+
+    def _format_data_line(self, args):
         '''
-        Write a line of data.
+        Format a line of data, without newline.
         Args can be a single value or a 1d numpy.array / list / tuple.
         '''
 
         if hasattr(args, '__len__'):
-            if len(args) > 0:
-                line = self._format_data_value(args[0], 0)
-                for colnum in range(1, len(args)):
-                    line += '\t%s' % \
-                            self._format_data_value(args[colnum], colnum)
-            else:
-                line = ''
+            formats = self._get_column_formats(len(args))
+            vals = []
+            for colnum in range(len(args)):
+                val = args[colnum]
+                if type(val) in self._INT_TYPES:
+                    vals.append('%d' % val)
+                else:
+                    vals.append(formats[colnum] % val)
+            return '\t'.join(vals)
         else:
-            line = self._format_data_value(args, 0)
+            return self._format_data_value(args, 0)
 
-        line += '\n'
+    def _format_data_lines(self, args, npoints):
+        '''
+        Format multiple lines of data, including newlines.
+        For float or integer 2d numpy arrays a single format string is
+        built for the whole block, otherwise the lines are formatted one
+        by one.
+        '''
+
+        if isinstance(args, numpy.ndarray) and args.ndim == 2 and \
+                args.dtype.kind in ('f', 'i'):
+            ncols = args.shape[1]
+            if args.dtype.kind == 'i':
+                formats = ['%d'] * ncols
+            else:
+                formats = self._get_column_formats(ncols)
+            fmt = ('\t'.join(formats) + '\n') * npoints
+            return fmt % tuple(args.ravel().tolist())
+
+        lines = []
+        for i in range(npoints):
+            lines.append(self._format_data_line(args[i]) + '\n')
+        return ''.join(lines)
+
+    def _write_lines(self, text, nrows):
+        '''Write formatted data lines and flush if required.'''
 
         if self._file is None:
             logging.info('File not opened yet, doing now')
             self.create_file()
 
-        self._file.write(line)
-        self._file.flush()
+        if self._writer is not None:
+            self._writer.write(text, nrows)
+            return
+
+        self._file.write(text)
+        self._nrows_unflushed += nrows
+
+        if self._nrows_unflushed >= self._flush_rows or \
+                (time.time() - self._last_flush) * 1000 >= self._flush_interval:
+            self.flush()
+        elif self._flush_hid is None:
+            self._flush_hid = gobject.timeout_add(int(self._flush_interval),
+                    self._flush_timeout_cb)
+
+    def _write_data_line(self, args):
+        '''
+        Write a line of data.
+        Args can be a single value or a 1d numpy.array / list / tuple.
+        '''
+        self._write_lines(self._format_data_line(args) + '\n', 1)
+
+    def flush(self):
+        '''
+        Flush pending data to the file. In async_write mode this requests
+        a flush from the writer thread.
+        '''
+
+        if self._writer is not None:
+            self._writer.write('', flush=True)
+            return
+
+        if self._flush_hid is not None:
+            gobject.source_remove(self._flush_hid)
+            self._flush_hid = None
+
+        if self._file is not None and self._nrows_unflushed > 0:
+            self._file.flush()
+        self._nrows_unflushed = 0
+        self._last_flush = time.time()
+
+    def get_write_stats(self):
+        '''
+        Return statistics of the writer thread in async_write mode, see
+        _AsyncWriter.get_stats(). After close_file() the final statistics
+        are returned; None if no writer was used.
+        '''
+
+        if self._writer is None:
+            return self._write_stats
+        return self._writer.get_stats()
+
+    def _flush_timeout_cb(self):
+        self._flush_hid = None
+        self.flush()
+        return False
 
     def _get_block_columns(self):
         blockcols = []
@@ -697,29 +1022,34 @@ class Data(SharedGObject):
 
         return blockcols
 
-    def _write_data(self):
+    def _write_data(self, start=0):
         if not self._inmem:
             logging.warning('Unable to _write_data() without having it memory')
             return False
 
         blockcols = self._get_block_columns()
 
-        lastvals = None
-        for vals in self._data:
+        if start > 0:
+            lastvals = self._data[start - 1]
+        else:
+            lastvals = None
+        for vals in self._data[start:]:
             if type(vals) is numpy.ndarray and lastvals is not None:
                 for i in range(len(vals)):
                     if blockcols[i] and vals[i] != lastvals[i]:
-                        self._file.write('\n')
+                        self._write_lines('\n', 0)
 
             self._write_data_line(vals)
             lastvals = vals
 
-    def _write_binary(self):
+        self.flush()
+
+    def _write_binary(self, start=0):
         if not self._inmem:
             logging.warning('Unable to _write_binary() without having it memory')
             return False
 
-        self._data.tofile(self._file.get_file())
+        self._data[start:].tofile(self._file.get_file())
         return True
 
 ### High-level file writing
@@ -754,27 +1084,105 @@ class Data(SharedGObject):
             self._dir, self._filename = os.path.split(self._file.name)
             self._file.close()
             self._tempfile = True
+            self._set_tempfile_written()
         except Exception, e:
             logging.warning('Error creating temporary file: %s', e)
             self._dir = ''
             self._filename = ''
             self._tempfile = False
 
-    def rewrite_tempfile(self):
+    def rewrite_tempfile(self, start=0):
         '''
-        Rewrite the temporary file with the current data.
+        Rewrite the temporary file with the current data. If <start> is
+        larger than 0, only the rows from <start> onwards are appended.
         '''
 
         if not self._tempfile:
             logging.warning('Data object has no temporary file to rewrite')
             return
 
-        self._file.reopen()
+        if start > 0:
+            if self._temp_binary:
+                mode = 'ab'
+            else:
+                mode = 'a'
+            size0 = os.path.getsize(self._file.name)
+        else:
+            mode = None
+            size0 = 0
+
+        self._file.reopen(mode)
         if self._temp_binary:
-            self._write_binary()
+            self._write_binary(start)
         else:
-            self._write_data()
+            self._write_data(start)
         self._file.close()
+        self._set_tempfile_written()
+
+        nbytes = os.path.getsize(self._file.name) - size0
+        stats = self._temp_stats
+        stats['nupdates'] += 1
+        if start > 0:
+            stats['nappends'] += 1
+        else:
+            stats['nrewrites'] += 1
+        stats['last_bytes'] = nbytes
+        stats['total_bytes'] += nbytes
+
+    @staticmethod
+    def _get_rows_crc(rows):
+        '''Return a CRC of the contents of array <rows>.'''
+        return zlib.crc32(buffer(numpy.ascontiguousarray(rows)))
+
+    def _set_tempfile_written(self):
+        '''
+        Remember how many rows were written to the temporary file, their
+        format and a CRC of their contents.
+        '''
+
+        if isinstance(self._data, numpy.ndarray) and len(self._data) > 0:
+            self._temp_nrows = len(self._data)
+            self._temp_format = (self._data.shape[1:], self._data.dtype)
+            self._temp_crc = self._get_rows_crc(self._data)
+        else:
+            self._temp_nrows = 0
+            self._temp_format = None
+            self._temp_crc = None
+
+    def _get_tempfile_append_start(self):
+        '''
+        Return the number of rows in the temporary file that are still
+        equal to the current data, or 0 if the file should be rewritten.
+        The rows are compared using a CRC, so rows that were changed in
+        place are detected as well.
+        '''
+
+        new = self._data
+        nold = self._temp_nrows
+        if self._temp_crc is None or not isinstance(new, numpy.ndarray):
+            return 0
+
+        # In text mode the block separators depend on the first two rows
+        if not self._temp_binary and nold < 2:
+            return 0
+        if len(new) < nold or (new.shape[1:], new.dtype) != self._temp_format:
+            return 0
+        if self._get_rows_crc(new[:nold]) != self._temp_crc:
+            return 0
+
+        return nold
+
+    def get_tempfile_stats(self):
+        '''
+        Return a dictionary with statistics of temporary file updates:
+            nupdates: number of updates
+            nappends: number of updates that only appended new rows
+            nrewrites: number of updates that rewrote the file
+            last_bytes: number of bytes written in the last update
+            total_bytes: total number of bytes written in updates
+        '''
+
+        return dict(self._temp_stats)
 
     def copy_file(self, fn):
         '''
@@ -878,17 +1286,17 @@ class Data(SharedGObject):
         #   - a 1d tuple of numbers, for adding a single data point
         #   - a 2d tuple/list/array, for adding >1 data points
         if self._inmem:
-            if len(self._data) == 0:
-                self._data = numpy.atleast_2d(args)
-            else:
-                self._data = numpy.append(self._data, [args], axis=0)
+            rows = self._append_rows(args, npoints, ncols)
+        else:
+            rows = numpy.reshape(args, (npoints, ncols))
+        self._track_rows(rows)
 
         if self._infile:
             if npoints == 1:
                 self._write_data_line(args)
             elif npoints > 1:
-                for i in range(npoints):
-                    self._write_data_line(args[i])
+                self._write_lines(self._format_data_lines(args, npoints),
+                        npoints)
 
         self._npoints += npoints
         self._npoints_last_block += npoints
@@ -900,11 +1308,178 @@ class Data(SharedGObject):
         else:
             self.emit('new-data-point')
 
+    def _get_expected_npoints(self):
+        '''
+        Return the expected number of data points, either as specified
+        or as given by the sizes of the coordinate dimensions. Returns 0
+        if unknown.
+        '''
+
+        if self._npoints_expected > 0:
+            return self._npoints_expected
+
+        npoints = 1
+        for info in self.get_coordinates():
+            size = info.get('size', 0)
+            if size <= 0:
+                return 0
+            npoints *= size
+        return npoints
+
+    _MIN_BUFFER_SIZE = 128
+
+    def _get_mmap_path(self):
+        '''
+        Return path of the binary file for memory-mapped storage: <name>.bin
+        next to the data file, or a temporary file if there is none.
+        '''
+
+        if self._mmap_path is None:
+            if self._filename != '' and not self._tempfile:
+                self._mmap_path = os.path.splitext(self.get_filepath())[0] \
+                        + '.bin'
+            else:
+                self._mmap_temp = temp.File(mode='wb', binary=True)
+                self._mmap_temp.close()
+                self._mmap_path = self._mmap_temp.name
+        return self._mmap_path
+
+    def _map_file(self, nrows, ncols, mode='r+'):
+        '''
+        Map the binary data file as a (nrows, ncols) float array. For
+        writable maps the file is grown to fit; it is never shrunk here,
+        since earlier maps of the file may still be in use.
+        '''
+
+        path = self._get_mmap_path()
+        if mode != 'r':
+            nbytes = nrows * ncols * numpy.dtype(numpy.float64).itemsize
+            if os.path.getsize(path) < nbytes:
+                f = open(path, 'r+b')
+                f.truncate(nbytes)
+                f.close()
+        if nrows == 0:
+            return numpy.zeros((0, ncols))
+        return numpy.memmap(path, dtype=numpy.float64, mode=mode,
+                shape=(nrows, ncols))
+
+    _MMAP_META_ATTRS = (
+        ('comment_lines', '_comment_lines'),
+        ('block_sizes', '_block_sizes'),
+        ('npoints_last_block', '_npoints_last_block'),
+        ('npoints_max_block', '_npoints_max_block'),
+    )
+
+    def _get_mmap_meta_path(self):
+        return self._get_mmap_path() + '.json'
+
+    def _finish_mmap(self):
+        '''
+        Map the binary data file read-only. The file is not truncated,
+        since views of the writable map may still be in use; the number of
+        valid rows is stored in <name>.bin.json instead, together with the
+        block sizes and comments after the header, so that the data file
+        does not have to be scanned when it is loaded.
+        '''
+
+        nrows, ncols = self._data.shape
+        self._buffer.flush()
+        self._buffer = None
+        self._data = None
+        self._data = self._map_file(nrows, ncols, mode='r')
+
+        if self._mmap_temp is not None or \
+                not os.path.exists(self.get_filepath()):
+            return
+
+        path = self._get_mmap_path()
+        metapath = self._get_mmap_meta_path()
+        meta = {
+            'nrows': nrows,
+            'ncols': ncols,
+            'bin_size': os.path.getsize(path),
+        }
+        for key, attr in self._MMAP_META_ATTRS:
+            meta[key] = getattr(self, attr)
+        try:
+            if not datacache.save_meta(self.get_filepath(), metapath, meta):
+                logging.debug('Meta data of %s not suitable for storing',
+                        path)
+        except Exception, e:
+            logging.warning('Unable to write %s: %s', metapath, e)
+
+    def _grow_mmap(self, size, nfilled, ncols):
+        '''Resize the memory-mapped buffer, keeping the first nfilled rows.'''
+
+        path = self._get_mmap_path()
+        old = None
+        if self._buffer is not None:
+            self._buffer.flush()
+        elif nfilled == 0 or getattr(self._data, 'filename', None) != \
+                os.path.abspath(path):
+            # Copy data that is not mapped yet. The file is overwritten but
+            # not truncated, earlier maps of it may still be in use.
+            if nfilled > 0:
+                old = numpy.reshape(self._data, (nfilled, -1))
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+
+            # The meta data is written again when the file is finished
+            metapath = self._get_mmap_meta_path()
+            if os.path.exists(metapath):
+                os.remove(metapath)
+
+        self._buffer = None
+        self._data = None
+        self._buffer = self._map_file(size, ncols)
+        if old is not None:
+            self._buffer[:nfilled] = old
+        self._data = self._buffer[:nfilled]
+
+    def _append_rows(self, args, npoints, ncols):
+        '''
+        Append data points to the in-memory buffer. The buffer capacity is
+        doubled when it is full, so adding points takes amortized constant
+        time. self._data is updated to be a view of the filled rows.
+        '''
+
+        rows = numpy.reshape(args, (npoints, ncols))
+        if self._mmap:
+            rows = rows.astype(numpy.float64)
+        nfilled = len(self._data)
+        nneeded = nfilled + npoints
+
+        if self._buffer is None or nneeded > len(self._buffer) or \
+                not numpy.can_cast(rows.dtype, self._buffer.dtype):
+            size = max(self._MIN_BUFFER_SIZE, self._get_expected_npoints())
+            while size < nneeded:
+                size *= 2
+
+            if self._mmap:
+                self._grow_mmap(size, nfilled, ncols)
+                old = None
+            elif nfilled > 0:
+                old = numpy.reshape(self._data, (nfilled, -1))
+                dtype = numpy.result_type(old, rows)
+            else:
+                old = None
+                dtype = rows.dtype
+
+            if not self._mmap:
+                self._buffer = numpy.empty((size, ncols), dtype=dtype)
+            if old is not None:
+                self._buffer[:nfilled] = old
+
+        self._buffer[nfilled:nneeded] = rows
+        self._data = self._buffer[:nneeded]
+        return rows
+
     def new_block(self):
         '''Start a new data block.'''
 
         if self._infile:
-            self._file.write('\n')
+            self._write_lines('\n', 0)
+            self.flush()
 
         self._block_sizes.append(self._npoints_last_block)
         self._npoints_last_block = 0
@@ -942,6 +1517,7 @@ class Data(SharedGObject):
         if not isinstance(data, numpy.ndarray):
             data = numpy.array(data)
         self._data = data
+        self._buffer = None
         self._inmem = True
         self._infile = False
         self._npoints = len(self._data)
@@ -986,10 +1562,15 @@ class Data(SharedGObject):
         Update this Data object with a new data set.
         No checks are performed on dimensions etc.
         If the data is associated with a temporary file, it will be updated.
+        If the new data extends the rows written before, only the new rows
+        are appended to it.
         '''
         self._data = data
+        self._buffer = None
+        self._shape_nrows = None
+        self._reshaped_data = None
         if self._tempfile:
-            self.rewrite_tempfile()
+            self.rewrite_tempfile(self._get_tempfile_append_start())
 
 ### File reading
 
@@ -1005,31 +1586,27 @@ class Data(SharedGObject):
             self._nvalues = 1
             self._ncoordinates -= 1
 
-    def _load_file(self):
-        """
-        Load data from file and store internally.
-        """
-
-        try:
-            f = file(self.get_filepath(), 'r')
-        except:
-            logging.warning('Unable to open file %s' % self.get_filepath())
-            return False
-
+    def _reset_file_info(self):
         self._dimensions = []
         self._values = []
         self._comment = []
-        data = []
-        nfields = 0
 
         self._block_sizes = []
         self._npoints = 0
         self._npoints_last_block = 0
         self._npoints_max_block = 0
 
+    def _parse_lines(self, lines):
+        '''
+        Parse data file line by line. Returns a tuple (data, nfields,
+        size of last block).
+        '''
+
+        data = []
+        nfields = 0
         blocksize = 0
 
-        for line in f:
+        for line in lines:
             line = line.rstrip(' \n\t\r')
 
             # Count blocks
@@ -1054,10 +1631,222 @@ class Data(SharedGObject):
                 data.append(fields)
                 blocksize += 1
 
+        return numpy.array(data), nfields, blocksize
+
+    _COMMENT_RE = re.compile('#.*')
+
+    def _parse_contents(self, text):
+        '''
+        Parse the contents of a data file in two steps: first the line
+        boundaries, comment lines and fields are located, after which all
+        numbers are converted in one go.
+
+        Returns a tuple (data, nfields, size of last block), or None if the
+        data is not a regular table of numbers. In that case the meta data
+        should be reset before parsing again with _parse_lines().
+        '''
+
+        if len(text) == 0:
+            return numpy.array([]), 0, 0
+
+        # Line boundaries; a trailing newline does not start a new line
+        orig = numpy.frombuffer(text, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(orig == ord('\n'))
+        if text[-1] != '\n':
+            ends = numpy.append(ends, len(text))
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+
+        # Meta data, and blank out comments keeping line offsets the same
+        hashpos = numpy.flatnonzero(orig == ord('#'))
+        commentlines = numpy.unique(numpy.searchsorted(ends, hashpos))
+        for i in commentlines:
+            self._parse_meta_data(text[starts[i]:ends[i]].rstrip(' \t\r'))
+        if len(commentlines) > 0:
+            text = self._COMMENT_RE.sub(lambda m: ' ' * len(m.group(0)), text)
+            buf = numpy.frombuffer(text, dtype=numpy.uint8)
+        else:
+            buf = orig
+
+        # Number of fields per line; a field starts with a non-whitespace
+        # character following whitespace
+        notspace = buf > 32
+        fieldstart = notspace.copy()
+        fieldstart[1:] &= ~notspace[:-1]
+        fieldpos = numpy.flatnonzero(fieldstart)
+        linefields = numpy.diff(numpy.concatenate(([0],
+                numpy.searchsorted(fieldpos, ends))))
+
+        isdata = linefields > 0
+        isblank = ~isdata
+        isblank[commentlines] = False
+
+        ndata = numpy.cumsum(isdata)
+        ntotal = int(ndata[-1])
+        if ntotal == 0:
+            return numpy.array([]), 0, 0
+
+        nfields = int(linefields.max())
+        if (linefields[isdata] != nfields).any():
+            return None
+
+        data = numpy.fromstring(text, sep=' ')
+        if len(data) != ntotal * nfields:
+            return None
+
+        # Block sizes, a blank line ends a block once data was seen
+        blockends = ndata[isblank]
+        blockends = blockends[blockends > 0]
+        sizes = numpy.diff(numpy.concatenate(([0], blockends)))
+        self._block_sizes = [int(i) for i in sizes]
+        if len(sizes) > 0:
+            self._npoints_max_block = int(sizes.max())
+            lastblock = ntotal - int(blockends[-1])
+        else:
+            lastblock = ntotal
+
+        return data.reshape((ntotal, nfields)), nfields, lastblock
+
+    _CACHE_ATTRS = (
+        ('dimensions', '_dimensions'),
+        ('comment', '_comment'),
+        ('block_sizes', '_block_sizes'),
+        ('npoints_last_block', '_npoints_last_block'),
+        ('npoints_max_block', '_npoints_max_block'),
+        ('ncoordinates', '_ncoordinates'),
+        ('nvalues', '_nvalues'),
+        ('loopdims', '_loopdims'),
+        ('loopshape', '_loopshape'),
+        ('complete', '_complete'),
+    )
+
+    def _load_cache(self):
+        '''
+        Load data and meta data from the cache, if a valid entry exists.
+        The data will be a copy-on-write memory-mapped array, so changes
+        to it are not written to the cache.
+        '''
+
+        ret = datacache.load(self.get_filepath(), self._cache_mode)
+        if ret is None:
+            return False
+
+        data, meta = ret
+        for key, attr in self._CACHE_ATTRS:
+            setattr(self, attr, meta[key])
+        self._data = data
+        self._buffer = None
+        self._npoints = len(data)
+        self._inmem = True
+        self._shape_nrows = None
+        return True
+
+    def _save_cache(self):
+        meta = {}
+        for key, attr in self._CACHE_ATTRS:
+            meta[key] = getattr(self, attr)
+        datacache.save(self.get_filepath(), self._data, meta,
+                self._cache_mode)
+
+    def _load_mmap_file(self):
+        '''
+        Map the binary data file belonging to the data file. The number of
+        rows, the block sizes and the comments added while writing are
+        taken from <name>.bin.json, which is only used if it matches the
+        data file; of the data file only the header is read.
+        '''
+
+        path = self._get_mmap_path()
+        metapath = self._get_mmap_meta_path()
+        try:
+            meta = datacache.load_meta(self.get_filepath(), metapath)
+        except Exception, e:
+            logging.warning('Unable to read %s: %s', metapath, e)
+            return False
+        if meta is None:
+            logging.info('No valid meta data for binary data file %s, '
+                    'loading text file', path)
+            return False
+        if not os.path.exists(path) or \
+                os.path.getsize(path) != meta['bin_size']:
+            logging.warning('Binary data file %s changed, loading text file',
+                    path)
+            return False
+
+        try:
+            f = file(self.get_filepath(), 'r')
+        except:
+            logging.warning('Unable to open file %s' % self.get_filepath())
+            return False
+
+        self._reset_file_info()
+        for line in f:
+            line = line.rstrip(' \n\t\r')
+            if len(line) == 0:
+                continue
+            if not line.lstrip().startswith('#'):
+                break
+            self._parse_meta_data(line)
+        f.close()
+
+        for key, attr in self._MMAP_META_ATTRS:
+            setattr(self, attr, meta[key])
+        for line in self._comment_lines:
+            self._parse_meta_data(line)
+
+        ncols = len(self._dimensions)
+        if ncols != meta['ncols']:
+            logging.warning('Binary data file %s does not match %s: %d '
+                    'columns instead of %d, loading text file', path,
+                    self.get_filepath(), meta['ncols'], ncols)
+            return False
+
+        nrows = meta['nrows']
+        self._count_coord_val_dims()
+        self._data = self._map_file(nrows, ncols, mode='r')
+        self._buffer = None
+        self._npoints = nrows
+        self._inmem = True
+
+        try:
+            self._detect_dimensions_size()
+        except Exception, e:
+            logging.warning('Error while detecting dimension size')
+
+        return True
+
+    def _load_file(self):
+        """
+        Load data from file and store internally.
+        """
+
+        if self._mmap and self._load_mmap_file():
+            return True
+
+        if self._cache_mode and self._load_cache():
+            return True
+
+        try:
+            f = file(self.get_filepath(), 'r')
+        except:
+            logging.warning('Unable to open file %s' % self.get_filepath())
+            return False
+
+        text = f.read()
+        f.close()
+
+        self._reset_file_info()
+        ret = self._parse_contents(text)
+        if ret is None:
+            logging.info('Irregular data file, parsing line by line')
+            self._reset_file_info()
+            ret = self._parse_lines(text.splitlines())
+        data, nfields, blocksize = ret
+
         self._add_missing_dimensions(nfields)
         self._count_coord_val_dims()
 
-        self._data = numpy.array(data)
+        self._data = data
+        self._buffer = None
         self._npoints = len(self._data)
         self._inmem = True
 
@@ -1068,6 +1857,9 @@ class Data(SharedGObject):
         except Exception, e:
             logging.warning('Error while detecting dimension size')
 
+        if self._cache_mode:
+            self._save_cache()
+
         return True
 
     def _type_added(self, name):
@@ -1113,22 +1905,15 @@ class Data(SharedGObject):
         if m is not None:
             self._comment.append(m.group(1))
 
-    def _reshape_data(self):
+    def _reshape_rows(self, data, loopdims, newshape):
         '''
-        Return a reshaped version of the data. This is not guaranteed to be
-        a view to the same data object.
+        Reshape data into the loop dimensions <loopdims> with sizes
+        <newshape>. Returns None if this is not possible.
         '''
 
-        if self._reshaped_data is not None:
-            return self._reshaped_data
-
-        loopdims = copy.copy(self._loopdims)
-        newshape = copy.copy(self._loopshape)
-        if not self._complete or None in (loopdims, newshape):
+        if loopdims is None or newshape is None or len(loopdims) == 0:
             return None
 
-        data = self._data
-
         cshape_ok, fshape_ok = True, True
         for i in range(len(loopdims)):
             if loopdims[i] != i:
@@ -1138,25 +1923,251 @@ class Data(SharedGObject):
 
         if not cshape_ok and not fshape_ok:
             logging.warning('Unable to do simple data reshape')
-        else:
-            newshape.reverse()
-            newshape.append(-1)
-            data = data.reshape(newshape)
+            return data
+
+        newshape = list(newshape)
+        newshape.reverse()
+        newshape.append(-1)
+        data = data.reshape(newshape)
+
+        # Swap axes if necessary
+        if fshape_ok:
+            for i in range(len(loopdims) - 1):
+                data = data.swapaxes(i, i + 1)
+
+        return data
 
-            # Swap axes if necessary
-            if fshape_ok:
-                for i in range(self.get_ncoordinates() - 1):
-                    data = data.swapaxes(i, i + 1)
+    def _reshape_data(self, completed=False):
+        '''
+        Return a reshaped version of the data. This is not guaranteed to be
+        a view to the same data object.
+
+        If the data set is not complete and <completed> is True, the data of
+        the completed iterations of the outer loop is returned.
+        '''
 
-        self._reshaped_data = data
+        if self._reshaped_data is not None:
+            return self._reshaped_data
+
+        if not self._complete:
+            if not completed:
+                return None
+            nrows, newshape = self._get_completed_shape()
+            if nrows == 0:
+                return None
+            return self._reshape_rows(self._data[:nrows], self._loopdims,
+                    newshape)
+
+        self._reshaped_data = self._reshape_rows(self._data, self._loopdims,
+                self._loopshape)
         return self._reshaped_data
 
+### Shape tracking
+
+    def _reset_shape_tracker(self):
+        '''
+        Reset the incremental detection of loop dimensions. The shape info
+        is updated by _track_rows() when adding data points, looking only
+        at rows that are a multiple of the size of the inner loops.
+        '''
+
+        self._shape_first = None
+        self._shape_last = None
+        self._shape_nrows = 0
+        self._shape_mulsize = 1
+        self._shape_open = None
+        self._shape_next = 0
+        self._shape_done = False
+
+    def _track_rows(self, rows):
+        '''
+        Update loop dimensions, sizes and completeness for newly added
+        rows. This takes constant time per data point.
+        '''
+
+        if self._shape_nrows != self._npoints:
+            self._sync_shape_tracker()
+
+        self._reshaped_data = None
+        n0 = self._shape_nrows
+        n1 = n0 + len(rows)
+        self._shape_nrows = n1
+        if len(rows) == 0 or self._shape_done:
+            self._update_tracked_shape()
+            return
+
+        ncoords = self.get_ncoordinates()
+        if n0 == 0:
+            self._shape_first = numpy.array(rows[0, :ncoords])
+            self._loopdims = []
+            self._loopshape = []
+        first = self._shape_first
+
+        while not self._shape_done:
+            mulsize = self._shape_mulsize
+
+            # Find the next loop dimension from the first row of the
+            # second iteration of the inner loops.
+            if self._shape_open is None:
+                if mulsize >= n1:
+                    break
+                row = rows[mulsize - n0]
+                for colnum in range(ncoords):
+                    if row[colnum] != first[colnum]:
+                        self._shape_open = colnum
+                        break
+
+                if self._shape_open is None:
+                    self._shape_done = True
+                    break
+
+                self._loopdims.append(self._shape_open)
+                self._loopshape.append(2)
+                self._set_detected_info(self._shape_open, 'start',
+                        first[self._shape_open])
+                self._shape_last = row[self._shape_open]
+                self._shape_next = 2 * mulsize
+                continue
+
+            # Look for the start value of the current loop dimension
+            i = self._shape_next
+            if i >= n1:
+                break
+            col = self._shape_open
+            chunk = rows[i - n0::mulsize, col]
+            idx = numpy.flatnonzero(chunk == first[col])
+            if len(idx) == 0:
+                self._shape_next = i + len(chunk) * mulsize
+                self._shape_last = chunk[-1]
+                break
+
+            if idx[0] > 0:
+                self._shape_last = chunk[idx[0] - 1]
+            end = i + int(idx[0]) * mulsize
+            size = end / mulsize
+            self._set_detected_info(col, 'size', size)
+            self._set_detected_info(col, 'end', self._shape_last)
+            self._loopshape[-1] = size
+            self._shape_mulsize = end
+            self._shape_open = None
+            if len(self._loopdims) == ncoords:
+                self._shape_done = True
+
+        self._update_tracked_shape()
+
+    def _set_detected_info(self, colnum, key, val):
+        '''
+        Store a detected start, size or end value for a coordinate, unless
+        it was specified by the user (a size of 0 means unspecified).
+        '''
+
+        opt = self._dimensions[colnum]
+        if key == 'size':
+            if opt.get('size', 0) == 0:
+                opt['size'] = val
+        elif key not in opt:
+            opt[key] = val
+
+    def _update_tracked_shape(self):
+        n = self._shape_nrows
+        mulsize = self._shape_mulsize
+        if self._shape_open is not None:
+            size = (n - 1) / mulsize + 1
+            self._loopshape[-1] = size
+            mulsize *= size
+        if self._loopdims:
+            self._complete = (n == mulsize)
+
+    def _sync_shape_tracker(self):
+        '''
+        Initialize the shape tracker from the data that is already present.
+        '''
+
+        self._reset_shape_tracker()
+        if self._npoints == 0:
+            return
+
+        if self._inmem and self._data is not None:
+            try:
+                self._detect_dimensions_size()
+                return
+            except Exception, e:
+                logging.warning('Error while detecting dimension size')
+
+        # Data not available, stop tracking
+        self._shape_nrows = self._npoints
+        self._shape_done = True
+
+    def _get_completed_shape(self):
+        '''
+        Return the number of rows and the shape of the data belonging to
+        completed iterations of the outer loop.
+        '''
+
+        if self._shape_nrows != self._npoints:
+            self._sync_shape_tracker()
+        if not self._loopdims:
+            return 0, None
+
+        n = self._shape_nrows
+        mulsize = self._shape_mulsize
+        if self._shape_open is None:
+            if n < mulsize:
+                return 0, None
+            return mulsize, list(self._loopshape)
+
+        nsteps = n / mulsize
+        newshape = list(self._loopshape)
+        newshape[-1] = nsteps
+        return nsteps * mulsize, newshape
+
+    def get_loop_shape(self):
+        '''
+        Return the detected loop dimensions and their sizes, ordered from
+        the inner to the outer loop. For the outer loop the size will be
+        the number of (started) iterations if the data set is not complete.
+
+        Output:
+            (loopdims, loopshape, complete)
+        '''
+
+        if self._shape_nrows != self._npoints:
+            self._sync_shape_tracker()
+        return copy.copy(self._loopdims), copy.copy(self._loopshape), \
+                self._complete
+
+    _CHUNK_SIZE = 1 << 20
+
+    def _find_loop_size(self, data, col, loopstart, mulsize):
+        '''
+        Return the first step i > 0 for which data[i * mulsize, col] equals
+        loopstart, or the number of steps if it does not occur. The data is
+        scanned in chunks to avoid loading it completely.
+        '''
+
+        nsteps = (len(data) - 1) / mulsize + 1
+        i = 1
+        while i < nsteps:
+            end = min(i + self._CHUNK_SIZE, nsteps)
+            chunk = data[i * mulsize:end * mulsize:mulsize, col]
+            idx = numpy.flatnonzero(chunk == loopstart)
+            if len(idx) > 0:
+                return i + int(idx[0])
+            i = end
+        return nsteps
+
     def _detect_dimensions_size(self):
         data = self._data
         ncoords = self.get_ncoordinates()
+        self._reset_shape_tracker()
+        self._shape_nrows = len(data)
+        if len(data) > 0:
+            self._shape_first = numpy.array(data[0, :ncoords])
         if len(data) < 2:
             for colnum in range(ncoords):
                 self._dimensions[colnum]['size'] = len(data)
+            self._loopdims = []
+            self._loopshape = []
             return
 
         loopdims = []
@@ -1176,16 +2187,13 @@ class Data(SharedGObject):
                     break
 
             if loopdim is None:
+                self._shape_done = (mulsize < len(data))
                 break
 
             if firstloopdim is None:
                 firstloopdim = loopdim
 
-            i = 1
-            while i * mulsize < len(data):
-                if data[i * mulsize, loopdim] == loopstart:
-                    break
-                i += 1
+            i = self._find_loop_size(data, loopdim, loopstart, mulsize)
 
             opt = self._dimensions[loopdim]
             opt['start'] = loopstart
@@ -1193,7 +2201,20 @@ class Data(SharedGObject):
             opt['end'] = data[mulsize * (i - 1), loopdim]
             newshape.append(i)
 
+            # Continue incremental tracking where the scan ended
+            nsteps = (len(data) - 1) / mulsize + 1
+            if i == nsteps:
+                self._shape_mulsize = mulsize
+                self._shape_open = loopdim
+                self._shape_next = nsteps * mulsize
+                self._shape_last = opt['end']
+                mulsize *= i
+                break
+
             mulsize *= i
+            self._shape_mulsize = mulsize
+            if len(loopdims) == ncoords:
+                self._shape_done = True
 
         complete = len(self._data) == mulsize
         self._loopdims = loopdims
@@ -1201,6 +2222,8 @@ class Data(SharedGObject):
         self._complete = complete
 
         # Determine number of blocks
+        if firstloopdim is None:
+            return complete
         bs = self._dimensions[firstloopdim]['size']
         if bs > 0:
             if len(data) % bs == 0:
@@ -1255,5 +2278,45 @@ class Data(SharedGObject):
 
 def slice(data, coords, vals):
     """
-    Return new data object with a slice of the given data set
+    Return new data object with a slice of the given data set, containing
+    the coordinate dimensions <coords> and value dimensions <vals> (lists of
+    column numbers).
+
+    The data is copied in chunks; if the source uses memory-mapped storage
+    the new data object will as well.
     """
+
+    src = data.get_data()
+    ret = Data(name='%s_slice' % data.get_name(), infile=False,
+            inmem=True, mmap=data._mmap)
+
+    dims = data.get_dimensions()
+    for colnum in coords:
+        info = dict(dims[colnum])
+        name = info.pop('name', 'col%d' % (colnum + 1))
+        info.pop('type', None)
+        ret.add_coordinate(name, **info)
+    for colnum in vals:
+        info = dict(dims[colnum])
+        name = info.pop('name', 'col%d' % (colnum + 1))
+        info.pop('type', None)
+        ret.add_value(name, **info)
+
+    cols = list(coords) + list(vals)
+    ret.reserve(len(src))
+    for start in range(0, len(src), Data._CHUNK_SIZE):
+        ret._append_rows(src[start:start + Data._CHUNK_SIZE, cols],
+                min(Data._CHUNK_SIZE, len(src) - start), len(cols))
+    ret._npoints = len(src)
+    ret._block_sizes = list(data._block_sizes)
+    ret._npoints_last_block = data._npoints_last_block
+    ret._npoints_max_block = data._npoints_max_block
+    if ret._mmap and ret._buffer is not None:
+        ret._finish_mmap()
+
+    try:
+        ret._detect_dimensions_size()
+    except Exception, e:
+        logging.warning('Error while detecting dimension size')
+
+    return ret
@@ -25,6 +25,15 @@ Contains:
   object, adapted for usage with qtlab
 - name generators in the style of qtlab Data objects
 - functions to create standard data sets
+
+Data sets can be streamed to the file: dimensions that are created without
+data are chunked and resizable along the first axis, and rows can be
+appended with DataGroup.append_rows() or, like for a Data object, with
+DataGroup.add_data_point().
+
+Files created with swmr=True can be read while they are being written, using
+HDF5 single-writer / multiple-reader mode. After creating all data sets, call
+HDF5Data.start_swmr(); readers can then follow the data with StreamReader.
 """
 
 import gobject
@@ -59,8 +68,14 @@ class DataGroup(SharedGObject):
     At the moment this does not have too many improvements over using just the
     bare container, but the concept should be useful for plotting, ensuring
     correct dimensionalities, etc.
+
+    Dimensions added without data can be filled row by row using
+    add_data_point() and new_block(), in the same way as a Data object.
     """
 
+    # Maximum size of a chunk of a streamed data set
+    _MAX_CHUNK_BYTES = 1 << 20
+
     def __init__(self, name, hdf5_data, base='/', **kw):
         self.name = name
         self.h5d = hdf5_data._file
@@ -68,9 +83,10 @@ class DataGroup(SharedGObject):
         self.groupname = base + name
         self._filepath = hdf5_data.get_filepath()
         self._folder = hdf5_data.get_folder()
+        self._hdf5_data = hdf5_data
 
         if self.name in self.h5d[base].keys():
-            self.group = self.h5d[base]
+            self.group = self.h5d[self.groupname]
         else:
             self.group = self.h5d.create_group(self.groupname)
 
@@ -78,17 +94,49 @@ class DataGroup(SharedGObject):
         for k in kw:
             self.group.attrs[k] = kw[k]
 
+        # Streaming state, rows added with add_data_point() are buffered.
+        # They are written from row 0 of each column, so that they replace
+        # rows that were preallocated, e.g. by loop1d_data().
+        self._columns = []
+        self._write_pos = {}
+        self._pending = []
+        self._npending = 0
+        self._npoints = 0
+        self._npoints_last_block = 0
+        self._block_sizes = []
+        self._last_flush = time.time()
+        self._flush_hid = None
+
+        hdf5_data._add_group(self)
+
     def __getitem__(self, name):
+        self._write_pending()
         return self.group[name].value
 
     def __setitem__(self, name, val):
         if name in self.group.keys():
+            self._write_pending()
+            dset = self.group[name]
+            val = np.asarray(val)
+
+            # write in place if possible, resizing streamed data sets
+            if val.shape == dset.shape and val.dtype == dset.dtype:
+                dset[...] = val
+                return True
+            elif dset.maxshape[0] is None and val.ndim == dset.ndim and \
+                    val.shape[1:] == dset.shape[1:] and \
+                    np.can_cast(val.dtype, dset.dtype):
+                dset.resize(val.shape[0], axis=0)
+                dset[...] = val
+                return True
 
             # store old attributes
             attrs = dict(self.group[name].attrs)
 
             # delete and re-create; overwrite doesn't work with hdf5
             del self.group[name]
+            if name in self._columns:
+                self._columns.remove(name)
             dim = self.group.create_dataset(name, data=val)
             for k, v in attrs.iteritems():
                 dim.attrs[k] = v
@@ -121,7 +169,7 @@ class DataGroup(SharedGObject):
             return False
 
         if data is None:
-            data = np.array([np.NaN])
+            return self.add_stream_dimension(name, dim_type, **meta)
 
         dim = self.group.create_dataset(name, data=data)
         dim.attrs['dim_type'] = dim_type
@@ -131,6 +179,47 @@ class DataGroup(SharedGObject):
 
         return True
 
+    def add_stream_dimension(self, name, dim_type, shape=(),
+            dtype=np.float64, **meta):
+        '''
+        Add an initially empty dimension that can grow along the first
+        axis. Each row has shape <shape>.
+
+        The keywords chunk_rows, compression and compression_opts override
+        the storage options of the HDF5Data object; other extra keywords are
+        added as meta data.
+        '''
+
+        if name in self.group.keys():
+            logging.error("Dimension '%s' already exists in data set '%s'" \
+                    % (name, self.name))
+            return False
+
+        opts = self._hdf5_data.get_stream_options()
+        for k in opts.keys():
+            if k in meta:
+                opts[k] = meta.pop(k)
+
+        shape = tuple(shape)
+        rowbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        chunk_rows = max(1, min(opts['chunk_rows'],
+            self._MAX_CHUNK_BYTES / max(rowbytes, 1)))
+
+        dim = self.group.create_dataset(name, shape=(0, ) + shape,
+                maxshape=(None, ) + shape, chunks=(chunk_rows, ) + shape,
+                dtype=dtype, compression=opts['compression'],
+                compression_opts=opts['compression_opts'])
+        dim.attrs['dim_type'] = dim_type
+
+        for k in meta:
+            dim.attrs[k] = meta[k]
+
+        # Only data sets with scalar rows can be filled by add_data_point()
+        if shape == ():
+            self._columns.append(name)
+            self._write_pos[name] = 0
+        return True
+
     def add(self, name, data=None, **meta):
         '''
         Add an unspecified dimension, optionally with known data.
@@ -152,6 +241,202 @@ class DataGroup(SharedGObject):
         '''
         return self.add_dimension(name, 'value', data, **meta)
 
+    def append_rows(self, name, val):
+        '''
+        Append rows to a resizable data set. <val> can be a single row or
+        an array of rows. Returns the new number of rows.
+        '''
+
+        self._write_pending()
+        dset = self.group[name]
+        val = np.asarray(val)
+        if val.ndim == dset.ndim - 1:
+            val = val[np.newaxis]
+
+        n = dset.shape[0]
+        dset.resize(n + len(val), axis=0)
+        dset[n:] = val
+        self._check_flush()
+        return n + len(val)
+
+    def write_slice(self, name, start, val):
+        '''
+        Write rows <val> to data set <name>, starting at row <start>.
+        Resizable data sets are extended if required.
+        '''
+
+        self._write_pending()
+        dset = self.group[name]
+        val = np.asarray(val)
+        if val.ndim == dset.ndim - 1:
+            val = val[np.newaxis]
+
+        end = start + len(val)
+        if end > dset.shape[0]:
+            if dset.maxshape[0] is not None and end > dset.maxshape[0]:
+                logging.error("Slice %d:%d does not fit in data set '%s'" \
+                        % (start, end, name))
+                return False
+            dset.resize(end, axis=0)
+
+        dset[start:end] = val
+        self._check_flush()
+        return True
+
+    def add_data_point(self, *args, **kwargs):
+        '''
+        Add new data point(s) to the streamed dimensions with scalar rows
+        of this group, in the order in which they were added. Dimensions
+        created with data, like the coordinates of loop1d_data() and
+        loop2d_data(), are not included. The points are written from the
+        first row on, replacing rows that were preallocated, e.g. by
+        loop1d_data(). Like Data.add_data_point(), this accepts N numbers,
+        a single MxN 2d array or N 1d arrays of length M.
+
+        Input:
+            *args:
+                n column values or a 2d array
+            **kwargs:
+                newblock (boolean): marks a new 'block' starts after this point
+
+        Output:
+            None
+        '''
+
+        if len(args) == 0:
+            logging.warning('add_data_point(): no data specified')
+            return
+
+        if len(args) == 1 and np.ndim(args[0]) == 2:
+            rows = np.asarray(args[0])
+        else:
+            try:
+                rows = np.column_stack([np.atleast_1d(a) for a in args])
+            except ValueError:
+                logging.warning('add_data_point(): not all provided data arguments have same shape')
+                return
+
+        if len(self._columns) == 0:
+            logging.warning('add_data_point(): group %s has no streamed ' \
+                    'dimensions with scalar rows' % self.name)
+            return
+
+        if rows.shape[1] != len(self._columns):
+            logging.warning('add_data_point(): got %d columns, expected %d' \
+                    % (rows.shape[1], len(self._columns)))
+            return
+
+        self._pending.append(rows)
+        self._npending += len(rows)
+        self._npoints += len(rows)
+        self._npoints_last_block += len(rows)
+
+        if kwargs.get('newblock', False):
+            self.new_block()
+        else:
+            self._check_flush()
+
+    def new_block(self):
+        '''
+        Start a new data block. The block sizes are stored in the
+        'block_sizes' attribute of the group.
+        '''
+
+        self._block_sizes.append(self._npoints_last_block)
+        self._npoints_last_block = 0
+        self._write_block_sizes()
+        self.flush()
+
+    def _write_block_sizes(self):
+        '''
+        Store the block sizes. Attributes can not be changed in SWMR mode,
+        in that case they are appended to the 'block_sizes' data set.
+        '''
+
+        if 'block_sizes' in self.group.keys():
+            dset = self.group['block_sizes']
+            n = dset.shape[0]
+            dset.resize(len(self._block_sizes), axis=0)
+            dset[n:] = self._block_sizes[n:]
+        else:
+            self.group.attrs['block_sizes'] = np.array(self._block_sizes)
+
+    def _prepare_swmr(self):
+        '''
+        Create data sets that are needed for streaming in SWMR mode, when
+        no new objects can be created anymore.
+        '''
+
+        if len(self._columns) == 0 or 'block_sizes' in self.group.keys():
+            return
+
+        self.group.create_dataset('block_sizes', data=self._block_sizes,
+                dtype=np.int64, maxshape=(None, ), chunks=(256, ))
+        self.group['block_sizes'].attrs['dim_type'] = 'block_sizes'
+        if 'block_sizes' in self.group.attrs:
+            del self.group.attrs['block_sizes']
+
+    def get_npoints(self):
+        '''Return number of data points added with add_data_point().'''
+        return self._npoints
+
+    def get_nblocks(self):
+        '''Return number of blocks.'''
+        if self._npoints_last_block > 0:
+            return len(self._block_sizes) + 1
+        return len(self._block_sizes)
+
+    def _write_pending(self):
+        '''Write rows buffered by add_data_point() to the data sets.'''
+
+        if self._npending == 0:
+            return
+
+        rows = np.concatenate(self._pending)
+        self._pending = []
+        self._npending = 0
+        for i, name in enumerate(self._columns):
+            dset = self.group[name]
+            n = self._write_pos[name]
+            end = n + len(rows)
+            if dset.shape[0] < end:
+                dset.resize(end, axis=0)
+            dset[n:end] = rows[:, i]
+            self._write_pos[name] = end
+
+    def _check_flush(self):
+        opts = self._hdf5_data.get_stream_options()
+        if self._npending >= opts['flush_rows'] or \
+                (time.time() - self._last_flush) * 1000 >= \
+                opts['flush_interval']:
+            self.flush()
+        elif self._flush_hid is None:
+            self._flush_hid = gobject.timeout_add(int(opts['flush_interval']),
+                    self._flush_timeout_cb)
+
+    def _flush_timeout_cb(self):
+        self._flush_hid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        '''Write buffered rows and flush the file.'''
+
+        if self._flush_hid is not None:
+            gobject.source_remove(self._flush_hid)
+            self._flush_hid = None
+
+        self._write_pending()
+        self.h5d.flush()
+        self._last_flush = time.time()
+
+    def close_file(self):
+        '''
+        Write buffered rows, for compatibility with Data objects. The HDF5
+        file itself is closed by HDF5Data.close().
+        '''
+        self.flush()
+
     def loop1d_data(self, *args, **kwargs):
         kwargs['group'] = self
         return loop1d_data(*args, **kwargs)
@@ -172,6 +457,18 @@ class HDF5Data:
 
         kwargs:
             name (string) : default is 'data'
+            filepath (string) : file to use instead of a generated name
+            chunk_rows (int) : number of rows per chunk of streamed data
+                sets, default from config 'hdf5_chunk_rows' or 1024
+            compression (string) : compression filter of streamed data sets
+                ('gzip', 'lzf'), default from config 'hdf5_compression'
+            compression_opts : options for the compression filter
+            flush_rows (int) : number of buffered rows after which streamed
+                data is written, default from config 'data_flush_rows'
+            flush_interval (int) : maximum time (ms) before streamed data is
+                written, default from config 'data_flush_interval'
+            swmr (bool) : create the file so that it can be read while
+                writing, see start_swmr(). Default is False.
         """
 
         # FIXME: the name generation here is a bit nasty
@@ -179,7 +476,21 @@ class HDF5Data:
         name = data.Data._data_list.new_item_name(self, name)
         self._name = name
 
-        filepath = kwargs.get('filepath, None')
+        self._stream_options = {
+            'chunk_rows': kwargs.get('chunk_rows',
+                config.get('hdf5_chunk_rows', 1024)),
+            'compression': kwargs.get('compression',
+                config.get('hdf5_compression', None)),
+            'compression_opts': kwargs.get('compression_opts', None),
+            'flush_rows': kwargs.get('flush_rows',
+                config.get('data_flush_rows', 1000)),
+            'flush_interval': kwargs.get('flush_interval',
+                config.get('data_flush_interval', 200)),
+        }
+        self._groups = []
+        self._swmr = kwargs.get('swmr', False)
+
+        filepath = kwargs.get('filepath', None)
         if filepath:
             self._filepath = filepath
 
@@ -193,7 +504,10 @@ class HDF5Data:
         self._folder, self._filename = os.path.split(self._filepath)
         if not os.path.isdir(self._folder):
             os.makedirs(self._folder)
-        self._file = h5py.File(self._filepath, 'a')
+        if self._swmr:
+            self._file = h5py.File(self._filepath, 'a', libver='latest')
+        else:
+            self._file = h5py.File(self._filepath, 'a')
         self.flush()
 
     def __getitem__(self, name):
@@ -223,10 +537,166 @@ class HDF5Data:
         '''Create a DataGroup object.'''
         return DataGroup(name, self, **kwargs)
 
+    def _add_group(self, group):
+        self._groups.append(group)
+
+    def get_stream_options(self):
+        '''Return the storage and flush options for streamed data sets.'''
+        return dict(self._stream_options)
+
+    def start_swmr(self):
+        '''
+        Switch to single-writer / multiple-reader mode, after which other
+        processes can read the file while it is being written. No data sets,
+        groups or attributes can be created after this; existing data sets
+        can still be written and extended. Block sizes of data groups are
+        stored in a 'block_sizes' data set instead of an attribute.
+        '''
+
+        if not self._swmr:
+            logging.error('SWMR mode requires creating HDF5Data with swmr=True')
+            return False
+
+        for group in self._groups:
+            group._prepare_swmr()
+        self.flush()
+        self._file.swmr_mode = True
+        return True
+
+    def get_swmr_mode(self):
+        '''Return whether the file is in SWMR mode.'''
+        return self._swmr and self._file.swmr_mode
+
     def flush(self):
+        # Also removes the flush timers of the groups
+        for group in self._groups:
+            group.flush()
         self._file.flush()
 
     def close(self):
+        self.flush()
+        self._file.close()
+
+class StreamReader:
+    '''
+    Follow the data sets of a HDF5 file while it is being written. The
+    file should have been written using HDF5Data with swmr=True.
+
+    Each call to read() returns only the rows that were added since the
+    previous call, so a live plot or monitor does not have to re-read the
+    complete file.
+    '''
+
+    def __init__(self, filepath, group='/', names=None):
+        '''
+        Open <filepath> for reading. Data sets in <group> are followed,
+        optionally only those listed in <names>.
+        '''
+
+        self._filepath = filepath
+        try:
+            self._file = h5py.File(filepath, 'r', libver='latest', swmr=True)
+        except Exception, e:
+            logging.warning('Unable to open %s in SWMR mode (%s), data will not be updated',
+                    filepath, e)
+            self._file = h5py.File(filepath, 'r')
+
+        self._group = self._file[group]
+        if names is None:
+            names = [k for k in self._group.keys() \
+                    if isinstance(self._group[k], h5py.Dataset) and \
+                    self._group[k].attrs.get('dim_type') != 'block_sizes']
+        self._names = list(names)
+        self._positions = dict([(name, 0) for name in self._names])
+        self._follow_hid = None
+
+    def get_names(self):
+        '''Return the names of the followed data sets.'''
+        return list(self._names)
+
+    def get_position(self, name):
+        '''Return the number of rows of data set <name> read so far.'''
+        return self._positions[name]
+
+    def refresh(self):
+        '''
+        Refresh the followed data sets and return a dictionary with their
+        current number of rows.
+        '''
+
+        ret = {}
+        for name in self._names:
+            dset = self._group[name]
+            if self._file.swmr_mode:
+                dset.refresh()
+            if len(dset.shape) == 0:
+                ret[name] = 1
+            else:
+                ret[name] = dset.shape[0]
+        return ret
+
+    def read(self, aligned=True):
+        '''
+        Return a dictionary with the rows that were added to each data set
+        since the last call.
+
+        If aligned is True, only rows that are available for all data sets
+        are returned, so that the columns written with
+        DataGroup.add_data_point() stay together.
+        '''
+
+        sizes = self.refresh()
+        if aligned and len(sizes) > 0:
+            n = min(sizes.values())
+            for name in sizes:
+                sizes[name] = max(n, self._positions[name])
+
+        ret = {}
+        for name in self._names:
+            start = self._positions[name]
+            dset = self._group[name]
+            if sizes[name] > start and len(dset.shape) > 0:
+                ret[name] = dset[start:sizes[name]]
+            else:
+                ret[name] = np.zeros((0, ) + dset.shape[1:], dtype=dset.dtype)
+            self._positions[name] = sizes[name]
+        return ret
+
+    def get_block_sizes(self):
+        '''Return the sizes of the completed blocks in the group.'''
+
+        if 'block_sizes' in self._group.keys():
+            dset = self._group['block_sizes']
+            if self._file.swmr_mode:
+                dset.refresh()
+            return dset[:]
+        return self._group.attrs.get('block_sizes', np.zeros(0, dtype=int))
+
+    def follow(self, callback, interval=200):
+        '''
+        Call callback(rows) every <interval> ms when new rows are available,
+        with rows the dictionary returned by read().
+        '''
+
+        self.stop_follow()
+        self._follow_hid = gobject.timeout_add(int(interval),
+                self._follow_cb, callback)
+
+    def _follow_cb(self, callback):
+        rows = self.read()
+        for val in rows.values():
+            if len(val) > 0:
+                callback(rows)
+                break
+        return True
+
+    def stop_follow(self):
+        if self._follow_hid is not None:
+            gobject.source_remove(self._follow_hid)
+            self._follow_hid = None
+
+    def close(self):
+        self.stop_follow()
         self._file.close()
 
 def loop1d_data(xs, ynames=('ys', ), name='data', xname='xs', data=None, group=None):
@@ -235,14 +705,20 @@ def loop1d_data(xs, ynames=('ys', ), name='data', xname='xs', data=None, group=N
     HDF5 data file.
     The x coordinates should be specified in <xs> and will be named <xname>.
     <ynames> is a list that specifies the value data sets that will be created.
+    If <xs> is None, all data sets are created empty and can be filled with
+    add_data_point(), for sweeps of unknown length.
     '''
     if not group:
         if not data:
             data = HDF5Data()
-    group = d.create_data_group(name)
-    group.add_coordinate(xs, data=xs)
+        group = data.create_data_group(name)
+    group.add_coordinate(xname, data=xs)
     for yname in ynames:
-        group.add_value(yname, np.zeros((len(xs),)))
+        if xs is None:
+            group.add_value(yname)
+        else:
+            group.add_stream_dimension(yname, 'value')
+            group.write_slice(yname, 0, np.zeros((len(xs),)))
     return group
 
 def loop2d_data(xs, ys, znames=('zs', ), name='data', xname='xs', yname='ys', data=None, group=None):
@@ -251,15 +727,16 @@ def loop2d_data(xs, ys, znames=('zs', ), name='data', xname='xs', yname='ys', da
     HDF5 data file.
     The x and y coordinates should be specified in <xs> and <ys> and will be
     named <xname> and <yname>. <znames> is a list that specifies the value
-    data sets that will be created.
+    data sets that will be created; these can be extended along x.
     '''
     if not group:
         if not data:
             data = HDF5Data()
-        group = d.create_data_group(name)
+        group = data.create_data_group(name)
     group.add_coordinate(xname, data=xs)
     group.add_coordinate(yname, data=ys)
     for zname in znames:
-        group.add_value(zname, np.zeros((len(xs), len(ys))))
+        group.add_stream_dimension(zname, 'value', shape=(len(ys), ))
+        group.write_slice(zname, 0, np.zeros((len(xs), len(ys))))
     return group
 
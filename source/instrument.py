@@ -23,6 +23,9 @@ import math
 import inspect
 from gettext import gettext as _L
 from lib import calltimer
+from lib.ramp import Ramp
+from lib.executor import get_executor
+from lib import bus
 from lib.network.object_sharer import SharedGObject, cache_result
 
 import numpy as np
@@ -43,6 +46,9 @@ class Instrument(SharedGObject):
     Implement an instrument:
     In __init__ call self.add_variable(<name>, <option dict>)
     Implement _do_get_<variable> and _do_set_<variable> functions
+    Optionally implement do_get_many(<names>) and do_set_many(<dict>) to
+    access several parameters in one bus transaction.
+    Sweeps performed by the instrument itself are added with add_sweep().
     """
 
     __gsignals__ = {
@@ -84,6 +90,7 @@ class Instrument(SharedGObject):
     RESERVED_NAMES = ('name', 'type')
 
     _lock_classes = {}
+    _lock_class_users = {}
 
     def __init__(self, name, **kwargs):
         SharedGObject.__init__(self, 'instrument_%s' % name, replace=True)
@@ -100,8 +107,12 @@ class Instrument(SharedGObject):
             self._options['tags'] = []
 
         self._parameters = {}
+        self._accessor_specs = {}
+        self._value_times = {}
+        self._cache_stats = {}
         self._parameter_groups = {}
         self._functions = {}
+        self._sweeps = {}
         self._added_methods = []
         self._probe_ids = []
 
@@ -114,6 +125,8 @@ class Instrument(SharedGObject):
         else:
             self._access_lock = calltimer.TimedLock(2.0)
             self._lock_classes[self._lock_class] = self._access_lock
+        Instrument._lock_class_users[self._lock_class] = \
+                Instrument._lock_class_users.get(self._lock_class, 0) + 1
 
     def __str__(self):
         return "Instrument '%s'" % (self.get_name())
@@ -196,6 +209,16 @@ class Instrument(SharedGObject):
         '''
 
         self._remove_parameters()
+
+        # Stop the I/O worker thread if no other instrument uses it
+        users = Instrument._lock_class_users
+        n = users.get(self._lock_class, 0) - 1
+        if n > 0:
+            users[self._lock_class] = n
+        elif self._lock_class in users:
+            del users[self._lock_class]
+            get_executor().shutdown(self._lock_class)
+
         self.emit('removed', self.get_name())
 
     def is_initialized(self):
@@ -251,6 +274,9 @@ class Instrument(SharedGObject):
                 option_list (array/tuple): allowed options
                 persist (bool): if true load/save values in config file
                 probe_interval (int): interval in ms between automatic gets
+                cache_ttl (float): time in seconds during which a queried
+                    value is returned from the cache instead of querying
+                    the instrument again. A set invalidates the cache.
                 listen_to (list of (ins, param) tuples): list of parameters
                     to watch. If any of them changes, execute a get for this
                     parameter. Useful for a parameter that depends on one
@@ -307,13 +333,10 @@ class Instrument(SharedGObject):
 
         base_name = kwargs.get('base_name', name)
 
+        self._accessor_specs[name] = {'get': [False], 'set': [False]}
+
         if options['flags'] & Instrument.FLAG_GET:
-            if ch is not None:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=query, channel=ch, **lopts)
-            else:
-                func = lambda query=True, **lopts: \
-                    self.get(name, query=query, **lopts)
+            func = self._make_fast_get(name, ch)
 
             self._add_options_to_doc(options)
             func.__doc__ = 'Get variable %s' % name
@@ -349,10 +372,7 @@ class Instrument(SharedGObject):
             self._added_methods.append('get_%s' % name)
 
         if options['flags'] & Instrument.FLAG_SET:
-            if ch is not None:
-                func = lambda val, **lopts: self.set(name, val, channel=ch, **lopts)
-            else:
-                func = lambda val, **lopts: self.set(name, val, **lopts)
+            func = self._make_fast_set(name, ch)
 
             func.__doc__ = 'Set variable %s' % name
             if 'doc' in options:
@@ -382,10 +402,13 @@ class Instrument(SharedGObject):
         else:
             options['value'] = None
 
+        self._compile_parameter(name)
+
         if 'probe_interval' in options:
             interval = int(options['probe_interval'])
             self._probe_ids.append(gobject.timeout_add(interval,
-                lambda: self.get(name)))
+                lambda: bus.call_with_priority(bus.PRIORITY_BACKGROUND,
+                    self.get, name)))
 
         if 'listen_to' in options:
             insset = set([])
@@ -405,6 +428,133 @@ class Instrument(SharedGObject):
 
         self.emit('parameter-added', name)
 
+    # Casts performed on values returned by a get function
+    _GET_CAST_MAP = {
+            types.IntType: int,
+            types.FloatType: float,
+            types.BooleanType: bool,
+            np.ndarray: np.array,
+    }
+
+    def _compile_parameter(self, name):
+        '''
+        Precompute the function, channel, conversion and bounds used by the
+        get_<name> / set_<name> accessors. Parameters with options that need
+        the generic path (e.g. format_map, maxstep, cache_ttl) are not
+        compiled.
+        '''
+
+        p = self._parameters[name]
+        specs = self._accessor_specs[name]
+        flags = p['flags']
+        ch = p.get('channel', None)
+        ptype = p.get('type', types.NoneType)
+
+        getspec = specs['get']
+        del getspec[:]
+        if flags & Instrument.FLAG_GET and \
+                not flags & Instrument.FLAG_SOFTGET and \
+                p.get('cache_ttl', None) is None:
+            getspec.extend((True, p['get_func'],
+                self._GET_CAST_MAP.get(ptype, None), ch))
+        else:
+            getspec.append(False)
+
+        setspec = specs['set']
+        del setspec[:]
+        generic = ('format_map' in p or 'option_list' in p or
+                p.get('maxstep', None) is not None or
+                flags & (Instrument.FLAG_GET_AFTER_SET | Instrument.FLAG_PERSIST))
+        if flags & Instrument.FLAG_SET and not generic and \
+                ptype in self._CONVERT_MAP:
+            setspec.extend((True, p['set_func'], self._CONVERT_MAP[ptype],
+                ptype is types.BooleanType, 'minval' in p, p.get('minval'),
+                'maxval' in p, p.get('maxval'), ch))
+        else:
+            setspec.append(False)
+
+    def _make_fast_get(self, name, ch):
+        '''
+        Create the get_<name> function. Queries go directly to the get
+        function of the parameter; other cases use get().
+        '''
+
+        p = self._parameters[name]
+        spec = self._accessor_specs[name]['get']
+
+        def func(query=True, fast=False, **lopts):
+            if not query or lopts or not spec[0] or Instrument.USE_ACCESS_LOCK:
+                if ch is not None:
+                    lopts['channel'] = ch
+                return self.get(name, query=query, fast=fast, **lopts)
+
+            ok, getfunc, cast, channel = spec
+            if channel is None:
+                value = getfunc()
+            else:
+                value = getfunc(channel=channel)
+            if cast is not None and value is not None:
+                try:
+                    value = cast(value)
+                except:
+                    logging.warning('Unable to cast value "%s" to %s',
+                            value, p['type'])
+
+            p['value'] = value
+            self._value_times[name] = time.time()
+            if not fast:
+                self._changed[name] = value
+                if self._changed_hid is None:
+                    self._changed_hid = gobject.idle_add(self._do_emit_changed)
+            return value
+
+        return func
+
+    def _make_fast_set(self, name, ch):
+        '''
+        Create the set_<name> function. Values that pass the conversion and
+        bound checks are sent directly to the set function of the parameter;
+        other cases use set(), which also reports errors.
+        '''
+
+        p = self._parameters[name]
+        spec = self._accessor_specs[name]['set']
+
+        def func(val, fast=False, **lopts):
+            if lopts or not spec[0] or self._locked or \
+                    Instrument.USE_ACCESS_LOCK:
+                if ch is not None:
+                    lopts['channel'] = ch
+                return self.set(name, val, fast=fast, **lopts)
+
+            ok, setfunc, conv, isbool, hasmin, minval, hasmax, maxval, \
+                    channel = spec
+            try:
+                if type(val) is types.BooleanType and not isbool:
+                    raise ValueError()
+                value = conv(val)
+                if (hasmin and value < minval) or (hasmax and value > maxval):
+                    raise ValueError()
+            except:
+                if ch is not None:
+                    lopts['channel'] = ch
+                return self.set(name, val, fast=fast, **lopts)
+
+            if channel is None:
+                setfunc(value)
+            else:
+                setfunc(value, channel=channel)
+
+            p['value'] = value
+            self._value_times.pop(name, None)
+            if not fast:
+                self._changed[name] = value
+                if self._changed_hid is None:
+                    self._changed_hid = gobject.idle_add(self._do_emit_changed)
+            return True
+
+        return func
+
     def _remove_parameters(self):
         '''
         Remove remaining references to bound methods so that the Instrument
@@ -416,6 +566,10 @@ class Instrument(SharedGObject):
                 if hasattr(self, fname):
                     delattr(self, fname)
         self._parameters = {}
+        self._accessor_specs = {}
+        self._value_times = {}
+        self._cache_stats = {}
+        self._sweeps = {}
 
     def remove_parameter(self, name):
         if name not in self._parameters:
@@ -426,6 +580,9 @@ class Instrument(SharedGObject):
                 delattr(self, func)
 
         del self._parameters[name]
+        del self._accessor_specs[name]
+        self._value_times.pop(name, None)
+        self._cache_stats.pop(name, None)
         self.emit('parameter-removed', name)
 
     def has_parameter(self, name):
@@ -477,6 +634,7 @@ class Instrument(SharedGObject):
 
         for key, val in kwargs.iteritems():
             self._parameters[name][key] = val
+        self._compile_parameter(name)
 
         self.emit('parameter-changed', name)
 
@@ -670,13 +828,15 @@ class Instrument(SharedGObject):
 
         return text
 
-    def _get_value(self, name, query=True, **kwargs):
+    def _get_value(self, name, query=True, max_age=None, **kwargs):
         '''
         Private wrapper function to get a value.
 
         Input:  (1) name of parameter (string)
                 (2) query the instrument or return stored value (Boolean)
-                (3) optional list of extra options
+                (3) maximum age in seconds of a cached value to return
+                    instead of querying, default is the 'cache_ttl' option
+                (4) optional list of extra options
         Output: value of parameter (whatever type the instrument driver returns)
         '''
 
@@ -689,6 +849,16 @@ class Instrument(SharedGObject):
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
 
+        # Extra options might change the result, don't use the cache then
+        if max_age is None:
+            max_age = p.get('cache_ttl', None)
+        if query and max_age is not None and \
+                len([k for k in kwargs if k != 'channel']) == 0:
+            hit = self._is_fresh(name, max_age)
+            self._count_cache(name, hit)
+            if hit:
+                query = False
+
         flags = p['flags']
         if not query or flags & 8: #self.FLAG_SOFTGET:
             if 'value' in p:
@@ -712,6 +882,15 @@ class Instrument(SharedGObject):
 
         func = p['get_func']
         value = func(**kwargs)
+        value = self._cast_get_value(p, value)
+
+        p['value'] = value
+        self._value_times[name] = time.time()
+        return value
+
+    def _cast_get_value(self, p, value):
+        '''Cast a value returned by a driver to the type of parameter p.'''
+
         if 'type' in p and value is not None:
             try:
                 if p['type'] == types.IntType:
@@ -728,11 +907,53 @@ class Instrument(SharedGObject):
                     value = np.array(value)
             except:
                 logging.warning('Unable to cast value "%s" to %s', value, p['type'])
-
-        p['value'] = value
         return value
 
-    def get(self, name, query=True, fast=False, **kwargs):
+    def _get_many(self, names, max_age=None):
+        '''
+        Query several parameters using the do_get_many(names) function of
+        the driver. The driver returns a dictionary of parameter -> value,
+        which can contain more parameters than requested; all of them are
+        stored. Parameters that the driver did not return, or that have a
+        cached value younger than max_age / 'cache_ttl', are not handled.
+
+        Output: dictionary of parameter -> value for all returned parameters
+        '''
+
+        todo = []
+        for name in names:
+            p = self._parameters.get(name, None)
+            if p is None or not p['flags'] & Instrument.FLAG_GET or \
+                    p['flags'] & Instrument.FLAG_SOFTGET:
+                continue
+            age = max_age
+            if age is None:
+                age = p.get('cache_ttl', None)
+            if age is not None:
+                if self._is_fresh(name, age):
+                    continue
+                self._count_cache(name, False)
+            todo.append(name)
+        if len(todo) == 0:
+            return {}
+
+        values = self.do_get_many(todo)
+        if values is None:
+            return {}
+
+        ret = {}
+        now = time.time()
+        for name, value in values.iteritems():
+            p = self._parameters.get(name, None)
+            if p is None:
+                continue
+            value = self._cast_get_value(p, value)
+            p['value'] = value
+            self._value_times[name] = now
+            ret[name] = value
+        return ret
+
+    def get(self, name, query=True, fast=False, max_age=None, **kwargs):
         '''
         Get one or more Instrument parameter values.
 
@@ -742,10 +963,16 @@ class Instrument(SharedGObject):
                 last stored value
             fast (bool): if True perform as fast as possible, e.g. don't
                 emit a signal to update the GUI.
+            max_age (float): return the stored value instead of querying
+                if it is younger than max_age seconds. The default is the
+                'cache_ttl' option of the parameter, if specified.
             kwargs: Optional keyword args that will be passed on.
 
         Output: Single value, or dictionary of parameter -> values
                 Type is whatever the instrument driver returns.
+
+        If the driver implements do_get_many(names), a list of parameters
+        is queried at once.
         '''
 
         if Instrument.USE_ACCESS_LOCK:
@@ -754,7 +981,7 @@ class Instrument(SharedGObject):
                 return None
 
         if fast:
-            ret = self._get_value(name, query, **kwargs)
+            ret = self._get_value(name, query, max_age, **kwargs)
             if Instrument.USE_ACCESS_LOCK:
                 self._access_lock.release()
             return ret
@@ -762,14 +989,22 @@ class Instrument(SharedGObject):
         if type(name) in (types.ListType, types.TupleType):
             changed = {}
             result = {}
+
+            # Let the driver query several parameters at once if possible
+            if query and len(kwargs) == 0 and hasattr(self, 'do_get_many'):
+                changed = self._get_many(name, max_age)
+
             for key in name:
-                val = self._get_value(key, query, **kwargs)
+                if key in changed:
+                    val = changed[key]
+                else:
+                    val = self._get_value(key, query, max_age, **kwargs)
                 if val is not None:
                     result[key] = val
                     changed[key] = val
 
         else:
-            result = self._get_value(name, query, **kwargs)
+            result = self._get_value(name, query, max_age, **kwargs)
             changed = {name: result}
 
         if Instrument.USE_ACCESS_LOCK:
@@ -789,18 +1024,33 @@ class Instrument(SharedGObject):
         if config.get('threading_warning', True):
             logging.warning('Using threading functions could result in QTLab becoming unstable!')
 
-        thread = calltimer.ThreadCall(self.get, *args, **kwargs)
+        return self.get_async(*args, **kwargs).result()
 
-        # In python 2.6 the function is called is_alive
-        try:
-            isalive = thread.is_alive
-        except:
-            isalive = thread.isAlive
+    def get_async(self, name, *args, **kwargs):
+        '''
+        Perform a get in the I/O worker thread of this instrument and
+        return immediately. Calls for instruments with the same 'lockclass'
+        are executed in order, other instruments are accessed at the same
+        time. Use lib.executor.gather() to wait for several results.
+
+        Input: see get()
+        Output: Future, use result() to wait for the value
+        '''
 
-        while isalive():
-            qt.flow.run_mainloop(0.005)
+        return get_executor().submit(self._lock_class, self.get, name,
+                *args, **kwargs)
+
+    def set_async(self, name, *args, **kwargs):
+        '''
+        Perform a set in the I/O worker thread of this instrument and
+        return immediately, see get_async().
+
+        Input: see set()
+        Output: Future, use result() to wait for the result
+        '''
 
-        return thread.get_return_value()
+        return get_executor().submit(self._lock_class, self.set, name,
+                *args, **kwargs)
 
     def _key_from_format_map_val(self, dic, value):
         for key, val in dic.iteritems():
@@ -900,6 +1150,95 @@ class Instrument(SharedGObject):
         if 'channel' in p and 'channel' not in kwargs:
             kwargs['channel'] = p['channel']
 
+        value = self._check_set_value(name, value)
+        if value is None:
+            return None
+
+        if 'base_name' in p:
+            base_name = p['base_name']
+        else:
+            base_name = name
+
+        if p.get('maxstep', None) is not None:
+            return Ramp([(self, name, value, kwargs)], fast=True).run()[0]
+
+        func = p['set_func']
+        func(value, **kwargs)
+        return self._finish_set(name, value, **kwargs)
+
+    def _finish_set(self, name, value, **kwargs):
+        '''
+        Store the value of parameter <name> after it has been set.
+
+        Output: the value, or the result of a get if FLAG_GET_AFTER_SET
+        '''
+
+        p = self._parameters[name]
+        self._value_times.pop(name, None)
+
+        if p['flags'] & self.FLAG_GET_AFTER_SET:
+            value = self._get_value(name, **kwargs)
+
+        if p['flags'] & self.FLAG_PERSIST:
+            config.set('persist_%s_%s' % (self._name, name), value)
+            config.save()
+
+        p['value'] = value
+        return value
+
+    def _get_ramp_spec(self, name, value, **kwargs):
+        '''
+        Check a value for parameter <name> before ramping it.
+
+        Output: (start value, value, maxstep, stepdelay, kwargs), or None if
+                the value is not valid. Start value and maxstep are None if
+                the parameter should not be ramped.
+        '''
+
+        p = self._parameters.get(name, None)
+        if p is None:
+            print 'Could not retrieve options for parameter %s' % name
+            return None
+
+        if not p['flags'] & Instrument.FLAG_SET:
+            print 'Instrument does not support setting of %s' % name
+            return None
+
+        if 'channel' in p and 'channel' not in kwargs:
+            kwargs['channel'] = p['channel']
+
+        value = self._check_set_value(name, value)
+        if value is None:
+            return None
+
+        maxstep = p.get('maxstep', None)
+        if maxstep is None:
+            return None, value, None, 0, kwargs
+
+        curval = p['value']
+        if curval is None:
+            logging.warning('Current value not available, ignoring maxstep')
+            curval = value + 0.01 * maxstep
+
+        return curval, value, maxstep, p.get('stepdelay', 50), kwargs
+
+    def _do_ramp_step(self, name, value, kwargs):
+        '''Set one step while ramping parameter <name>.'''
+
+        p = self._parameters[name]
+        p['set_func'](value, **kwargs)
+        p['value'] = value
+        self._value_times.pop(name, None)
+
+    def _check_set_value(self, name, value):
+        '''
+        Check and convert a value for parameter <name>, using the format
+        map, option list, type and bounds. Returns None if the value is not
+        valid.
+        '''
+
+        p = self._parameters[name]
+
         # If a format map is available the key should be found.
         if 'format_map' in p:
             newval = self._val_from_option_dict(p['format_map'], value)
@@ -932,54 +1271,46 @@ class Instrument(SharedGObject):
             print 'Trying to set too large value: %s' % value
             return None
 
-        if 'base_name' in p:
-            base_name = p['base_name']
-        else:
-            base_name = name
-
-        func = p['set_func']
-        if 'maxstep' in p and p['maxstep'] is not None:
-            curval = p['value']
-            if curval is None:
-                logging.warning('Current value not available, ignoring maxstep')
-                curval = value + 0.01 * p['maxstep']
-
-            delta = curval - value
-            if delta < 0:
-                sign = 1
-            else:
-                sign = -1
-
-            if 'stepdelay' in p:
-                delay = p['stepdelay']
-            else:
-                delay = 50
-
-            while math.fabs(delta) > 0:
-                if math.fabs(delta) > p['maxstep']:
-                    curval += sign * p['maxstep']
-                    delta += sign * p['maxstep']
-                else:
-                    curval = value
-                    delta = 0
+        return value
 
-                ret = func(curval, **kwargs)
+    def _set_many(self, values):
+        '''
+        Set several parameters using the do_set_many(values) function of
+        the driver, which receives a dictionary of parameter -> value and
+        returns the names of the parameters it has set. Parameters that need
+        ramping (maxstep), a get after set or that persist are not included.
 
-                if delta != 0:
-                    time.sleep(delay / 1000.0)
+        Output: dictionary of parameter -> value for the parameters that
+                were handled; the value is None if it was not valid.
+        '''
 
-        else:
-            ret = func(value, **kwargs)
+        batch = {}
+        ret = {}
+        for name, value in values.iteritems():
+            p = self._parameters.get(name, None)
+            if p is None or not p['flags'] & Instrument.FLAG_SET or \
+                    p.get('maxstep', None) is not None or \
+                    p['flags'] & (Instrument.FLAG_GET_AFTER_SET | \
+                        Instrument.FLAG_PERSIST):
+                continue
 
-        if p['flags'] & self.FLAG_GET_AFTER_SET:
-            value = self._get_value(name, **kwargs)
+            value = self._check_set_value(name, value)
+            if value is None:
+                ret[name] = None
+            else:
+                batch[name] = value
 
-        if p['flags'] & self.FLAG_PERSIST:
-            config.set('persist_%s_%s' % (self._name, name), value)
-            config.save()
+        if len(batch) == 0:
+            return ret
 
-        p['value'] = value
-        return value
+        done = self.do_set_many(batch)
+        if done is None:
+            return ret
+        for name in done:
+            self._parameters[name]['value'] = batch[name]
+            self._value_times.pop(name, None)
+            ret[name] = batch[name]
+        return ret
 
     def set(self, name, value=None, fast=False, **kwargs):
         '''
@@ -998,6 +1329,9 @@ class Instrument(SharedGObject):
 
         Output: True or False whether the operation succeeded.
                 For multiple sets return False if any of the parameters failed.
+
+        If the driver implements do_set_many(values), a dictionary of
+        parameters is set at once, see _set_many().
         '''
 
         if self._locked:
@@ -1013,13 +1347,35 @@ class Instrument(SharedGObject):
         result = True
         changed = {}
         if type(name) == types.DictType:
+
+            # Let the driver set several parameters at once if possible
+            handled = {}
+            if len(kwargs) == 0 and hasattr(self, 'do_set_many'):
+                handled = self._set_many(name)
+
+            # Parameters with a maxstep are ramped at the same time
+            ramps = []
             for key, val in name.iteritems():
-                val = self._set_value(key, val, **kwargs)
+                if key in handled:
+                    val = handled[key]
+                elif self._parameters.get(key, {}).get('maxstep') is not None:
+                    ramps.append((self, key, val, dict(kwargs)))
+                    continue
+                else:
+                    val = self._set_value(key, val, **kwargs)
                 if val is not None:
                     changed[key] = val
                 else:
                     result = False
 
+            if len(ramps) > 0:
+                vals = Ramp(ramps, fast=True).run()
+                for item, val in zip(ramps, vals):
+                    if val is not None:
+                        changed[item[1]] = val
+                    else:
+                        result = False
+
         else:
             val = self._set_value(name, value, **kwargs)
             if val is not None:
@@ -1035,6 +1391,36 @@ class Instrument(SharedGObject):
 
         return result
 
+    def ramp_parameters(self, values, wait=True, fast=False, **kwargs):
+        '''
+        Ramp several parameters at the same time. Parameters with a maxstep
+        option are changed in steps, respecting maxstep and stepdelay of
+        each parameter; other parameters are set directly.
+
+        Input:
+            values (dict): parameter -> value
+            wait (bool): if True return when finished, otherwise ramp from
+                the main loop and return a Ramp object (see lib/ramp.py)
+                that can be used to wait for the result or to cancel.
+            fast (bool): if True don't emit a signal to update the GUI.
+            kwargs: Optional keyword args that will be passed on.
+
+        Output: dictionary of parameter -> final value, or a Ramp object
+        '''
+
+        if self._locked:
+            logging.warning('Trying to set value of locked instrument (%s)',
+                    self.get_name())
+            return None
+
+        names = values.keys()
+        r = Ramp([(self, name, values[name], dict(kwargs)) for name in names],
+                fast=fast)
+        if not wait:
+            r.start()
+            return r
+        return dict(zip(names, r.run()))
+
     def update_value(self, name, value):
         '''
         Update a parameter value if new information is obtained.
@@ -1048,8 +1434,59 @@ class Instrument(SharedGObject):
             return None
 
         p['value'] = value
+        self._value_times[name] = time.time()
         self._queue_changed({name: value})
 
+    def _is_fresh(self, name, max_age):
+        '''
+        Return whether the stored value of parameter <name> was obtained
+        less than <max_age> seconds ago.
+        '''
+
+        t = self._value_times.get(name, None)
+        return t is not None and (time.time() - t) <= max_age
+
+    def _count_cache(self, name, hit):
+        if name not in self._cache_stats:
+            self._cache_stats[name] = [0, 0]
+        if hit:
+            self._cache_stats[name][0] += 1
+        else:
+            self._cache_stats[name][1] += 1
+
+    def get_cache_stats(self, name=None):
+        '''
+        Return the number of value cache hits and misses.
+
+        Input:
+            name (string): parameter name, or None for the total of all
+                parameters
+        Output: dictionary with keys 'hits' and 'misses'
+        '''
+
+        if name is not None:
+            hits, misses = self._cache_stats.get(name, (0, 0))
+        else:
+            hits = sum([s[0] for s in self._cache_stats.values()])
+            misses = sum([s[1] for s in self._cache_stats.values()])
+        return {'hits': hits, 'misses': misses}
+
+    def reset_cache_stats(self):
+        '''Reset the value cache hit / miss counters.'''
+        self._cache_stats = {}
+
+    def invalidate_cache(self, name=None):
+        '''
+        Invalidate the cached value of parameter <name>, or of all
+        parameters if name is None, so that the next get queries the
+        instrument.
+        '''
+
+        if name is None:
+            self._value_times = {}
+        else:
+            self._value_times.pop(name, None)
+
     def get_argspec_dict(self, a):
         return dict(args=a[0], varargs=a[1], keywords=a[2], defaults=a[3])
 
@@ -1123,6 +1560,226 @@ class Instrument(SharedGObject):
         f = getattr(self, funcname)
         f(**kwargs)
 
+    def add_sweep(self, name, **kwargs):
+        '''
+        Add a sweep or buffered acquisition that is performed by the
+        instrument itself, so that many points cost only a few bus
+        transactions. A sweep is used as follows:
+
+            arm_sweep(name, npoints, **kwargs)
+            trigger_sweep(name)
+            data = fetch_sweep(name)
+
+        The driver implements do_arm_<name>(npoints, **kwargs),
+        do_trigger_<name>() and do_fetch_<name>(), unless other functions
+        are specified. The arm function returns True when the sweep was
+        armed. The fetch function returns a numpy array with one row per
+        point and one column per read parameter.
+
+        Input:
+            name (string): the name of the sweep
+            optional keywords:
+                read_parameters (list): the parameters that are returned
+                    for each point, in column order
+                sweep_parameter (string): a parameter that is stepped by
+                    the instrument; the arm function then receives the
+                    values as 'values' keyword argument
+                max_points (int): maximum number of points
+                arm_func, trigger_func, fetch_func: functions to use
+                channel: passed to the functions as 'channel' keyword
+                    argument
+                doc (string): documentation string
+
+        Output: None
+        '''
+
+        if name in self._sweeps:
+            logging.error('Sweep %s already exists.', name)
+            return
+
+        options = kwargs
+        options['read_parameters'] = list(options.get('read_parameters', []))
+        for action in ('arm', 'trigger', 'fetch'):
+            key = '%s_func' % action
+            if key not in options:
+                options[key] = getattr(self, 'do_%s_%s' % (action, name), None)
+            if options[key] is None:
+                logging.warning('Sweep %s does not implement %s', name, action)
+
+        options['state'] = None
+        self._sweeps[name] = options
+
+    def has_sweep(self, name):
+        '''Return whether instrument has a sweep called 'name'.'''
+        return name in self._sweeps
+
+    def get_sweep_names(self):
+        '''Return the list of sweep names.'''
+        return self._sweeps.keys()
+
+    def get_sweep_options(self, name):
+        '''
+        Return options for sweep 'name', without the driver functions.
+
+        Input: name (string)
+        Output: dictionary of options
+        '''
+
+        if name not in self._sweeps:
+            return None
+        options = dict(self._sweeps[name])
+        for i in ('arm_func', 'trigger_func', 'fetch_func'):
+            del options[i]
+        return options
+
+    def find_sweep(self, read_parameter=None, sweep_parameter=None):
+        '''
+        Return the name of a sweep that reads <read_parameter> and / or
+        steps <sweep_parameter>, or None if not available.
+        '''
+
+        for name, opts in self._sweeps.iteritems():
+            if read_parameter is not None and \
+                    read_parameter not in opts['read_parameters']:
+                continue
+            if sweep_parameter is not None and \
+                    opts.get('sweep_parameter', None) != sweep_parameter:
+                continue
+            return name
+        return None
+
+    def arm_sweep(self, name, npoints, **kwargs):
+        '''
+        Prepare sweep 'name' for <npoints> points.
+
+        Input:
+            name (string): the sweep
+            npoints (int): number of points
+            kwargs: Optional keyword args for the driver, e.g. 'values'
+                for sweeps with a sweep_parameter.
+
+        Output: True or False whether the operation succeeded.
+        '''
+
+        if self._locked:
+            logging.warning('Trying to arm sweep of locked instrument (%s)',
+                    self.get_name())
+            return False
+
+        opts = self._sweeps.get(name, None)
+        if opts is None or opts['arm_func'] is None:
+            logging.error('Sweep %s not available', name)
+            return False
+
+        npoints = int(npoints)
+        if 'max_points' in opts and npoints > opts['max_points']:
+            logging.error('Sweep %s supports at most %d points',
+                    name, opts['max_points'])
+            return False
+
+        sp = opts.get('sweep_parameter', None)
+        if sp is not None and 'values' in kwargs:
+            values = [self._check_set_value(sp, v) for v in kwargs['values']]
+            if None in values or len(values) != npoints:
+                logging.error('Invalid values for sweep %s', name)
+                return False
+            kwargs['values'] = np.array(values)
+
+        if 'channel' in opts:
+            kwargs['channel'] = opts['channel']
+        if not opts['arm_func'](npoints, **kwargs):
+            logging.error('Unable to arm sweep %s', name)
+            return False
+        opts['state'] = 'armed'
+        opts['npoints'] = npoints
+        opts['values'] = kwargs.get('values', None)
+        return True
+
+    def trigger_sweep(self, name):
+        '''
+        Start sweep 'name', which should have been armed.
+
+        Output: True or False whether the operation succeeded.
+        '''
+
+        opts = self._sweeps.get(name, None)
+        if opts is None or opts['state'] != 'armed':
+            logging.error('Sweep %s not armed', name)
+            return False
+
+        kwargs = {}
+        if 'channel' in opts:
+            kwargs['channel'] = opts['channel']
+        if opts['trigger_func'] is not None:
+            if opts['trigger_func'](**kwargs) is False:
+                return False
+        opts['state'] = 'triggered'
+        return True
+
+    def fetch_sweep(self, name, fast=False):
+        '''
+        Wait for sweep 'name' to finish and return the data. The values of
+        the read parameters are updated with the last point.
+
+        Input:
+            name (string): the sweep
+            fast (bool): if True don't emit a signal to update the GUI.
+
+        Output: numpy array with one row per point, None on error
+        '''
+
+        opts = self._sweeps.get(name, None)
+        if opts is None or opts['state'] != 'triggered':
+            logging.error('Sweep %s not triggered', name)
+            return None
+
+        kwargs = {}
+        if 'channel' in opts:
+            kwargs['channel'] = opts['channel']
+        data = opts['fetch_func'](**kwargs)
+        opts['state'] = None
+        if data is None:
+            return None
+
+        data = np.asarray(data)
+        changed = {}
+        pars = opts['read_parameters']
+        if len(data) > 0 and len(pars) > 0:
+            last = np.atleast_1d(data[-1])
+            for i, par in enumerate(pars[:len(last)]):
+                p = self._parameters.get(par, None)
+                if p is not None:
+                    p['value'] = self._cast_get_value(p, last[i])
+                    self._value_times[par] = time.time()
+                    changed[par] = p['value']
+
+        # The swept parameter stays at the last value
+        sp = opts.get('sweep_parameter', None)
+        if sp is not None and opts['values'] is not None and \
+                len(opts['values']) > 0:
+            p = self._parameters[sp]
+            p['value'] = self._cast_get_value(p, opts['values'][-1])
+            self._value_times.pop(sp, None)
+            changed[sp] = p['value']
+
+        if not fast and len(changed) > 0:
+            self._queue_changed(changed)
+
+        return data
+
+    def run_sweep(self, name, npoints, **kwargs):
+        '''
+        Arm, trigger and fetch sweep 'name'.
+
+        Output: numpy array with one row per point, None on error
+        '''
+
+        if not self.arm_sweep(name, npoints, **kwargs):
+            return None
+        if not self.trigger_sweep(name):
+            return None
+        return self.fetch_sweep(name)
+
     def lock(self):
         '''
         Lock the instrument; no parameters can be changed until the Instrument
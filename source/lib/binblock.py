@@ -0,0 +1,151 @@
+# binblock.py, IEEE 488.2 binary block encoding and decoding
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Functions to transfer waveforms as IEEE 488.2 binary blocks.
+
+A definite length block is '#<n><length><data>', where <n> is the number of
+digits of <length>. Block data is converted to and from numpy arrays
+directly, without handling the samples one by one:
+
+    data = ins._visainstrument.ask('CURV?')
+    wave, end = decode_block(data, '<i2')
+
+    ins._visainstrument.write('TRAC:DATA' + encode_block(wave))
+'''
+
+import re
+import numpy as np
+
+# Tektronix AWG real waveform record: float32 value and a marker byte with
+# marker 1 in bit 0 and marker 2 in bit 1.
+TEK_WFM_DTYPE = np.dtype([('value', '<f4'), ('markers', 'u1')])
+
+def block_header(length):
+    '''Return the header for a definite length block of <length> bytes.'''
+    length = str(length)
+    return '#%d%s' % (len(length), length)
+
+def encode_block(data):
+    '''
+    Encode data as definite length block.
+
+    Input:
+        data (string or numpy array): block data; arrays are sent with
+            their own dtype and byte order
+
+    Output: string
+    '''
+
+    if isinstance(data, np.ndarray):
+        data = data.tostring()
+    return block_header(len(data)) + data
+
+def find_block(data, offset=0):
+    '''
+    Find a block in data, starting at offset. For an indefinite length
+    block ('#0') the data runs up to the end, without a final newline.
+
+    Output: (start, length) of the block data
+    '''
+
+    start = data.find('#', offset)
+    if start == -1 or len(data) < start + 2:
+        raise ValueError('No IEEE 488.2 block found')
+
+    ndigits = int(str(data[start + 1:start + 2]))
+    if ndigits == 0:
+        end = len(data)
+        if data[end - 1:end] == '\n':
+            end -= 1
+        return start + 2, end - start - 2
+
+    header = str(data[start + 2:start + 2 + ndigits])
+    if len(header) != ndigits:
+        raise ValueError('Incomplete IEEE 488.2 block header')
+    length = int(header)
+    start += 2 + ndigits
+    if len(data) < start + length:
+        raise ValueError('Incomplete IEEE 488.2 block, %d of %d bytes' % \
+                (len(data) - start, length))
+    return start, length
+
+def decode_block(data, dtype='u1', offset=0):
+    '''
+    Decode a block in data as numpy array. The array shares memory with
+    data, so it is read-only if data is a string.
+
+    Input:
+        data (string, bytearray): reply containing the block
+        dtype: numpy dtype of the samples, e.g. '<i2' or TEK_WFM_DTYPE
+        offset (int): position in data to start looking for the block
+
+    Output: (array, end), where end is the position after the block
+    '''
+
+    dtype = np.dtype(dtype)
+    start, length = find_block(data, offset)
+    count = length / dtype.itemsize
+    arr = np.frombuffer(data, dtype=dtype, count=count, offset=start)
+    return arr, start + length
+
+def pack_markers(m1, m2):
+    '''Combine marker arrays into marker bytes (m1 in bit 0, m2 in bit 1).'''
+    return (np.asarray(m1, dtype=np.uint8) & 1) | \
+            ((np.asarray(m2, dtype=np.uint8) & 1) << 1)
+
+def unpack_markers(markers):
+    '''Split marker bytes into (m1, m2) arrays.'''
+    markers = np.asarray(markers, dtype=np.uint8)
+    return markers & 1, (markers >> 1) & 1
+
+def encode_tek_wfm(w, m1, m2, clock):
+    '''
+    Encode a Tektronix AWG .wfm file with a real waveform.
+
+    Input:
+        w (float[numpoints]): waveform
+        m1, m2 (int[numpoints]): markers
+        clock (float): clock frequency (Hz)
+
+    Output: string with the file contents
+    '''
+
+    records = np.empty(len(w), dtype=TEK_WFM_DTYPE)
+    records['value'] = w
+    records['markers'] = pack_markers(m1, m2)
+    return 'MAGIC 1000\n' + encode_block(records) + 'CLOCK %.10e\n' % clock
+
+def decode_tek_wfm(data):
+    '''
+    Decode a Tektronix AWG .wfm file with a real waveform, optionally
+    contained in a block as returned by 'MMEM:DATA?'.
+
+    Output: (w, m1, m2, clock)
+    '''
+
+    start = data.find('MAGIC')
+    if start == -1:
+        raise ValueError('Not a waveform file')
+    records, end = decode_block(data, TEK_WFM_DTYPE, start)
+    m1, m2 = unpack_markers(records['markers'])
+
+    m = re.search('CLOCK\s+(\S+)', str(data[end:end + 64]))
+    if m is None:
+        clock = None
+    else:
+        clock = float(m.group(1))
+    return records['value'], m1, m2, clock
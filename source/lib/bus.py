@@ -0,0 +1,279 @@
+# bus.py, schedule transactions on shared instrument controllers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Per-bus transaction scheduling.
+
+Several instruments often share one controller (a GPIB board, a prologix
+bridge). Every transaction (write, read, ask) on such a bus is executed
+while holding the lock of that bus, so transactions from different threads
+never interleave. Threads that are waiting for a bus are served in order of
+priority, and in order of arrival within the same priority:
+
+    PRIORITY_MEASUREMENT: the thread that started a measurement (qt.mstart)
+    PRIORITY_NORMAL: everything else
+    PRIORITY_BACKGROUND: probes and calls from the GUI
+
+The visa wrapper module performs the locking, see visa.instrument().
+Use get_bus_stats() to see the utilization and queue wait times per bus.
+'''
+
+import thread
+import threading
+import heapq
+
+from misc import exact_time
+
+PRIORITY_MEASUREMENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_MEASUREMENT: 'measurement',
+    PRIORITY_NORMAL: 'normal',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+_thread_state = threading.local()
+_measurement_thread = None
+
+def set_measurement_thread(ident=-1):
+    '''
+    Set the thread that runs the measurement; its transactions get
+    PRIORITY_MEASUREMENT. Default is the current thread, None to clear.
+    '''
+
+    global _measurement_thread
+    if ident == -1:
+        ident = thread.get_ident()
+    _measurement_thread = ident
+
+def set_priority(priority):
+    '''
+    Set the priority of transactions from the current thread. Use None to
+    return to the default priority.
+    '''
+    _thread_state.priority = priority
+
+def get_priority():
+    '''Return the priority of transactions from the current thread.'''
+
+    priority = getattr(_thread_state, 'priority', None)
+    if priority is not None:
+        return priority
+    if _measurement_thread == thread.get_ident():
+        return PRIORITY_MEASUREMENT
+    return PRIORITY_NORMAL
+
+def call_with_priority(priority, func, *args, **kwargs):
+    '''
+    Call func(*args, **kwargs) with the transaction priority of the current
+    thread set to <priority>.
+    '''
+
+    old = getattr(_thread_state, 'priority', None)
+    _thread_state.priority = priority
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _thread_state.priority = old
+
+class Bus(object):
+    '''
+    Lock for one controller. The lock is re-entrant, so a transaction can
+    consist of several calls from the same thread.
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._queue = []
+        self._seq = 0
+        self._busy_start = None
+        self.reset_stats()
+
+    def get_name(self):
+        return self._name
+
+    def reset_stats(self):
+        '''Reset the statistics of this bus.'''
+
+        self._cond.acquire()
+        self._stats_start = exact_time()
+        if self._busy_start is not None:
+            self._busy_start = self._stats_start
+        self._busy_time = 0
+        self._max_queue = 0
+        self._prio_stats = {}
+        self._cond.release()
+
+    def acquire(self, priority=None):
+        '''
+        Wait until the bus is available and acquire it. Waiting threads
+        with a lower priority number go first.
+        '''
+
+        if priority is None:
+            priority = get_priority()
+        me = thread.get_ident()
+
+        self._cond.acquire()
+        try:
+            if self._owner == me:
+                self._depth += 1
+                return
+
+            start = exact_time()
+            if self._owner is not None or len(self._queue) > 0:
+                entry = (priority, self._seq, me)
+                self._seq += 1
+                heapq.heappush(self._queue, entry)
+                self._max_queue = max(self._max_queue, len(self._queue))
+                try:
+                    while self._owner is not None or \
+                            self._queue[0] is not entry:
+                        self._cond.wait()
+                except:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notifyAll()
+                    raise
+                heapq.heappop(self._queue)
+
+            self._owner = me
+            self._depth = 1
+            self._busy_start = exact_time()
+
+            wait = self._busy_start - start
+            stats = self._prio_stats.setdefault(priority, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+        finally:
+            self._cond.release()
+
+    def release(self):
+        '''Release the bus.'''
+
+        self._cond.acquire()
+        try:
+            if self._owner != thread.get_ident():
+                raise RuntimeError('Bus %s not acquired by this thread' % \
+                        self._name)
+            self._depth -= 1
+            if self._depth > 0:
+                return
+            self._busy_time += exact_time() - self._busy_start
+            self._busy_start = None
+            self._owner = None
+            if len(self._queue) > 0:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def transaction(self, func, *args, **kwargs):
+        '''Call func(*args, **kwargs) while holding the bus.'''
+
+        self.acquire()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release()
+
+    def get_stats(self):
+        '''
+        Return statistics of this bus.
+
+        Output: dictionary with keys:
+            transactions: number of transactions
+            utilization: fraction of time the bus was in use
+            queue_length: number of threads currently waiting
+            max_queue_length: maximum number of waiting threads
+            wait_mean, wait_max: time in seconds waited for the bus
+            priorities: dictionary of priority name -> dictionary with
+                transactions, wait_mean and wait_max for that priority
+        '''
+
+        self._cond.acquire()
+        now = exact_time()
+        busy = self._busy_time
+        if self._busy_start is not None:
+            busy += now - self._busy_start
+        elapsed = now - self._stats_start
+
+        n = 0
+        total = 0.0
+        maxwait = 0.0
+        prios = {}
+        for prio, (pn, ptotal, pmax) in self._prio_stats.iteritems():
+            prios[PRIORITY_NAMES.get(prio, prio)] = {
+                'transactions': pn,
+                'wait_mean': ptotal / pn,
+                'wait_max': pmax,
+            }
+            n += pn
+            total += ptotal
+            maxwait = max(maxwait, pmax)
+
+        ret = {
+            'transactions': n,
+            'utilization': busy / elapsed if elapsed > 0 else 0.0,
+            'queue_length': len(self._queue),
+            'max_queue_length': self._max_queue,
+            'wait_mean': total / n if n > 0 else 0.0,
+            'wait_max': maxwait,
+            'priorities': prios,
+        }
+        self._cond.release()
+        return ret
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+def get_bus(name):
+    '''Return the Bus object for <name>, create it if it does not exist.'''
+
+    _buses_lock.acquire()
+    bus = _buses.get(name, None)
+    if bus is None:
+        bus = Bus(name)
+        _buses[name] = bus
+    _buses_lock.release()
+    return bus
+
+def get_bus_names():
+    return _buses.keys()
+
+def get_bus_stats(name=None):
+    '''
+    Return statistics for bus <name>, or a dictionary of bus name ->
+    statistics if name is None. See Bus.get_stats().
+    '''
+
+    if name is not None:
+        return get_bus(name).get_stats()
+    return dict([(n, b.get_stats()) for n, b in _buses.items()])
+
+def reset_bus_stats(name=None):
+    '''Reset statistics for bus <name>, or for all buses if name is None.'''
+
+    if name is not None:
+        get_bus(name).reset_stats()
+        return
+    for bus in _buses.values():
+        bus.reset_stats()
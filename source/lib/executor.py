@@ -0,0 +1,245 @@
+# executor.py, perform instrument I/O in worker threads
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Executor to perform instrument I/O without blocking.
+
+Every key (an instrument or a bus, see the 'lockclass' option of
+Instrument) gets one worker thread, so calls with the same key are
+executed in order, while calls with different keys overlap in time.
+Submitting a call returns a Future:
+
+    f1 = dmm1.get_async('readval')
+    f2 = dmm2.get_async('readval')
+    v1, v2 = gather(f1, f2)
+'''
+
+import sys
+import gobject
+import logging
+import threading
+import Queue
+
+from misc import exact_time
+import bus
+
+class Future(object):
+    '''
+    The result of a call that is executed by the Executor.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _set_result(self, result, exc_info=None):
+        self._lock.acquire()
+        self._result = result
+        self._exc_info = exc_info
+        self._event.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        self._lock.release()
+
+        for cb in callbacks:
+            gobject.idle_add(self._run_callback, cb)
+
+    def _run_callback(self, cb):
+        try:
+            cb(self)
+        except Exception, e:
+            logging.error('Error in future callback: %s', e)
+        return False
+
+    def done(self):
+        '''Return whether the call has finished.'''
+        return self._event.isSet()
+
+    def add_done_callback(self, cb):
+        '''
+        Add function cb(future) that is called from the main loop when
+        the call has finished.
+        '''
+
+        self._lock.acquire()
+        if not self._event.isSet():
+            self._callbacks.append(cb)
+            self._lock.release()
+            return
+        self._lock.release()
+        gobject.idle_add(self._run_callback, cb)
+
+    def wait(self, timeout=None, mainloop=True):
+        '''
+        Wait until the call has finished, or until <timeout> seconds have
+        passed. If mainloop is True, pending events of the main loop are
+        handled while waiting. Returns whether the call has finished.
+        '''
+
+        if not mainloop:
+            self._event.wait(timeout)
+            return self._event.isSet()
+
+        from qtflow import get_flowcontrol
+        flow = get_flowcontrol()
+        start = exact_time()
+        while not self._event.isSet():
+            if timeout is not None and exact_time() - start > timeout:
+                return False
+            self._event.wait(0.01)
+            flow.run_mainloop(0, wait=False)
+        return True
+
+    def result(self, timeout=None, mainloop=True):
+        '''
+        Wait for and return the result of the call. If the call raised an
+        exception it is raised again.
+        '''
+
+        if not self.wait(timeout, mainloop):
+            raise RuntimeError('Timeout waiting for result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None, mainloop=True):
+        '''Return the exception raised by the call, or None.'''
+
+        if not self.wait(timeout, mainloop):
+            raise RuntimeError('Timeout waiting for result')
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+class Worker(threading.Thread):
+    '''
+    Thread that executes calls from a queue one after the other.
+    '''
+
+    def __init__(self, key):
+        threading.Thread.__init__(self, name='executor-%s' % key)
+        self.setDaemon(True)
+        self._queue = Queue.Queue()
+
+    def submit(self, future, func, args, kwargs, priority):
+        self._queue.put((future, func, args, kwargs, priority))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, func, args, kwargs, priority = item
+            try:
+                future._set_result(bus.call_with_priority(priority,
+                    func, *args, **kwargs))
+            except Exception, e:
+                future._set_result(None, sys.exc_info())
+
+class Executor(object):
+    '''
+    Execute calls in one worker thread per key.
+    '''
+
+    def __init__(self):
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        '''
+        Execute func(*args, **kwargs) in the worker thread for <key>.
+        Bus transactions get the priority of the calling thread.
+
+        Output: Future
+        '''
+
+        self._lock.acquire()
+        worker = self._workers.get(key, None)
+        if worker is None:
+            worker = Worker(key)
+            worker.start()
+            self._workers[key] = worker
+        self._lock.release()
+
+        future = Future()
+        worker.submit(future, func, args, kwargs, bus.get_priority())
+        return future
+
+    def get_keys(self):
+        '''Return the keys that have a worker thread.'''
+        return self._workers.keys()
+
+    def shutdown(self, key=None):
+        '''
+        Stop the worker thread for <key>, or all workers if key is None.
+        Calls that were already submitted are still executed.
+        '''
+
+        self._lock.acquire()
+        if key is None:
+            keys = self._workers.keys()
+        else:
+            keys = [key]
+        for k in keys:
+            worker = self._workers.pop(k, None)
+            if worker is not None:
+                worker.stop()
+        self._lock.release()
+
+_executor = None
+
+def get_executor():
+    '''Return the global Executor.'''
+    global _executor
+    if _executor is None:
+        _executor = Executor()
+    return _executor
+
+def gather(*futures, **kwargs):
+    '''
+    Wait for several futures and return a list of their results.
+
+    Input:
+        futures: Future objects, or one list of them
+        timeout (float): maximum total time to wait in seconds
+        mainloop (bool): whether to handle main loop events while waiting
+
+    Output:
+        list of results, in the order of the futures
+    '''
+
+    if len(futures) == 1 and type(futures[0]) in (list, tuple):
+        futures = futures[0]
+    timeout = kwargs.get('timeout', None)
+    mainloop = kwargs.get('mainloop', True)
+
+    start = exact_time()
+    for f in futures:
+        if timeout is not None:
+            remaining = max(timeout - (exact_time() - start), 0)
+        else:
+            remaining = None
+        if not f.wait(remaining, mainloop):
+            raise RuntimeError('Timeout waiting for results')
+
+    return [f.result(mainloop=mainloop) for f in futures]
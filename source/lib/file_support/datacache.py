@@ -0,0 +1,241 @@
+# datacache.py, binary cache for parsed data files
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Cache for the parsed contents of .dat files.
+
+The data is stored as a .npy file, which is memory-mapped when loading, and
+the meta data as a small JSON file. A cache entry is only used if the size
+and modification time of the .dat file match the values stored in the
+meta data.
+
+Two locations are supported:
+- 'sidecar': next to the .dat file, as <name>.dat.npy / <name>.dat.json
+- 'temp': in the 'datacache' subdirectory of the qtlab temp dir. In this
+  case the least recently used entries are removed when the total size
+  exceeds 'data_cache_size' (in MB) from the config.
+'''
+
+import os
+import logging
+import hashlib
+import numpy
+
+try:
+    import json
+except:
+    import simplejson as json
+
+from lib.config import get_config
+config = get_config()
+
+CACHE_VERSION = 1
+
+def _to_str(val):
+    '''Convert unicode strings from the json decoder back to str.'''
+    if type(val) is unicode:
+        return val.encode('utf-8')
+    elif type(val) is list:
+        return [_to_str(i) for i in val]
+    elif type(val) is dict:
+        return dict([(_to_str(k), _to_str(v)) for k, v in val.iteritems()])
+    return val
+
+def _get_cache_dir():
+    tdir = config.get('tempdir')
+    if tdir is None:
+        return None
+    return os.path.join(tdir, 'datacache')
+
+def get_cache_paths(filepath, mode):
+    '''
+    Return the paths of the data and meta data cache files for
+    <filepath>, or None if caching is not possible.
+    '''
+
+    if mode == 'sidecar':
+        base = filepath
+    elif mode == 'temp':
+        cdir = _get_cache_dir()
+        if cdir is None:
+            return None
+        key = hashlib.md5(os.path.abspath(filepath)).hexdigest()
+        base = os.path.join(cdir, key)
+    else:
+        logging.warning('Unknown data cache mode: %s', mode)
+        return None
+
+    return base + '.npy', base + '.json'
+
+def _get_file_info(filepath):
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime
+
+def load_meta(filepath, metapath):
+    '''
+    Load meta data (dictionary) stored for <filepath> in <metapath>. Returns
+    None if there is none, or if it does not match the size and
+    modification time of <filepath>.
+    '''
+
+    if not os.path.exists(metapath):
+        return None
+
+    f = open(metapath, 'r')
+    meta = _to_str(json.load(f))
+    f.close()
+
+    size, mtime = _get_file_info(filepath)
+    if meta.get('version') != CACHE_VERSION or \
+            meta.get('size') != size or meta.get('mtime') != mtime:
+        logging.debug('Meta data %s out of date', metapath)
+        return None
+
+    return meta
+
+def save_meta(filepath, metapath, meta):
+    '''
+    Store meta data (dictionary) for <filepath> in <metapath>, together
+    with the size and modification time of <filepath>. Returns False if the
+    meta data does not survive a round trip through json.
+    '''
+
+    meta = dict(meta)
+    meta['version'] = CACHE_VERSION
+    meta['size'], meta['mtime'] = _get_file_info(filepath)
+
+    metastr = json.dumps(meta)
+    if _to_str(json.loads(metastr)) != meta:
+        return False
+
+    f = open(metapath, 'w')
+    f.write(metastr)
+    f.close()
+    return True
+
+def load(filepath, mode):
+    '''
+    Load cached data for <filepath>. Returns a tuple (data, meta), where
+    data is a copy-on-write memory-mapped numpy array, or None if no valid
+    cache entry is available.
+    '''
+
+    paths = get_cache_paths(filepath, mode)
+    if paths is None:
+        return None
+    npypath, metapath = paths
+    if not os.path.exists(metapath) or not os.path.exists(npypath):
+        return None
+
+    try:
+        meta = load_meta(filepath, metapath)
+        if meta is None:
+            return None
+
+        data = numpy.load(npypath, mmap_mode='c')
+    except Exception, e:
+        logging.warning('Unable to load data cache for %s: %s', filepath, e)
+        return None
+
+    # Mark entry as recently used
+    if mode == 'temp':
+        try:
+            os.utime(metapath, None)
+        except:
+            pass
+
+    return data, meta
+
+def save(filepath, data, meta, mode):
+    '''
+    Store data and meta data (dictionary) for <filepath>. The meta data
+    should survive a round trip through json; if it does not, nothing is
+    stored.
+    '''
+
+    paths = get_cache_paths(filepath, mode)
+    if paths is None:
+        return False
+    npypath, metapath = paths
+
+    meta = dict(meta)
+    meta['version'] = CACHE_VERSION
+    meta['size'], meta['mtime'] = _get_file_info(filepath)
+
+    try:
+        metastr = json.dumps(meta)
+        if _to_str(json.loads(metastr)) != meta:
+            logging.debug('Meta data of %s not suitable for caching', filepath)
+            return False
+
+        cdir = os.path.dirname(npypath)
+        if cdir != '' and not os.path.isdir(cdir):
+            os.makedirs(cdir)
+
+        # Write meta data last, it validates the entry
+        if os.path.exists(metapath):
+            os.remove(metapath)
+        numpy.save(npypath, numpy.asarray(data))
+        f = open(metapath, 'w')
+        f.write(metastr)
+        f.close()
+    except Exception, e:
+        logging.warning('Unable to write data cache for %s: %s', filepath, e)
+        return False
+
+    if mode == 'temp':
+        evict()
+
+    return True
+
+def evict(maxsize=None):
+    '''
+    Remove least recently used entries from the temp dir cache until the
+    total size is below <maxsize> MB (default: 'data_cache_size' from
+    config, or 1000).
+    '''
+
+    if maxsize is None:
+        maxsize = config.get('data_cache_size', 1000)
+    cdir = _get_cache_dir()
+    if cdir is None or not os.path.isdir(cdir):
+        return
+
+    entries = []
+    total = 0
+    for fn in os.listdir(cdir):
+        base, ext = os.path.splitext(fn)
+        if ext != '.json':
+            continue
+        metapath = os.path.join(cdir, fn)
+        npypath = os.path.join(cdir, base + '.npy')
+        size = os.path.getsize(metapath)
+        if os.path.exists(npypath):
+            size += os.path.getsize(npypath)
+        entries.append((os.path.getmtime(metapath), size, metapath, npypath))
+        total += size
+
+    entries.sort()
+    for atime, size, metapath, npypath in entries:
+        if total <= maxsize * 1024 * 1024:
+            break
+        try:
+            os.remove(metapath)
+            if os.path.exists(npypath):
+                os.remove(npypath)
+            total -= size
+        except Exception, e:
+            logging.warning('Unable to remove cache entry %s: %s', npypath, e)
@@ -19,6 +19,7 @@ import time
 import gtk
 import gobject
 import logging
+import numpy as np
 import qt
 from data import Data
 
@@ -265,9 +266,158 @@ class Measurement(gobject.GObject):
 
         return extra_delay
 
+    def _get_hardware_sweeps(self):
+        '''
+        Check whether the inner loop can be performed by the instruments
+        (see Instrument.add_sweep): a sweep of the inner coordinate
+        instrument should step the coordinate, and every measurement should
+        be read by a sweep. Sweeps of other instruments are only used if
+        they are declared to be triggered by the sweeping instrument in the
+        'trigger_links' option.
+
+        Output:
+            list of (instrument, sweep name, [(column, measurement nr)])
+            with the sweep of the inner coordinate first, or None.
+        '''
+
+        if not self._options.get('hardware_sweep', False):
+            return None
+
+        inner = self._coords[-1]
+        if 'ins' not in inner or not hasattr(inner['ins'], 'find_sweep'):
+            return None
+        ins = inner['ins']
+        name = ins.find_sweep(sweep_parameter=inner['var'])
+        if name is None:
+            return None
+        sweeps = [(ins, name, [])]
+
+        for i, m in enumerate(self._measurements):
+            if 'ins' not in m or not hasattr(m['ins'], 'find_sweep'):
+                return None
+
+            # Prefer a sweep that is already used
+            for ins, name, cols in sweeps:
+                if ins.get_name() != m['ins'].get_name():
+                    continue
+                pars = ins.get_sweep_options(name)['read_parameters']
+                if m['var'] in pars:
+                    cols.append((pars.index(m['var']), i))
+                    break
+            else:
+                ins = m['ins']
+                name = ins.find_sweep(read_parameter=m['var'])
+                if name is None:
+                    return None
+                pars = ins.get_sweep_options(name)['read_parameters']
+                sweeps.append((ins, name, [(pars.index(m['var']), i)]))
+
+        # Readings of other instruments should be triggered by every step
+        sweep_ins = sweeps[0][0].get_name()
+        linked = [r.get_name() for r, s in \
+                self._options.get('trigger_links', []) \
+                if s.get_name() == sweep_ins]
+        for ins, name, cols in sweeps[1:]:
+            if ins.get_name() not in linked:
+                logging.warning('Not using hardware sweep: %s is not '
+                        'triggered by %s', ins.get_name(), sweep_ins)
+                return None
+
+        return sweeps
+
+    def _set_outer_values(self, index):
+        '''
+        Set the coordinates of all but the inner loop to <index> if they
+        changed. Returns the extra delay required.
+        '''
+
+        extra_delay = 0
+        coords = self.index_to_coords(index)
+        for i in xrange(len(coords) - 1):
+            if self._last_index is not None and \
+                    index[i] == self._last_index[i]:
+                continue
+
+            if 'ins' in self._coords[i]:
+                self._coords[i]['ins'].set(self._coords[i]['var'], coords[i])
+            elif 'func' in self._coords[i]:
+                self._coords[i]['func'](coords[i])
+            if 'delay' in self._coords[i]:
+                extra_delay += self._coords[i]['delay'] / 1000.0
+
+        self._last_index = index
+        return extra_delay
+
+    def _run_hardware_sweeps(self, sweeps):
+        '''
+        Measurement loop where the inner loop is performed by instrument
+        sweeps: for every point of the outer loops the sweeps are armed,
+        triggered (the inner coordinate last) and fetched.
+        '''
+
+        inner = self._coords[-1]
+        npoints = int(inner['steps'])
+        values = inner['start'] + np.arange(npoints) * inner['stepsize']
+        arm_kwargs = {'values': values}
+        if 'delay' in inner:
+            arm_kwargs['delay'] = inner['delay']
+
+        self._last_index = None
+        for outer in xrange(self._ntotal / npoints):
+            index = self.iter_to_index(outer * npoints)
+            try:
+                delay = self._set_outer_values(index)
+                if delay > 0:
+                    qt.msleep(delay)
+
+                for ins, name, cols in sweeps[1:]:
+                    if not ins.arm_sweep(name, npoints):
+                        raise ValueError('Unable to arm %s' % name)
+                ins, name, cols = sweeps[0]
+                if not ins.arm_sweep(name, npoints, **arm_kwargs):
+                    raise ValueError('Unable to arm %s' % name)
+
+                for ins, name, cols in sweeps[1:] + sweeps[:1]:
+                    ins.trigger_sweep(name)
+
+                data = [None] * len(self._measurements)
+                for ins, name, cols in sweeps:
+                    ret = ins.fetch_sweep(name)
+                    if ret is None:
+                        raise ValueError('No data from %s' % name)
+                    ret = np.asarray(ret).reshape((npoints, -1))
+                    for col, i in cols:
+                        data[i] = ret[:, col]
+            except Exception, e:
+                logging.error('Hardware sweep failed: %s', e)
+                self.emit('finished', str(e))
+                return False
+
+            coords = self.index_to_coords(index)
+            cols = [np.ones(npoints) * c for c in coords[:-1]]
+            self._data.add_data_point(*(cols + [values] + data))
+            if len(self._coords) > 1:
+                self._data.new_block()
+
+            self.emit('progress', {
+                'current': (outer + 1) * npoints - 1,
+                'total': self._ntotal,
+                })
+
+        self.emit('finished', 'Ok')
+        return True
+
     def start(self):
         '''
         Start measurement loop.
+
+        If hardware_sweep=True was passed when creating the Measurement
+        and the instruments implement sweeps (see Instrument.add_sweep) for
+        the inner coordinate and all measurements, the inner loop is
+        performed by the instruments. Instruments that read while another
+        instrument sweeps should have their trigger input connected to it,
+        which is declared with trigger_links=[(reading instrument, sweeping
+        instrument), ...]. Otherwise the loop steps point by point.
         '''
 
         if len(self._coords) == 0:
@@ -275,12 +425,16 @@ class Measurement(gobject.GObject):
             self.emit('finished', 'ok')
             return False
 
+        sweeps = self._get_hardware_sweeps()
+
         # determine loop delay
         last_coord = self._coords[len(self._coords) - 1]
         if 'delay' in self._options:
             self._delay = self._options['delay']
         elif 'delay' in last_coord:
             self._delay = last_coord['delay']
+        elif sweeps is not None:
+            self._delay = 0
         else:
             logging.warning('measurement delay undefined')
             return False
@@ -289,17 +443,21 @@ class Measurement(gobject.GObject):
         self._ntotal = 1
         for coord in self._coords:
             self._ntotal *= coord['steps']
+        self._data.reserve(self._ntotal)
 
         # Create file
         self._data.create_file(self._name)
 
+        if sweeps is not None:
+            return self._run_hardware_sweeps(sweeps)
+
         # Set starting values and sleep
         self._last_index = [-1 for i in xrange(len(self._coords))]
         self._do_set_values(-1)
         time.sleep(self._delay / 1000.0)
 
         for i in range(self._ntotal):
-            self._measure()
+            self._measure(i)
             try:
                 qt.msleep(self._delay / 1000.0)
             except:
@@ -0,0 +1,511 @@
+# codec.py, encoding of object sharer packets
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Codecs to encode the packets of the object sharer.
+
+pickle:
+    cPickle with the highest protocol. Any python object can be sent, but
+    decoding a packet can execute arbitrary code, so only use it between
+    trusted hosts.
+
+compact:
+    A msgpack-style binary format for the basic types used in calls and
+    signals: None, bool, int, long, float, complex, str, unicode, tuple,
+    list, dict, numpy arrays and scalars. Exceptions are decoded as
+    RemoteException. Decoding never creates other objects, and encoding
+    other objects raises TypeError.
+
+Every codec has a packet magic ('QT' / 'QC'), and one for packets that are
+followed by raw array data ('QA' / 'QD'), so received packets are decoded
+with the codec that encoded them. Large numpy arrays can be left out of
+the encoded data through the persistent_id / persistent_load functions,
+as with pickle.
+'''
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+import struct
+import numpy as np
+from cStringIO import StringIO
+
+class RemoteException(Exception):
+    pass
+
+class PickleCodec():
+    '''Encode packets with pickle.'''
+
+    name = 'pickle'
+    magic = 'QT'
+    array_magic = 'QA'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self._protocol = protocol
+
+    def encode(self, obj, persistent_id=None):
+        if persistent_id is None:
+            return pickle.dumps(obj, self._protocol)
+        f = StringIO()
+        p = pickle.Pickler(f, self._protocol)
+        p.inst_persistent_id = persistent_id
+        p.dump(obj)
+        return f.getvalue()
+
+    def decode(self, data, persistent_load=None):
+        if persistent_load is None:
+            return pickle.loads(str(data))
+        p = pickle.Unpickler(StringIO(data))
+        p.persistent_load = persistent_load
+        return p.load()
+
+# Type codes of the compact codec. As in msgpack, small integers, short
+# strings and small containers are encoded in the type code itself.
+_FIXINT_MAX = 0x7f
+_FIXDICT = 0x80
+_FIXTUPLE = 0x90
+_FIXSTR = 0xa0
+_NONE = 0xc0
+_FALSE = 0xc2
+_TRUE = 0xc3
+_UNICODE = 0xc4
+_LIST = 0xc5
+_ARRAY = 0xc6
+_ARRAY_REF = 0xc7
+_SCALAR = 0xc8
+_EXCEPTION = 0xc9
+_LONG = 0xca
+_FLOAT = 0xcb
+_COMPLEX = 0xcc
+_INT8 = 0xd0
+_INT16 = 0xd1
+_INT32 = 0xd2
+_INT64 = 0xd3
+_STR8 = 0xd9
+_STR32 = 0xdb
+_TUPLE = 0xdc
+_DICT = 0xde
+_NEGFIXINT = 0xe0
+
+# Type codes for the packet shapes (info, data) used by the object sharer:
+# (('call', callid), (objname, funcname, args, kwargs)),
+# (('signal', ), (objname, funcname, args, kwargs)) and
+# (('return', callid), value). They are only used at the start of a packet.
+_PACKET_CALL = 0xd4
+_PACKET_SIGNAL = 0xd5
+_PACKET_RETURN = 0xd6
+_packet_header = struct.Struct('<BI')
+
+_TAGS = [chr(i) for i in range(256)]
+_pack_len = struct.Struct('<I').pack
+_unpack_len = struct.Struct('<I').unpack_from
+
+class CompactCodec():
+    '''Encode packets with a compact schema of basic types.'''
+
+    name = 'compact'
+    magic = 'QC'
+    array_magic = 'QD'
+
+    def __init__(self):
+        self._encoders = {
+            type(None): self._encode_none,
+            bool: self._encode_bool,
+            int: self._encode_int,
+            long: self._encode_int,
+            float: self._encode_float,
+            complex: self._encode_complex,
+            str: self._encode_str,
+            unicode: self._encode_unicode,
+            tuple: self._encode_tuple,
+            list: self._encode_list,
+            dict: self._encode_dict,
+            np.ndarray: self._encode_array,
+        }
+
+        self._decoders = [None] * 256
+        for i in range(_FIXINT_MAX + 1):
+            self._decoders[i] = self._decode_fixint
+        for i in range(16):
+            self._decoders[_FIXDICT + i] = self._decode_fixdict
+            self._decoders[_FIXTUPLE + i] = self._decode_fixtuple
+        for i in range(32):
+            self._decoders[_FIXSTR + i] = self._decode_fixstr
+            self._decoders[_NEGFIXINT + i] = self._decode_fixint
+        for tag, func in (
+                (_NONE, self._decode_none),
+                (_FALSE, self._decode_bool),
+                (_TRUE, self._decode_bool),
+                (_UNICODE, self._decode_unicode),
+                (_LIST, self._decode_list),
+                (_ARRAY, self._decode_array),
+                (_ARRAY_REF, self._decode_array_ref),
+                (_SCALAR, self._decode_scalar),
+                (_EXCEPTION, self._decode_exception),
+                (_LONG, self._decode_long),
+                (_FLOAT, self._decode_struct),
+                (_COMPLEX, self._decode_complex),
+                (_INT8, self._decode_struct),
+                (_INT16, self._decode_struct),
+                (_INT32, self._decode_struct),
+                (_INT64, self._decode_struct),
+                (_STR8, self._decode_str8),
+                (_STR32, self._decode_str32),
+                (_TUPLE, self._decode_tuple),
+                (_DICT, self._decode_dict)):
+            self._decoders[tag] = func
+
+        self._structs = {
+            _FLOAT: struct.Struct('<d'),
+            _INT8: struct.Struct('<b'),
+            _INT16: struct.Struct('<h'),
+            _INT32: struct.Struct('<i'),
+            _INT64: struct.Struct('<q'),
+        }
+
+    def encode(self, obj, persistent_id=None):
+        '''
+        Encode obj. If persistent_id(obj) returns a string for an array,
+        only a reference to it is encoded.
+
+        Raises TypeError for objects of unsupported types.
+        '''
+
+        out = []
+        if not self._encode_packet(obj, out, persistent_id):
+            self._encode(obj, out, persistent_id)
+        return ''.join(out)
+
+    def _encode_packet(self, obj, out, pid):
+        '''Encode obj with one of the packet schemas if it fits.'''
+
+        if type(obj) is not tuple or len(obj) != 2 or \
+                type(obj[0]) is not tuple:
+            return False
+        info, data = obj
+        kind = info[0]
+        if kind == 'return' and len(info) == 2 and type(info[1]) is int and \
+                0 <= info[1] <= 0xffffffff:
+            out.append(_packet_header.pack(_PACKET_RETURN, info[1]))
+            self._encode(data, out, pid)
+            return True
+
+        if type(data) is not tuple or len(data) != 4 or \
+                type(data[0]) is not str or type(data[1]) is not str or \
+                len(data[0]) > 255 or len(data[1]) > 255:
+            return False
+        if kind == 'call' and len(info) == 2 and type(info[1]) is int and \
+                0 <= info[1] <= 0xffffffff:
+            out.append(_packet_header.pack(_PACKET_CALL, info[1]))
+        elif kind == 'signal' and len(info) == 1:
+            out.append(_TAGS[_PACKET_SIGNAL])
+        else:
+            return False
+
+        objname, funcname, args, kwargs = data
+        out.append(_TAGS[len(objname)] + objname + _TAGS[len(funcname)] + \
+                funcname)
+        self._encode(args, out, pid)
+        self._encode(kwargs, out, pid)
+        return True
+
+    def _encode(self, obj, out, pid):
+        func = self._encoders.get(type(obj), None)
+        if func is not None:
+            func(obj, out, pid)
+        elif isinstance(obj, np.generic):
+            self._encode_scalar(obj, out, pid)
+        elif isinstance(obj, Exception):
+            self._encode_exception(obj, out, pid)
+        else:
+            raise TypeError('Unable to encode %s object' % type(obj).__name__)
+
+    def _encode_none(self, obj, out, pid):
+        out.append(_TAGS[_NONE])
+
+    def _encode_bool(self, obj, out, pid):
+        if obj:
+            out.append(_TAGS[_TRUE])
+        else:
+            out.append(_TAGS[_FALSE])
+
+    def _encode_int(self, obj, out, pid):
+        if 0 <= obj <= _FIXINT_MAX:
+            out.append(_TAGS[obj])
+        elif -32 <= obj < 0:
+            out.append(_TAGS[obj & 0xff])
+        elif -0x80 <= obj < 0x80:
+            out.append(struct.pack('<Bb', _INT8, obj))
+        elif -0x8000 <= obj < 0x8000:
+            out.append(struct.pack('<Bh', _INT16, obj))
+        elif -0x80000000 <= obj < 0x80000000:
+            out.append(struct.pack('<Bi', _INT32, obj))
+        elif -0x8000000000000000 <= obj < 0x8000000000000000:
+            out.append(struct.pack('<Bq', _INT64, obj))
+        else:
+            s = str(obj)
+            out.append(_TAGS[_LONG] + _pack_len(len(s)) + s)
+
+    def _encode_float(self, obj, out, pid):
+        out.append(struct.pack('<Bd', _FLOAT, obj))
+
+    def _encode_complex(self, obj, out, pid):
+        out.append(struct.pack('<Bdd', _COMPLEX, obj.real, obj.imag))
+
+    def _encode_str(self, obj, out, pid):
+        n = len(obj)
+        if n < 32:
+            out.append(_TAGS[_FIXSTR + n])
+        elif n < 256:
+            out.append(_TAGS[_STR8] + _TAGS[n])
+        else:
+            out.append(_TAGS[_STR32] + _pack_len(n))
+        out.append(obj)
+
+    def _encode_unicode(self, obj, out, pid):
+        obj = obj.encode('utf-8')
+        out.append(_TAGS[_UNICODE] + _pack_len(len(obj)))
+        out.append(obj)
+
+    def _encode_tuple(self, obj, out, pid):
+        n = len(obj)
+        if n < 16:
+            out.append(_TAGS[_FIXTUPLE + n])
+        else:
+            out.append(_TAGS[_TUPLE] + _pack_len(n))
+        for item in obj:
+            self._encode(item, out, pid)
+
+    def _encode_list(self, obj, out, pid):
+        out.append(_TAGS[_LIST] + _pack_len(len(obj)))
+        for item in obj:
+            self._encode(item, out, pid)
+
+    def _encode_dict(self, obj, out, pid):
+        n = len(obj)
+        if n < 16:
+            out.append(_TAGS[_FIXDICT + n])
+        else:
+            out.append(_TAGS[_DICT] + _pack_len(n))
+        for key, val in obj.iteritems():
+            self._encode(key, out, pid)
+            self._encode(val, out, pid)
+
+    def _encode_dtype(self, dtype, out):
+        if dtype.hasobject:
+            raise TypeError('Unable to encode object arrays')
+        if dtype.fields is None:
+            self._encode_str(dtype.str, out, None)
+        else:
+            self._encode(dtype.descr, out, None)
+
+    def _encode_array(self, obj, out, pid):
+        if pid is not None:
+            ref = pid(obj)
+            if ref is not None:
+                out.append(_TAGS[_ARRAY_REF])
+                self._encode_str(ref, out, None)
+                return
+
+        out.append(_TAGS[_ARRAY])
+        self._encode_dtype(obj.dtype, out)
+        self._encode_tuple(obj.shape, out, None)
+        data = np.ascontiguousarray(obj).tostring()
+        out.append(_pack_len(len(data)))
+        out.append(data)
+
+    def _encode_scalar(self, obj, out, pid):
+        out.append(_TAGS[_SCALAR])
+        self._encode_dtype(obj.dtype, out)
+        data = obj.tostring()
+        out.append(_TAGS[len(data)])
+        out.append(data)
+
+    def _encode_exception(self, obj, out, pid):
+        if isinstance(obj, RemoteException):
+            msg = str(obj)
+        else:
+            msg = '%s: %s' % (type(obj).__name__, obj)
+        out.append(_TAGS[_EXCEPTION])
+        self._encode_str(msg, out, None)
+
+    def decode(self, data, persistent_load=None):
+        '''
+        Decode data. Array references are resolved with
+        persistent_load(pid).
+        '''
+
+        data = str(data)
+        tag = ord(data[0])
+        if tag in (_PACKET_CALL, _PACKET_SIGNAL, _PACKET_RETURN):
+            obj, pos = self._decode_packet(data, tag, persistent_load)
+        else:
+            obj, pos = self._decode(data, 0, persistent_load)
+        if pos != len(data):
+            raise ValueError('Trailing data after packet')
+        return obj
+
+    def _decode_packet(self, data, tag, load):
+        if tag == _PACKET_SIGNAL:
+            info = ('signal', )
+            pos = 1
+        else:
+            callid = _unpack_len(data, 1)[0]
+            pos = 5
+            if tag == _PACKET_RETURN:
+                val, pos = self._decode(data, pos, load)
+                return (('return', callid), val), pos
+            info = ('call', callid)
+
+        n = ord(data[pos])
+        objname = data[pos+1:pos+1+n]
+        pos += 1 + n
+        n = ord(data[pos])
+        funcname = data[pos+1:pos+1+n]
+        pos += 1 + n
+        args, pos = self._decode(data, pos, load)
+        kwargs, pos = self._decode(data, pos, load)
+        return (info, (objname, funcname, args, kwargs)), pos
+
+    def _decode(self, data, pos, load):
+        func = self._decoders[ord(data[pos])]
+        if func is None:
+            raise ValueError('Invalid type code 0x%02x' % ord(data[pos]))
+        return func(data, pos, load)
+
+    def _decode_fixint(self, data, pos, load):
+        val = ord(data[pos])
+        if val >= _NEGFIXINT:
+            val -= 256
+        return val, pos + 1
+
+    def _decode_none(self, data, pos, load):
+        return None, pos + 1
+
+    def _decode_bool(self, data, pos, load):
+        return ord(data[pos]) == _TRUE, pos + 1
+
+    def _decode_struct(self, data, pos, load):
+        s = self._structs[ord(data[pos])]
+        return s.unpack_from(data, pos + 1)[0], pos + 1 + s.size
+
+    def _decode_complex(self, data, pos, load):
+        re, im = struct.unpack_from('<dd', data, pos + 1)
+        return complex(re, im), pos + 17
+
+    def _decode_long(self, data, pos, load):
+        n = _unpack_len(data, pos + 1)[0]
+        pos += 5
+        return long(data[pos:pos+n]), pos + n
+
+    def _decode_bytes(self, data, pos, n):
+        if pos + n > len(data):
+            raise ValueError('Truncated packet')
+        return data[pos:pos+n], pos + n
+
+    def _decode_fixstr(self, data, pos, load):
+        return self._decode_bytes(data, pos + 1, ord(data[pos]) - _FIXSTR)
+
+    def _decode_str8(self, data, pos, load):
+        return self._decode_bytes(data, pos + 2, ord(data[pos + 1]))
+
+    def _decode_str32(self, data, pos, load):
+        return self._decode_bytes(data, pos + 5, _unpack_len(data, pos + 1)[0])
+
+    def _decode_unicode(self, data, pos, load):
+        s, pos = self._decode_str32(data, pos, None)
+        return s.decode('utf-8'), pos
+
+    def _decode_items(self, data, pos, n, load):
+        items = []
+        for i in xrange(n):
+            item, pos = self._decode(data, pos, load)
+            items.append(item)
+        return items, pos
+
+    def _decode_fixtuple(self, data, pos, load):
+        items, pos = self._decode_items(data, pos + 1,
+                ord(data[pos]) - _FIXTUPLE, load)
+        return tuple(items), pos
+
+    def _decode_tuple(self, data, pos, load):
+        items, pos = self._decode_items(data, pos + 5,
+                _unpack_len(data, pos + 1)[0], load)
+        return tuple(items), pos
+
+    def _decode_list(self, data, pos, load):
+        return self._decode_items(data, pos + 5, _unpack_len(data, pos + 1)[0],
+                load)
+
+    def _decode_dict_items(self, data, pos, n, load):
+        items, pos = self._decode_items(data, pos, 2 * n, load)
+        return dict(zip(items[::2], items[1::2])), pos
+
+    def _decode_fixdict(self, data, pos, load):
+        return self._decode_dict_items(data, pos + 1,
+                ord(data[pos]) - _FIXDICT, load)
+
+    def _decode_dict(self, data, pos, load):
+        return self._decode_dict_items(data, pos + 5,
+                _unpack_len(data, pos + 1)[0], load)
+
+    def _decode_dtype(self, data, pos):
+        desc, pos = self._decode(data, pos, None)
+        if type(desc) is list:
+            desc = [tuple(d) for d in desc]
+        return np.dtype(desc), pos
+
+    def _decode_array(self, data, pos, load):
+        dtype, pos = self._decode_dtype(data, pos + 1)
+        shape, pos = self._decode(data, pos, None)
+        raw, pos = self._decode_bytes(data, pos + 4, _unpack_len(data, pos)[0])
+        arr = np.frombuffer(raw, dtype=dtype).reshape(shape).copy()
+        return arr, pos
+
+    def _decode_array_ref(self, data, pos, load):
+        ref, pos = self._decode(data, pos + 1, None)
+        if load is None:
+            raise ValueError('Array reference without arrays')
+        return load(ref), pos
+
+    def _decode_scalar(self, data, pos, load):
+        dtype, pos = self._decode_dtype(data, pos + 1)
+        raw, pos = self._decode_bytes(data, pos + 1, ord(data[pos]))
+        return np.frombuffer(raw, dtype=dtype)[0], pos
+
+    def _decode_exception(self, data, pos, load):
+        msg, pos = self._decode(data, pos + 1, None)
+        return RemoteException(msg), pos
+
+CODECS = {}
+_MAGICS = {}
+for _codec in (PickleCodec(), CompactCodec()):
+    CODECS[_codec.name] = _codec
+    _MAGICS[_codec.magic] = (_codec, False)
+    _MAGICS[_codec.array_magic] = (_codec, True)
+
+def get_codec(name):
+    '''Return the codec called <name>.'''
+    return CODECS[name]
+
+def get_codec_for_magic(magic):
+    '''
+    Return (codec, has_arrays) for the packet magic, or (None, False) if
+    the magic is unknown.
+    '''
+
+    return _MAGICS.get(magic, (None, False))
@@ -16,10 +16,6 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
-try:
-    import cPickle as pickle
-except:
-    import pickle
 import socket
 import copy
 import random
@@ -27,13 +23,350 @@ import inspect
 import time
 import gobject
 import types
+import struct
+import errno
+import select
+import numpy as np
+from lib import bus
+from lib.network import codec
+from lib.network.codec import RemoteException
 
 PORT = 12002
 BUFSIZE = 8192
 
-class RemoteException(Exception):
+class PacketSizeError(ValueError):
+    '''A packet announced more data than the maximum packet size.'''
     pass
 
+class PacketFramer():
+    '''
+    Reassemble the packets received on one connection, see
+    ObjectSharer.handle_data() for the packet format.
+
+    Received data is appended to a bytearray until a packet header is
+    complete. The packet data and the arrays that follow it are then
+    copied into buffers of the right size, or received into them directly
+    by ObjectSharer.receive().
+    '''
+
+    MIN_RECV_SIZE = 4096
+    MAX_RECV_SIZE = 4 * 1024 * 1024
+    MAX_PACKET_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, peer=None, accept=None, max_size=None):
+        self.peer = peer
+        self.recv_size = 65536
+
+        # Maximum size of a packet including its arrays; the sizes are
+        # sent by the peer, so they are checked before allocating.
+        if max_size is None:
+            max_size = self.MAX_PACKET_SIZE
+        self.max_size = max_size
+
+        # Names of the codecs that packets with arrays may be decoded with
+        self.accept = accept
+
+        self._buffer = bytearray()
+        self._start = 0
+
+        # The buffers being filled: [magic, data, views, pos]
+        self._packet = None
+
+        self._stats = {
+            'bytes_in': 0,
+            'packets_in': 0,
+            'bytes_out': 0,
+            'packets_out': 0,
+        }
+
+    def get_stats(self):
+        return dict(self._stats)
+
+    def count_sent(self, nbytes):
+        self._stats['packets_out'] += 1
+        self._stats['bytes_out'] += nbytes
+
+    def get_target(self):
+        '''
+        Return a memoryview of the buffer that the next data should be
+        received into, or None if the data should go through feed().
+        '''
+
+        if self._packet is None or self._start < len(self._buffer):
+            return None
+        views, pos = self._packet[2], self._packet[3]
+        return views[0][pos:]
+
+    def received(self, nbytes):
+        '''Register nbytes received into the view from get_target().'''
+        self._stats['bytes_in'] += nbytes
+        self._packet[3] += nbytes
+
+    def adapt_recv_size(self, nbytes, size):
+        '''Adapt the receive size after receiving nbytes of size.'''
+        if nbytes == size:
+            self.recv_size = min(self.recv_size * 2, self.MAX_RECV_SIZE)
+        elif nbytes < size / 4:
+            self.recv_size = max(self.recv_size / 2, self.MIN_RECV_SIZE)
+
+    def feed(self, data):
+        '''Add received data.'''
+        self._stats['bytes_in'] += len(data)
+        self._buffer += data
+
+    def _consume(self, nbytes):
+        self._start += nbytes
+        if self._start == len(self._buffer):
+            self._buffer = bytearray()
+            self._start = 0
+        elif self._start > 65536 and self._start > len(self._buffer) / 2:
+            del self._buffer[:self._start]
+            self._start = 0
+
+    def _fill(self):
+        '''
+        Move buffered data into the buffers of the current packet. Returns
+        True if they are complete.
+        '''
+
+        views = self._packet[2]
+        while len(views) > 0:
+            view = views[0]
+            pos = self._packet[3]
+            n = min(len(view) - pos, len(self._buffer) - self._start)
+            if n > 0:
+                view[pos:pos+n] = self._buffer[self._start:self._start+n]
+                self._consume(n)
+                pos += n
+                self._packet[3] = pos
+            if pos < len(view):
+                return False
+            del views[0]
+            self._packet[3] = 0
+        return True
+
+    def next_packet(self):
+        '''
+        Return the next complete packet as (magic, data, arrays), or None.
+        '''
+
+        while True:
+            if self._packet is not None:
+                if not self._fill():
+                    return None
+                magic, data, views, pos = self._packet
+                self._packet = None
+
+                # Allocate the arrays that follow the packet
+                pcodec, has_arrays = codec.get_codec_for_magic(magic)
+                if has_arrays:
+                    if self.accept is not None and \
+                            pcodec.name not in self.accept:
+                        # The array sizes are unknown, so the rest of the
+                        # data can not be used either.
+                        self._buffer = bytearray()
+                        self._start = 0
+                        self._stats['packets_in'] += 1
+                        return magic, None, []
+                    data, descs = pcodec.decode(str(data))
+                    dtypes = []
+                    nbytes = len(data)
+                    for dtype, shape in descs:
+                        if type(dtype) is list:
+                            dtype = [tuple(d) for d in dtype]
+                        dtype = np.dtype(dtype)
+                        dtypes.append((dtype, shape))
+                        size = dtype.itemsize
+                        for n in np.atleast_1d(shape):
+                            size *= int(n)
+                        nbytes += size
+                    if nbytes > self.max_size:
+                        raise PacketSizeError('Arrays of %d bytes exceed '
+                                'maximum packet size' % nbytes)
+
+                    arrays = []
+                    views = []
+                    for dtype, shape in dtypes:
+                        arr = np.empty(shape, dtype=dtype)
+                        arrays.append(arr)
+                        if arr.nbytes > 0:
+                            views.append(memoryview(arr.reshape(-1).view(np.uint8)))
+                    self._packet = ['ARRAYS', (magic, data, arrays), views, 0]
+                    continue
+
+                self._stats['packets_in'] += 1
+                if magic == 'ARRAYS':
+                    return data
+                return magic, data, []
+
+            if len(self._buffer) - self._start < 6:
+                return None
+
+            b = self._buffer
+            i = self._start
+            magic = str(b[i:i+2])
+            if magic != 'QN' and codec.get_codec_for_magic(magic)[0] is None:
+                self._buffer = bytearray()
+                self._start = 0
+                logging.warning('Packet magic missing, dumping data')
+                return None
+
+            datalen = struct.unpack('>I', str(b[i+2:i+6]))[0]
+            if datalen > self.max_size:
+                raise PacketSizeError('Packet of %d bytes exceeds maximum '
+                        'packet size' % datalen)
+            self._consume(6)
+            data = bytearray(datalen)
+            self._packet = [magic, data, [memoryview(data)], 0]
+
+class CoalescedSignal():
+    '''
+    State of one coalesced signal (object, signal name) for one client,
+    see ObjectSharer.set_signal_coalescing().
+
+    An emission is sent right away if the previous one was sent at least
+    1 / max_rate seconds ago and the client is not behind with receiving.
+    Otherwise it is kept until it can be sent, and replaces (or, if merge
+    is set, is merged into) the emission that is already waiting.
+    '''
+
+    def __init__(self, client, objname, signame):
+        self.client = client
+        self.objname = objname
+        self.signame = signame
+        self.last_sent = 0
+        self.pending = False
+        self.args = None
+        self.kwargs = None
+        self.hid = None
+
+    def set_pending(self, args, kwargs, merge):
+        '''
+        Keep args and kwargs to send later. Returns 'merged' or 'dropped'
+        if an emission was already waiting, otherwise None.
+        '''
+
+        if not self.pending:
+            self.pending = True
+            self.args = args
+            self.kwargs = kwargs
+            return None
+
+        if merge:
+            self.args = _merge_signal_args(self.args, args)
+            self.kwargs = _merge_signal_args(self.kwargs, kwargs)
+            return 'merged'
+
+        self.args = args
+        self.kwargs = kwargs
+        return 'dropped'
+
+def _merge_signal_args(old, new):
+    '''
+    Merge the args tuples or kwargs dictionaries of two emissions.
+    Dictionary arguments (e.g. the changed parameters of an Instrument) are
+    combined, other arguments are replaced.
+    '''
+
+    def merge(o, n):
+        if isinstance(o, dict) and isinstance(n, dict):
+            ret = dict(o)
+            ret.update(n)
+            return ret
+        return n
+
+    if isinstance(old, dict):
+        return merge(old, new)
+    if len(old) != len(new):
+        return new
+    return tuple([merge(o, n) for o, n in zip(old, new)])
+
+class CallFuture():
+    '''
+    The reply to a call made with ObjectSharer.call_async(). It has the
+    same interface as lib.executor.Future, so lib.executor.gather() can be
+    used to wait for several calls.
+
+    Waiting does not depend on a main loop: data is received from the
+    connection as soon as it becomes readable. Replies to other calls that
+    arrive in the mean time are handled as well.
+    '''
+
+    def __init__(self, conn, callid):
+        self.conn = conn
+        self.callid = callid
+        self._done = False
+        self._result = None
+        self._callbacks = []
+        self.closed = False
+
+        # The call and the codec it was sent with, to send it again if
+        # the peer rejects the codec.
+        self.callinfo = None
+        self.codec = None
+
+    def _set_result(self, result, closed=False):
+        self._done = True
+        self._result = result
+        self.closed = closed
+        callbacks = self._callbacks
+        self._callbacks = []
+        for cb in callbacks:
+            self._run_callback(cb)
+
+    def _run_callback(self, cb):
+        try:
+            cb(self)
+        except Exception, e:
+            logging.warning('Error in call %d callback: %s', self.callid, e)
+
+    def done(self):
+        '''Return whether the reply has been received.'''
+        return self._done
+
+    def add_done_callback(self, cb):
+        '''
+        Add function cb(future) that is called when the reply has been
+        received, or right away if it already has.
+        '''
+
+        if self._done:
+            self._run_callback(cb)
+        else:
+            self._callbacks.append(cb)
+
+    def wait(self, timeout=None, mainloop=True):
+        '''
+        Wait until the reply has been received, or until <timeout> seconds
+        have passed. The mainloop argument is only there for compatibility
+        with lib.executor.Future. Returns whether the reply was received.
+        '''
+        return helper._wait_for_reply(self, timeout)
+
+    def result(self, timeout=None, mainloop=True):
+        '''
+        Wait for and return the reply. If the remote function raised an
+        exception, an exception is raised here too. Returns None if the
+        connection was closed.
+        '''
+
+        if not self.wait(timeout):
+            raise RuntimeError('Timeout waiting for reply to call %d' % \
+                    self.callid)
+        if isinstance(self._result, Exception):
+            raise Exception('Remote error: %s' % str(self._result))
+        return self._result
+
+    def exception(self, timeout=None, mainloop=True):
+        '''Return the exception raised by the remote function, or None.'''
+
+        if not self.wait(timeout):
+            raise RuntimeError('Timeout waiting for reply to call %d' % \
+                    self.callid)
+        if isinstance(self._result, Exception):
+            return self._result
+        return None
+
 class ObjectSharer():
     '''
     The object sharer containing both client and server functions.
@@ -42,6 +375,21 @@ class ObjectSharer():
     TIMEOUT = 2
     server = None
 
+    # Numpy arrays of at least this many bytes are not encoded, but sent
+    # as raw data after the packet, see _encode_packet().
+    ARRAY_MIN_SIZE = 4096
+
+    # Codecs to encode packets with, in order of preference, see
+    # set_codecs() and lib/network/codec.py.
+    CODECS = ['pickle', 'compact']
+
+    # Signals for which only the latest emission matters, as
+    # signal name -> (max_rate, merge), see set_signal_coalescing().
+    COALESCED_SIGNALS = {
+        'changed': (10, True),
+        'new-data-point': (10, False),
+    }
+
     def __init__(self):
         self._functions = {}
         self._objects = {}
@@ -52,19 +400,37 @@ class ObjectSharer():
 
         self._last_hid = 0
         self._last_call_id = 0
-        self._return_cbs = {}
-        self._return_vals = {}
+
+        # Futures of calls waiting for a reply, indexed on call id
+        self._calls = {}
 
         self._client_timeout = 60
+        self._max_packet_size = PacketFramer.MAX_PACKET_SIZE
 
         # Store callback info indexed on hid and on signam__objname
         self._callbacks_hid = {}
         self._callbacks_name = {}
         self._event_callbacks = {}
 
-        # Buffers to store partly received packets
-        self._buffers = {}
+        # Framers to reassemble received packets
+        self._framers = {}
         self._send_queue = {}
+        self._send_hids = {}
+
+        # Codecs accepted by us, and codec names to send with and accepted
+        # by the peer, indexed on connection.
+        self._codecs = list(self.CODECS)
+        self._conn_codecs = {}
+        self._peer_codecs = {}
+
+        # Connections whose peer accepts arrays sent out of band. Older
+        # peers, without get_codecs, only accept plain pickle packets.
+        self._array_conns = set()
+
+        # Coalesced signals indexed on (conn, objname, signame)
+        self._coalesce = dict(self.COALESCED_SIGNALS)
+        self._coalesced = {}
+        self._signal_stats = {}
 
     def set_client_timeout(self, timeout):
         '''
@@ -72,6 +438,52 @@ class ObjectSharer():
         '''
         self._client_timeout = timeout
 
+    def set_max_packet_size(self, nbytes):
+        '''
+        Set the maximum size of received packets, including their arrays.
+        Connections that send larger packets are dropped.
+        '''
+        self._max_packet_size = nbytes
+        for framer in self._framers.values():
+            framer.max_size = nbytes
+
+    def set_codecs(self, names):
+        '''
+        Set the codecs that packets may be encoded with, in order of
+        preference. Received packets that are encoded with other codecs are
+        rejected, so use set_codecs(['compact']) to never unpickle data
+        from the network. The codec for each connection is negotiated when
+        the client is added.
+        '''
+
+        for name in names:
+            codec.get_codec(name)
+        self._codecs[:] = names
+
+    def get_codecs(self):
+        '''Return the accepted codecs, in order of preference.'''
+        return list(self._codecs)
+
+    def get_connection_codec(self, conn):
+        '''Return the name of the codec used to send to connection conn.'''
+        return self._conn_codecs.get(conn, self._codecs[0])
+
+    def _set_peer_codecs(self, conn, names):
+        '''
+        Set the codecs accepted by the peer of conn, and select the first
+        of ours that it accepts.
+        '''
+
+        self._peer_codecs[conn] = names
+        for name in self._codecs:
+            if name in names:
+                self._conn_codecs[conn] = name
+                logging.debug('Using codec %s for %r', name, conn)
+                return name
+        logging.warning('No common codec with peer (%r), peer accepts %r',
+                self._codecs, names)
+        return None
+
     def add_client(self, conn, handler):
         '''
         Add a client through connection 'conn'.
@@ -81,6 +493,18 @@ class ObjectSharer():
         if info is None:
             logging.warning('Unable to get client root object')
             return None
+
+        # Peers without get_codecs only accept pickle
+        if 'get_codecs' in [f[0] for f in info['functions']]:
+            names = self.call(conn, 'root', 'get_codecs',
+                    timeout=self._client_timeout)
+            if names is not None:
+                self._array_conns.add(conn)
+        else:
+            names = ['pickle']
+        if names is not None:
+            self._set_peer_codecs(conn, names)
+
         client = ObjectProxy(conn, info)
         self._clients.append(client)
         name = client.get_instance_name()
@@ -127,6 +551,25 @@ class ObjectSharer():
 
         if conn in self._send_queue:
             del self._send_queue[conn]
+        if conn in self._send_hids:
+            gobject.source_remove(self._send_hids.pop(conn))
+        self._framers.pop(conn, None)
+        self._conn_codecs.pop(conn, None)
+        self._peer_codecs.pop(conn, None)
+        self._array_conns.discard(conn)
+
+        for callid, future in self._calls.items():
+            if future.conn is conn:
+                del self._calls[callid]
+                future._set_result(None, closed=True)
+
+        for key in self._coalesced.keys():
+            if key[0] is conn:
+                sig = self._coalesced.pop(key)
+                if sig.hid is not None:
+                    gobject.source_remove(sig.hid)
+                if sig.pending:
+                    self._count_signal(sig, 'dropped')
 
     def get_clients(self):
         return self._clients
@@ -254,67 +697,224 @@ class ObjectSharer():
 
         return self.find_remote_object(objname)
 
-    def _pickle_packet(self, info, data):
+    def _encode_packet(self, conn, info, data, codec_name=None):
+        '''
+        Encode a packet with the codec for conn, or with codec_name. If that
+        codec can not encode the data, another one accepted by both sides
+        is tried. If none can, a return packet contains the error message,
+        for other packets the error is raised. If the peer accepts it,
+        large numpy arrays are replaced by a reference and returned
+        separately, so that their data can be sent without copying.
+
+        Output: (codec name, encoded string, list of arrays)
+        '''
+
+        if codec_name is None:
+            codec_name = self.get_connection_codec(conn)
+
+        arrays = []
+        indices = {}
+        def persistent_id(obj):
+            if type(obj) is not np.ndarray or obj.dtype.hasobject or \
+                    obj.nbytes < self.ARRAY_MIN_SIZE:
+                return None
+            if id(obj) not in indices:
+                indices[id(obj)] = len(arrays)
+                arrays.append(obj)
+            return str(indices[id(obj)])
+        if conn not in self._array_conns:
+            persistent_id = None
+
         try:
-            retdata = pickle.dumps((info, data))
+            retdata = codec.get_codec(codec_name).encode((info, data),
+                    persistent_id)
+            return codec_name, retdata, arrays
         except Exception, e:
             msg = 'Unable to encode object: %s' % str(e)
-            retdata = pickle.dumps((info, msg))
-        return retdata
 
-    def _unpickle_packet(self, data):
+        peer_names = self._peer_codecs.get(conn, None)
+        for name in self._codecs:
+            if name == codec_name or \
+                    (peer_names is not None and name not in peer_names):
+                continue
+            del arrays[:]
+            indices.clear()
+            try:
+                retdata = codec.get_codec(name).encode((info, data),
+                        persistent_id)
+                return name, retdata, arrays
+            except Exception, e:
+                pass
+
+        if info[0] != 'return':
+            raise ValueError(msg)
+        retdata = codec.get_codec(codec_name).encode((info, msg))
+        return codec_name, retdata, []
+
+    def _decode_packet(self, conn, magic, data, arrays=[]):
+        '''
+        Decode a packet, if it is encoded with an accepted codec.
+
+        Output: (codec name, packet), or None
+        '''
+
+        pcodec = codec.get_codec_for_magic(magic)[0]
+        if pcodec.name not in self._codecs:
+            logging.warning('Rejecting packet encoded with %s', pcodec.name)
+            self._send_reject(conn)
+            return None
+
         try:
-            return pickle.loads(data)
+            packet = pcodec.decode(data, lambda pid: arrays[int(pid)])
         except Exception, e:
             logging.warning('Unable to decode object: %s [%r]', str(e), data)
-            raise e
+            return None
+        return pcodec.name, packet
+
+    def _send_reject(self, conn):
+        '''
+        Tell the peer that a packet was rejected, and which codecs are
+        accepted. The packet is 'QN' <length> <comma separated names>.
+        '''
+
+        data = ','.join(self._codecs)
+        self._queue_send(conn, ['QN' + struct.pack('>I', len(data)) + data])
+
+    def _handle_reject(self, conn, data):
+        '''
+        Handle a 'QN' packet: select another codec and send the calls that
+        were rejected again.
+        '''
+
+        names = str(data).split(',')
+        logging.warning('Peer rejected packet, it accepts codecs %r', names)
+        old = self.get_connection_codec(conn)
+        name = self._set_peer_codecs(conn, names)
+        if name is None or name == old:
+            return
+
+        for future in self._calls.values():
+            if future.conn is conn and future.codec not in names:
+                future.codec = name
+                cmd, arrays = self._encode_packet(conn, ('call', future.callid),
+                        future.callinfo, name)[1:]
+                self.send_packet(conn, cmd, arrays, name)
 
-    def _send_return(self, conn, callid, retval):
+    def _send_return(self, conn, callid, retval, codec_name=None):
         logging.debug('Returning for call %d: %r', callid, retval)
         retinfo = ('return', callid)
-        retdata = self._pickle_packet(retinfo, retval)
-        self.send_packet(conn, retdata)
+        codec_name, retdata, arrays = self._encode_packet(conn, retinfo,
+                retval, codec_name)
+        self.send_packet(conn, retdata, arrays, codec_name)
 
-    def handle_data(self, conn, data):
+    def _get_framer(self, conn):
+        framer = self._framers.get(conn, None)
+        if framer is None:
+            try:
+                peer = '%s:%s' % conn.getpeername()[:2]
+            except Exception:
+                peer = None
+            framer = PacketFramer(peer, self._codecs,
+                    self._max_packet_size)
+            self._framers[conn] = framer
+        return framer
+
+    def get_connection_stats(self):
         '''
-        Handle incoming data from a connection and produce packets in the
-        packet queue. If a response is not expected, process the packet
-        immediately.
+        Return a list of dictionaries with the peer address and the number
+        of bytes and packets sent and received for each connection.
         '''
 
-        if conn not in self._buffers:
-            self._buffers[conn] = ''
+        ret = []
+        for framer in self._framers.values():
+            stats = framer.get_stats()
+            stats['peer'] = framer.peer
+            ret.append(stats)
+        return ret
 
-        self._buffers[conn] = self._buffers[conn] + data
+    def receive(self, conn):
+        '''
+        Receive data from connection and handle complete packets. Data for
+        a packet of known length is received directly into its buffer.
 
-        # Decode complete packets
-        while len(self._buffers[conn]) >= 6:
-            b = self._buffers[conn]
+        Output: number of bytes received, 0 if the connection was closed,
+        None if no data was available.
+        '''
 
-            if b[0] != 'Q' or b[1] != 'T':
-                self._buffers[conn] = ''
-                logging.warning('Packet magic missing, dumping data')
+        framer = self._get_framer(conn)
+        target = framer.get_target()
+        try:
+            if target is not None:
+                size = min(len(target), framer.MAX_RECV_SIZE)
+                nbytes = conn.recv_into(target, size)
+                if nbytes > 0:
+                    framer.received(nbytes)
+            else:
+                size = framer.recv_size
+                data = conn.recv(size)
+                nbytes = len(data)
+                if nbytes > 0:
+                    framer.feed(data)
+        except socket.error, e:
+            if e.errno in (10035, errno.EAGAIN, errno.EWOULDBLOCK):
                 return None
+            raise
 
-            datalen = (ord(b[2]) << 24) + (ord(b[3]) << 16) + (ord(b[4]) << 8)  + ord(b[5])
-            if len(b) < datalen + 6:
-                logging.debug('Incomplete packet received')
-                return None
+        if nbytes > 0:
+            framer.adapt_recv_size(nbytes, size)
+            self._handle_packets(conn, framer)
+        return nbytes
 
-            packet = b[6:6+datalen]
-            self._buffers[conn] = b[6+datalen:]
+    def handle_data(self, conn, data):
+        '''
+        Handle incoming data from a connection and produce packets in the
+        packet queue. If a response is not expected, process the packet
+        immediately.
 
+        A packet is <magic> <length> <encoded data>, or for packets with
+        numpy arrays <array magic> <length> <encoded (data, array
+        descriptions)> followed by the raw data of the arrays. The magic
+        identifies the codec, e.g. 'QT' and 'QA' for pickle, see
+        lib/network/codec.py.
+        '''
+
+        framer = self._get_framer(conn)
+        framer.feed(data)
+        self._handle_packets(conn, framer)
+
+    def _handle_packets(self, conn, framer):
+        while True:
             try:
-                packet = self._unpickle_packet(packet)
+                packet = framer.next_packet()
+            except PacketSizeError, e:
+                logging.warning('Dropping connection to %s: %s',
+                        framer.peer, e)
+                self._client_disconnected(conn)
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                return
             except Exception, e:
-                logging.warning('Unable to unpickle packet')
+                logging.warning('Unable to decode packet: %s', e)
+                continue
+            if packet is None:
                 return
 
-            self.handle_packet(conn, packet)
+            if packet[0] == 'QN':
+                self._handle_reject(conn, packet[1])
+                continue
+
+            packet = self._decode_packet(conn, *packet)
+            if packet is None:
+                continue
+
+            self.handle_packet(conn, packet[1], packet[0])
 
-    def handle_packet(self, conn, packet):
+    def handle_packet(self, conn, packet, codec_name=None):
         '''
-        Process an incoming packet
+        Process an incoming packet. Replies are encoded with the same codec
+        as the packet.
         '''
 
         info, callinfo = packet
@@ -323,19 +923,17 @@ class ObjectSharer():
         if info[0] == 'return':
             # (a)synchronous function reply
             callid = info[1]
-            if callid not in self._return_cbs:
+            future = self._calls.pop(callid, None)
+            if future is None:
                 logging.warning('Return received for unknown call %d', callid)
                 return
 
-            func = self._return_cbs[callid]
-            del self._return_cbs[callid]
-
             if type(callinfo) == types.StringType and callinfo.startswith('sharedname:'):
                 sn = callinfo[11:]
                 logging.debug('Received shared object reference, finding %s', sn)
                 callinfo = helper.find_object(sn)
 
-            func(callinfo)
+            future._set_result(callinfo)
             return
 
         elif info[0] not in ('call', 'signal'):
@@ -348,13 +946,16 @@ class ObjectSharer():
             msg = 'Object %s not available' % objname
             logging.warning(msg)
             if info[0] != 'signal':
-                self._send_return(conn, info[1], ValueError(msg))
+                self._send_return(conn, info[1], ValueError(msg), codec_name)
             return None
 
+        # Instrument access from remote clients (e.g. the GUI) should not
+        # delay measurements, see lib/bus.py.
         obj = self._objects[objname]
         func = getattr(obj, funcname)
         try:
-            ret = func(*args, **kwargs)
+            ret = bus.call_with_priority(bus.PRIORITY_BACKGROUND,
+                    func, *args, **kwargs)
         except Exception, e:
             import traceback
             tb = traceback.format_exc(15)
@@ -369,13 +970,13 @@ class ObjectSharer():
             logging.debug('Returning a shared object reference: %s', sn)
             ret = 'sharedname:' + sn
 
-        self._send_return(conn, info[1], ret)
+        self._send_return(conn, info[1], ret, codec_name)
 
     def _do_send_raw(self, conn, data):
         try:
             ret = conn.send(data)
         except socket.error, e:
-            if e.errno not in (10035, ):
+            if e.errno not in (10035, errno.EAGAIN, errno.EWOULDBLOCK):
                 logging.warning('Send exception (%s), assuming client disconnected', e)
                 self._client_disconnected(conn)
                 return -1
@@ -403,102 +1004,184 @@ class ObjectSharer():
                         del self._send_queue[conn]
                     break
 
-                # Partially sent
+                # Partially sent, continue when the socket is writable
+                elif nsent == 0:
+                    self._add_send_watch(conn)
+                    break
+
                 else:
                     datalist[0] = datalist[0][nsent:]
-                    break
 
         return True
 
-    def send_packet(self, conn, data):
+    def _add_send_watch(self, conn):
+        if conn in self._send_hids:
+            return
+        self._send_hids[conn] = gobject.io_add_watch(conn, gobject.IO_OUT,
+                self._send_watch_cb)
+
+    def _send_watch_cb(self, conn, condition):
+        self._process_send_queue()
+        if len(self._send_queue.get(conn, [])) > 0:
+            return True
+        self._send_hids.pop(conn, None)
+        return False
+
+    def send_packet(self, conn, data, arrays=[], codec_name=None):
+        '''
+        Send a packet encoded with codec_name (default is the codec for
+        conn), followed by the raw data of arrays.
+        '''
+
+        if codec_name is None:
+            codec_name = self.get_connection_codec(conn)
+        pcodec = codec.get_codec(codec_name)
+
+        tosend = []
+        if len(arrays) > 0:
+            descs = []
+            for arr in arrays:
+                arr = np.ascontiguousarray(arr)
+                if arr.dtype.fields is None:
+                    descs.append((arr.dtype.str, arr.shape))
+                else:
+                    descs.append((arr.dtype.descr, arr.shape))
+                if arr.nbytes > 0:
+                    tosend.append(memoryview(arr.reshape(-1).view(np.uint8)))
+            data = pcodec.encode((data, descs))
+            magic = pcodec.array_magic
+        else:
+            magic = pcodec.magic
+
         dlen = len(data)
         if dlen > 0xffffffffL:
             logging.error('Trying to send too long packet: %d', dlen)
             return -1
 
-        tosend = 'QT%c%c%c%c' % ((dlen&0xff000000)>>24, \
-            (dlen&0x00ff0000)>>16, (dlen&0x0000ff00)>>8, (dlen&0x000000ff))
-        tosend += data
+        header = magic + struct.pack('>I', dlen)
+        tosend.insert(0, header + data)
+        self._queue_send(conn, tosend)
 
+    def _queue_send(self, conn, tosend):
+        self._get_framer(conn).count_sent(sum([len(d) for d in tosend]))
         if conn not in self._send_queue:
             self._send_queue[conn] = []
-        self._send_queue[conn].append(tosend)
+        self._send_queue[conn].extend(tosend)
         self._process_send_queue()
 
-    def _call_cb(self, callid, val):
-        if callid in self._return_vals:
-            logging.warning('Received late reply for call %d', callid)
-            del self._return_vals[callid]
-        else:
-            self._return_vals[callid] = val
+        # Array data that could not be sent right away is copied, the
+        # caller may change the arrays before the socket is writable.
+        datalist = self._send_queue.get(conn, [])
+        for i, data in enumerate(datalist):
+            if type(data) is memoryview and not data.readonly:
+                datalist[i] = data.tobytes()
 
-    def call(self, conn, objname, funcname, *args, **kwargs):
+    def _wait_for_reply(self, future, timeout=None):
         '''
-        Call a function through connection 'conn'
+        Receive data from the connection of future until it is done, or
+        until <timeout> seconds have passed. Returns whether it is done.
         '''
 
-        cb = kwargs.pop('callback', None)
-        is_signal = kwargs.pop('signal', False)
-        timeout = kwargs.pop('timeout', self.TIMEOUT)
-        blocking = (cb is None and not is_signal)
+        conn = future.conn
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while not future.done():
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
 
-        if not is_signal:
-            self._last_call_id += 1
-            callid = self._last_call_id
-            if cb is not None:
-                self._return_cbs[callid] = cb
+            # Don't depend on a main loop to receive data while blocking
+            if len(self._send_queue.get(conn, [])) > 0:
+                wlist = [conn]
             else:
-                self._return_cbs[callid] = lambda val: self._call_cb(callid, val)
+                wlist = []
+            try:
+                rlist, wlist, xlist = select.select([conn], wlist, [], remaining)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
 
-            info = ('call', callid)
-        else:
-            cb = None
-            info = ('signal', )
+            if len(wlist) > 0:
+                self._process_send_queue()
+            if len(rlist) > 0:
+                try:
+                    nbytes = self.receive(conn)
+                except socket.error, e:
+                    logging.warning('Receive exception (%s), assuming client disconnected', e)
+                    nbytes = 0
+                if nbytes == 0:
+                    self._client_disconnected(conn)
 
-        logging.debug('Calling %s.%s(%r, %r), info=%r, blocking=%r', objname, funcname, args, kwargs, info, blocking)
+        return True
 
-        callinfo = (objname, funcname, args, kwargs)
-        cmd = self._pickle_packet(info, callinfo)
-        start_time = time.time()
-        self.send_packet(conn, cmd)
+    def call_async(self, conn, objname, funcname, *args, **kwargs):
+        '''
+        Call a function through connection 'conn' without waiting for the
+        reply. Several calls can be in progress at the same time; replies
+        are matched to calls by their call id.
 
-        if not blocking:
-            return
+        Output: CallFuture
+        '''
 
-        # Wait for return
-        while time.time() - start_time < timeout:
-            if callid in self._return_vals:
-                break
+        self._last_call_id += 1
+        callid = self._last_call_id
+        future = CallFuture(conn, callid)
 
-            # Don't depend on a main loop to receive data while blocking
-            import select
-            lists = select.select([conn], [], [], 0.1)
-            if len(lists[0]) > 0:
-                try:
-                    data = conn.recv(BUFSIZE)
-                except:
-                    # Cope with strange windows errors?
-                    time.sleep(0.002)
-                    continue
+        info = ('call', callid)
+        logging.debug('Calling %s.%s(%r, %r), info=%r', objname, funcname, args, kwargs, info)
+        future.callinfo = (objname, funcname, args, kwargs)
+        future.codec, cmd, arrays = self._encode_packet(conn, info,
+                future.callinfo)
+        self._calls[callid] = future
+        self.send_packet(conn, cmd, arrays, future.codec)
+        return future
 
-                if len(data) == 0:
-                    self._client_disconnected(conn)
-                    return
-                self.handle_data(conn, data)
-            else:
-                time.sleep(0.002)
+    def call(self, conn, objname, funcname, *args, **kwargs):
+        '''
+        Call a function through connection 'conn' and wait for the reply.
 
-        if callid in self._return_vals:
-            ret = self._return_vals[callid]
-            del self._return_vals[callid]
-            if isinstance(ret, Exception):
-                raise Exception('Remote error: %s' % str(ret))
-            return ret
-        else:
-            logging.warning('Blocking call %d timed out', callid)
-            self._return_vals[callid] = None    # Mark as timed out
+        Keyword arguments:
+            callback: function cb(reply) to call when the reply arrives,
+                instead of waiting for it
+            signal: if True, do not expect a reply at all
+            timeout: maximum time to wait for the reply in seconds
+        '''
 
-        return None
+        cb = kwargs.pop('callback', None)
+        is_signal = kwargs.pop('signal', False)
+        timeout = kwargs.pop('timeout', self.TIMEOUT)
+
+        if is_signal:
+            info = ('signal', )
+            logging.debug('Calling %s.%s(%r, %r), info=%r', objname, funcname, args, kwargs, info)
+            callinfo = (objname, funcname, args, kwargs)
+            try:
+                codec_name, cmd, arrays = self._encode_packet(conn, info,
+                        callinfo)
+            except ValueError, e:
+                logging.warning('Not sending signal %s.%s: %s', objname,
+                        funcname, e)
+                return
+            self.send_packet(conn, cmd, arrays, codec_name)
+            return
+
+        future = self.call_async(conn, objname, funcname, *args, **kwargs)
+        if cb is not None:
+            def done_cb(f):
+                if not f.closed:
+                    cb(f._result)
+            future.add_done_callback(done_cb)
+            return
+
+        if not future.wait(timeout):
+            logging.warning('Blocking call %d timed out', future.callid)
+            self._calls.pop(future.callid, None)
+            return None
+        return future.result()
 
     def connect(self, objname, signame, callback, *args, **kwargs):
         '''
@@ -533,13 +1216,116 @@ class ObjectSharer():
                     del self._callbacks_name[name][index]
                     break
 
+    def set_signal_coalescing(self, signame, max_rate=10, merge=False):
+        '''
+        Limit the rate at which signal <signame> is sent to each client.
+
+        Emissions that come too fast, or while a client is not keeping up
+        with receiving data, are kept until they can be sent. Only the
+        latest one is sent, or if merge is True the dictionary arguments
+        of the waiting emissions are combined (as for the 'changed' signal
+        of an Instrument). This is per client and per object, so a slow
+        client does not delay the others.
+
+        Input:
+            signame (string): signal name
+            max_rate (float): maximum emissions per second, None to send
+                every emission right away
+            merge (bool): whether to merge instead of replace emissions
+        '''
+
+        if max_rate is None:
+            self._coalesce.pop(signame, None)
+        else:
+            self._coalesce[signame] = (max_rate, merge)
+
+    def get_signal_stats(self):
+        '''
+        Return statistics for the coalesced signals, as a dictionary of
+        'objname.signame' -> dictionary with keys:
+            emitted: number of emissions, counted once for every client
+            sent: number of emissions sent
+            merged: number of emissions merged into a waiting one
+            dropped: number of emissions replaced by a later one
+        '''
+
+        ret = {}
+        for key, stats in self._signal_stats.iteritems():
+            ret['%s.%s' % key] = dict(stats)
+        return ret
+
+    def reset_signal_stats(self):
+        self._signal_stats = {}
+
+    def _count_signal(self, sig, what):
+        key = (sig.objname, sig.signame)
+        stats = self._signal_stats.get(key, None)
+        if stats is None:
+            stats = {'emitted': 0, 'sent': 0, 'merged': 0, 'dropped': 0}
+            self._signal_stats[key] = stats
+        stats[what] += 1
+
+    def _send_signal(self, client, objname, signame, args, kwargs):
+        kwargs = dict(kwargs)
+        kwargs['signal'] = True
+        client.receive_signal(objname, signame, *args, **kwargs)
+
+    def _emit_coalesced(self, client, objname, signame, args, kwargs):
+        max_rate, merge = self._coalesce[signame]
+        conn = client.get_connection()
+        key = (conn, objname, signame)
+        sig = self._coalesced.get(key, None)
+        if sig is None:
+            sig = CoalescedSignal(client, objname, signame)
+            self._coalesced[key] = sig
+        self._count_signal(sig, 'emitted')
+
+        if sig.pending:
+            self._count_signal(sig, sig.set_pending(args, kwargs, merge))
+            return
+
+        interval = 1.0 / max_rate
+        delay = sig.last_sent + interval - time.time()
+        if delay <= 0 and len(self._send_queue.get(conn, [])) == 0:
+            sig.last_sent = time.time()
+            self._count_signal(sig, 'sent')
+            self._send_signal(client, objname, signame, args, kwargs)
+            return
+
+        sig.set_pending(args, kwargs, merge)
+        if delay <= 0:
+            delay = interval
+        sig.hid = gobject.timeout_add(int(delay * 1000) + 1,
+                self._flush_signal, key)
+
+    def _flush_signal(self, key):
+        sig = self._coalesced.get(key, None)
+        if sig is None or not sig.pending:
+            return False
+
+        # Try again later if the client is still behind
+        if len(self._send_queue.get(key[0], [])) > 0:
+            return True
+
+        args, kwargs = sig.args, sig.kwargs
+        sig.pending = False
+        sig.args = sig.kwargs = None
+        sig.hid = None
+        sig.last_sent = time.time()
+        self._count_signal(sig, 'sent')
+        self._send_signal(sig.client, sig.objname, sig.signame, args, kwargs)
+        return False
+
     def emit_signal(self, objname, signame, *args, **kwargs):
         logging.debug('Emitting %s(%r, %r) for %s to %d clients',
                 signame, args, kwargs, objname, len(self._clients))
 
-        kwargs['signal'] = True
+        coalesce = signame in self._coalesce
         for client in self._clients:
-            client.receive_signal(objname, signame, *args, **kwargs)
+            if coalesce:
+                self._emit_coalesced(client, objname, signame, args, kwargs)
+            else:
+                self._send_signal(client, objname, signame, args, kwargs)
 
     def receive_signal(self, objname, signame, *args, **kwargs):
         logging.debug('Received signal %s(%r, %r) from %s',
@@ -720,6 +1506,10 @@ class _FunctionCall():
             self._cached_result = ret
         return ret
 
+    def call_async(self, *args, **kwargs):
+        '''Call the remote function without waiting, returns a CallFuture.'''
+        return helper.call_async(self._conn, self._objname, self._funcname, *args, **kwargs)
+
 class ObjectProxy():
     '''
     Client side object proxy.
@@ -803,6 +1593,9 @@ class RootObject(SharedObject):
     def get_id(self):
         return self._id
 
+    def get_codecs(self):
+        return helper.get_codecs()
+
     def hello_world(self, *args, **kwargs):
         return 'Hello world!'
 
@@ -12,6 +12,18 @@ class Handler(tcpservergtk.GlibTCPHandler):
                 packet_len=True)
         self.client = objsh.helper.add_client(self.socket, self)
 
+    def _handle_recv(self, sock, number):
+        # Let the object sharer receive directly into its packet buffers
+        try:
+            nbytes = objsh.helper.receive(self.socket)
+        except socket.error, e:
+            return True
+
+        if nbytes == 0:
+            self._handle_hup()
+            return False
+        return True
+
     def handle(self, data):
         if len(data) > 0:
             data = objsh.helper.handle_data(self.socket, data)
@@ -87,7 +87,7 @@ class GlibTCPHandler():
     Class to do asynchronous request handling integrated with GTK mainloop.
     '''
 
-    BUFSIZE = 4096
+    BUFSIZE = 65536
 
     def __init__(self, sock, client_address, server, packet_len=False):
         '''
@@ -51,6 +51,18 @@ class QtQtlabHandler(QtTCPHandler):
                 packet_len=True)
         self.client = helper.add_client(self.socket, self)
 
+    def _handle_recv(self, sock, number):
+        # Let the object sharer receive directly into its packet buffers
+        try:
+            nbytes = helper.receive(self.socket)
+        except socket.error, e:
+            return True
+
+        if nbytes == 0:
+            self._handle_hup()
+            return False
+        return True
+
     def handle(self, data):
         if len(data) > 0:
             data = helper.handle_data(self.socket, data)
@@ -0,0 +1,318 @@
+# ramp.py, ramp several instrument parameters at the same time
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Ramp instrument parameters that have a 'maxstep' option.
+
+The steps of all parameters are computed at once and executed on a shared
+clock, so several parameters (e.g. all dacs of an IVVI rack) ramp at the
+same time instead of one after the other. For each parameter subsequent
+steps differ at most 'maxstep' and are at least 'stepdelay' ms apart.
+
+A ramp can run blocking, or asynchronously from the gobject main loop:
+
+    r = ramp([(ivvi, 'dac1', 100), (ivvi, 'dac2', -50)], wait=False)
+    ...
+    r.wait()
+'''
+
+import gobject
+import logging
+import time
+import numpy as np
+
+from misc import exact_time
+
+def compute_steps(starts, targets, maxsteps):
+    '''
+    Compute the values to set for ramping several parameters.
+
+    Input:
+        starts (array): current values
+        targets (array): values to ramp to
+        maxsteps (array): maximum step sizes, 0 or NaN to set the target
+            directly. A start value of NaN always results in one step.
+
+    Output:
+        list of arrays with the values to set for each parameter. The last
+        value is the target; the array is empty if no set is needed.
+    '''
+
+    if len(starts) == 0:
+        return []
+
+    starts = np.asarray(starts, dtype=np.float)
+    targets = np.asarray(targets, dtype=np.float)
+    maxsteps = np.abs(np.asarray(maxsteps, dtype=np.float))
+    maxsteps[np.isnan(maxsteps)] = 0
+
+    deltas = np.abs(targets - starts)
+    nsteps = np.ones(len(starts), dtype=np.int)
+    ramped = maxsteps > 0
+    nsteps[ramped] = np.ceil(deltas[ramped] / maxsteps[ramped])
+    nsteps[deltas == 0] = 0
+
+    # Step number within each ramp, for all steps of all parameters
+    ends = np.cumsum(nsteps)
+    stepnr = np.arange(ends[-1]) - \
+            np.repeat(ends - nsteps, nsteps) + 1
+    sizes = np.minimum(stepnr * np.repeat(maxsteps, nsteps),
+            np.repeat(deltas, nsteps))
+    values = np.repeat(starts, nsteps) + \
+            np.repeat(np.sign(targets - starts), nsteps) * sizes
+    values[ends[nsteps > 0] - 1] = targets[nsteps > 0]
+
+    return np.split(values, ends[:-1])
+
+class Ramp(object):
+    '''
+    Ramp one or more instrument parameters, see ramp().
+    '''
+
+    def __init__(self, items, fast=False):
+        '''
+        Input:
+            items (list): (instrument, parameter, value) or
+                (instrument, parameter, value, kwargs) tuples
+            fast (bool): if True don't emit a 'changed' signal afterwards
+        '''
+
+        self._fast = fast
+        self._items = []
+        self._results = [None] * len(items)
+        self._callbacks = []
+        self._hid = None
+        self._done = False
+        self._cancelled = False
+        self._error = None
+
+        starts = []
+        targets = []
+        maxsteps = []
+        for i, item in enumerate(items):
+            if len(item) == 4:
+                ins, name, value, kwargs = item
+            else:
+                ins, name, value = item
+                kwargs = {}
+            spec = ins._get_ramp_spec(name, value, **kwargs)
+            if spec is None:
+                continue
+            start, value, maxstep, stepdelay, kwargs = spec
+            self._items.append((i, ins, name, value, stepdelay / 1000.0,
+                kwargs))
+
+            # Parameters without maxstep are set in one step
+            if maxstep is None:
+                starts.append(np.nan)
+                targets.append(np.nan)
+                maxsteps.append(0)
+            elif isinstance(value, (int, long)):
+                # Integer steps, none larger than maxstep if possible
+                starts.append(round(start))
+                targets.append(value)
+                maxsteps.append(max(1, np.floor(abs(maxstep))))
+            else:
+                starts.append(start)
+                targets.append(value)
+                maxsteps.append(maxstep)
+
+        self._steps = compute_steps(starts, targets, maxsteps)
+        self._pos = np.zeros(len(self._items), dtype=np.int)
+        self._nsteps = np.array([len(s) for s in self._steps], dtype=np.int)
+        self._due = np.zeros(len(self._items))
+
+    def get_steps(self):
+        '''Return the list of (instrument, parameter, step values).'''
+        return [(item[1], item[2], self._steps[j]) \
+                for j, item in enumerate(self._items)]
+
+    def _step(self):
+        '''
+        Perform all steps that are due. Returns the time of the next step,
+        or None if the ramp is finished or cancelled.
+        '''
+
+        while not self._cancelled:
+            active = self._pos < self._nsteps
+            if not active.any():
+                return None
+
+            due = np.where(active, self._due, np.inf)
+            j = due.argmin()
+            if due[j] > exact_time():
+                return due[j]
+
+            # The last step sets the value exactly as it was checked, the
+            # others are converted to the type of that value. Steps of
+            # integer parameters are integers already.
+            i, ins, name, value, delay, kwargs = self._items[j]
+            if self._pos[j] < self._nsteps[j] - 1:
+                step = self._steps[j][self._pos[j]]
+                if isinstance(value, (int, long)):
+                    value = type(value)(round(step))
+                else:
+                    value = float(step)
+            ins._do_ramp_step(name, value, kwargs)
+            self._pos[j] += 1
+            self._due[j] = exact_time() + delay
+
+        return None
+
+    def _finish(self):
+        if self._done:
+            return
+
+        changed = {}
+        for j, (i, ins, name, value, delay, kwargs) in enumerate(self._items):
+            if self._pos[j] < self._nsteps[j]:
+                self._results[i] = ins.get(name, query=False)
+                continue
+            val = ins._finish_set(name, value, **kwargs)
+            self._results[i] = val
+            if val is not None:
+                changed.setdefault(ins, {})[name] = val
+
+        if not self._fast:
+            for ins, vals in changed.iteritems():
+                ins._queue_changed(vals)
+
+        self._done = True
+        for cb in self._callbacks:
+            try:
+                cb(self)
+            except Exception, e:
+                logging.error('Error in ramp callback: %s', e)
+
+    def run(self):
+        '''Run the ramp, return when finished.'''
+
+        self._due[:] = exact_time()
+        try:
+            while not self._cancelled:
+                tnext = self._step()
+                if tnext is None:
+                    break
+                delay = tnext - exact_time()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            self._finish()
+        return self.result()
+
+    def start(self):
+        '''Start the ramp asynchronously from the gobject main loop.'''
+
+        self._due[:] = exact_time()
+        self._hid = gobject.idle_add(self._timeout_cb)
+
+    def _timeout_cb(self):
+        self._hid = None
+        if self._cancelled:
+            return False
+
+        try:
+            tnext = self._step()
+        except Exception, e:
+            logging.error('Error while ramping: %s', e)
+            self._error = e
+            tnext = None
+
+        if self._cancelled:
+            return False
+        if tnext is None:
+            self._finish()
+        else:
+            delay = max(int((tnext - exact_time()) * 1000), 0)
+            self._hid = gobject.timeout_add(delay, self._timeout_cb)
+        return False
+
+    def cancel(self):
+        '''
+        Stop the ramp. Parameters keep the value of the last step.
+        '''
+
+        if self._done:
+            return
+        self._cancelled = True
+        if self._hid is not None:
+            gobject.source_remove(self._hid)
+            self._hid = None
+        self._finish()
+
+    def done(self):
+        '''Return whether the ramp has finished.'''
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def add_done_callback(self, cb):
+        '''
+        Add function cb(ramp) that is called when the ramp is finished,
+        or immediately if it already is.
+        '''
+
+        if self._done:
+            cb(self)
+        else:
+            self._callbacks.append(cb)
+
+    def wait(self, timeout=None):
+        '''
+        Run the main loop until the ramp is finished, or until <timeout>
+        seconds have passed. Returns whether the ramp has finished.
+        '''
+
+        from qtflow import get_flowcontrol
+        flow = get_flowcontrol()
+        start = exact_time()
+        while not self._done:
+            if timeout is not None and exact_time() - start > timeout:
+                return False
+            flow.run_mainloop(0.005)
+        return True
+
+    def result(self):
+        '''
+        Return the final values of the parameters, in the order of the
+        items passed when creating the ramp; None for invalid values.
+        '''
+
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+def ramp(items, wait=True, fast=False):
+    '''
+    Ramp several instrument parameters at the same time.
+
+    Input:
+        items (list): (instrument, parameter, value) tuples
+        wait (bool): if True wait until the ramp is finished and return the
+            final values, otherwise start the ramp in the background and
+            return a Ramp object.
+        fast (bool): if True don't emit a 'changed' signal afterwards
+
+    Output:
+        list of final values, or a Ramp object
+    '''
+
+    r = Ramp(items, fast=fast)
+    if wait:
+        return r.run()
+    r.start()
+    return r
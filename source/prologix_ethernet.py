@@ -20,6 +20,8 @@ Changelog:
 import socket
 import time
 import re
+import threading
+import logging
 
 ip = None
 port = None
@@ -28,11 +30,149 @@ def set_controller_address(addr, nport):
     ip = addr
     port = nport
 
-# Connection information to share controller between different instruments
-class ConnectionInfo:
-    def __init__(self, sock, gpib_address=None):
+DEFAULT_PORT = 1234
+
+def _get_controller_address(kwargs):
+    '''
+    Return (ip, port) of the controller from the 'ip' and 'port' keyword
+    arguments of an instrument, or from set_controller_address().
+    '''
+    nport = kwargs.get("port", port)
+    if nport is None:
+        nport = DEFAULT_PORT
+    return kwargs.get("ip", ip), nport
+
+def get_bus_name(address, **kwargs):
+    '''
+    All instruments on one controller share a bus, see lib/bus.py.
+    '''
+    return 'prologix::%s:%s' % _get_controller_address(kwargs)
+
+class Connection:
+    '''
+    Persistent connection to a prologix controller, shared by all
+    instruments on that controller. It remembers the currently addressed
+    GPIB device and the values of other '++' settings, so that these are
+    only sent when they change. If the connection is lost it is opened again
+    on the next transfer.
+    '''
+
+    def __init__(self, ip, port, timeout=0.1):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.gpib_address = None
+        self.lock = threading.RLock()
+        self._settings = {}
+        self._stats = {'sends': 0, 'recvs': 0, 'connects': 0,
+                'skipped': 0}
+
+    def connect(self):
+        if self.sock is not None:
+            self.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                socket.IPPROTO_TCP)
+        sock.settimeout(self.timeout)
+        sock.connect((self.ip, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock = sock
+        self._stats['connects'] += 1
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+        # The controller state is unknown after reconnecting
+        self.gpib_address = None
+        self._settings = {}
+
+    def setting(self, cmd, value):
+        '''
+        Return the command to set '++<cmd> <value>', or an empty string if
+        the controller already has this setting.
+        '''
+
+        if self._settings.get(cmd, None) == value:
+            self._stats['skipped'] += 1
+            return ''
+        self._settings[cmd] = value
+        return '++%s %s\n' % (cmd, value)
+
+    def address(self, gpib_address):
+        '''
+        Return the command to address <gpib_address>, or an empty string if
+        it is already addressed.
+        '''
+
+        if self.gpib_address == gpib_address:
+            self._stats['skipped'] += 1
+            return ''
         self.gpib_address = gpib_address
+        return '++addr %d\n' % gpib_address
+
+    def send(self, data, retry=True):
+        '''
+        Send <data>; if the connection was lost, reconnect and try again.
+        '''
+
+        if self.sock is None:
+            self.connect()
+        try:
+            self.sock.sendall(data)
+            self._stats['sends'] += 1
+        except socket.timeout:
+            raise
+        except socket.error, e:
+            if not retry:
+                raise
+            logging.warning('Prologix connection %s:%s lost (%s), reconnecting',
+                    self.ip, self.port, e)
+            self.connect()
+            return False
+        return True
+
+    def recv(self, bufflen):
+        try:
+            data = self.sock.recv(bufflen)
+        except socket.timeout:
+            raise
+        except socket.error:
+            self.close()
+            raise
+        self._stats['recvs'] += 1
+        if len(data) == 0:
+            self.close()
+            raise socket.error('Prologix connection %s:%s closed' % \
+                    (self.ip, self.port))
+        return data
+
+    def get_stats(self):
+        '''
+        Return dictionary with the number of sends, receives, (re)connects
+        and skipped '++' commands.
+        '''
+        return dict(self._stats)
+
+# Connections to share controllers between different instruments
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(ip, port=DEFAULT_PORT):
+    '''Return the shared connection to the controller at ip:port.'''
+
+    _connections_lock.acquire()
+    connid = (ip, port)
+    conn = _connections.get(connid, None)
+    if conn is None:
+        conn = Connection(ip, port)
+        _connections[connid] = conn
+    _connections_lock.release()
+    return conn
 
 class instrument(object):
     """
@@ -45,9 +185,9 @@ class instrument(object):
         visa='prologix_ethernet')
     """
 
-    CONNECTIONS = {}
+    CONNECTIONS = _connections
 
-    def __init__(self, gpib, **kwargs):	
+    def __init__(self, gpib, **kwargs):
         self.conn = None
 
         # for compatibility with NI visa
@@ -63,27 +203,31 @@ class instrument(object):
         self.gpib_addr = self._get_gpib_adr_from_string(gpib)
 
         # open connection
+        self._ip, self._port = _get_controller_address(kwargs)
+        if self._ip is None:
+            raise self.Error("No controller address, use ip= or "
+                    "set_controller_address()")
         self._open_connection()
 
         if self.send_end:
             self.term_char = '\r\n'
-            self._set_EOI_assert()
-
-        # disable the automatic saving of parameters in
-        # the ethernet-gpib device,
-
-        self._set_saveconfig(False)
-
-        # set set the ethernet gpib device to be the controller of#
-        # the gpib chain
-        self._set_controller_mode()
-        # set the GPIB address of the device
-        self._set_gpib_address()
-
-        self._set_EOI_assert()
+        elif self.term_char is None:
+            self.term_char = '\n'
+
+        # The controller settings are sent with the first transfer, and
+        # later only when they differ from the previous instrument.
+        self._settings = [
+            # disable the automatic saving of parameters in
+            # the ethernet-gpib device
+            ('savecfg', 0),
+            # set the ethernet gpib device to be the controller of
+            # the gpib chain
+            ('mode', 1),
+            # Turn off read-after-write to avoid "Query Unterminated" errors
+            ('auto', 0),
+            ('eoi', 1),
+        ]
         self._set_read_timeout()
-        self._set_read_after_write(False)
-        #self._dump_internal_vars()
 
     # wrapper functions for py visa
     def write(self, cmd):
@@ -100,7 +244,7 @@ class instrument(object):
         return self._send_recv(cmd)
 
     def clear(self):
-        return self._set_reset()
+        return self._set_clear()
     def trigger(self):
         return self._set_trigger()
 
@@ -121,44 +265,85 @@ class instrument(object):
     # internal commands to access the prologix gpib device
     #
 
+    def _send_packet(self, data):
+        # Address this instrument and apply its settings if another
+        # instrument changed them, all in one packet.
+        conn = self.conn
+        for retry in (True, False):
+            pre = ''.join([conn.setting(cmd, val) \
+                    for cmd, val in self._settings])
+            pre += conn.address(self.gpib_addr)
+            if conn.send(pre + data, retry=retry):
+                break
+        time.sleep(self.delay)
+
     def _send(self, cmd):
         cmd = cmd.rstrip()
         cmd += self.term_char
-        #self._set_read_after_write(False)
-        self.conn.sock.send(cmd)
-        time.sleep(self.delay)
+        self.conn.lock.acquire()
+        try:
+            self._send_packet(cmd)
+        finally:
+            self.conn.lock.release()
 
     def _send_recv(self, cmd, **kwargs):
         bufflen = kwargs.get("bufflen", self.chunk_size)
         cmd = cmd.rstrip()
         cmd += self.term_char
-        #print cmd
+        read = "++read eoi" + self.term_char
 
-        self._send(cmd)
-        self._set_read()
-        return self.conn.sock.recv(bufflen)
+        self.conn.lock.acquire()
+        try:
+            for retry in (True, False):
+                # Send the read command in the same packet, unless a delay
+                # is required between the command and reading.
+                if self.delay > 0:
+                    self._send_packet(cmd)
+                    self._send_packet(read)
+                else:
+                    self._send_packet(cmd + read)
+
+                # A lost connection is often only noticed when reading
+                try:
+                    return self.conn.recv(bufflen)
+                except socket.timeout:
+                    raise
+                except socket.error, e:
+                    if not retry:
+                        raise
+                    logging.warning('Prologix read failed (%s), retrying', e)
+        finally:
+            self.conn.lock.release()
 
     def _recv(self, **kwargs):
         bufflen = kwargs.get("bufflen", self.chunk_size)
-        self._set_read()
-
-        buff = self.conn.sock.recv(bufflen)
-        return buff
+        self.conn.lock.acquire()
+        try:
+            self._send_packet("++read eoi" + self.term_char)
+            return self.conn.recv(bufflen)
+        finally:
+            self.conn.lock.release()
 
     def _open_connection(self):
-        connid = (ip, port)
-        if connid in instrument.CONNECTIONS:
-            self.conn = instrument.CONNECTIONS[connid]
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
-                socket.IPPROTO_TCP)
-        sock.settimeout(0.1)
-        sock.connect((ip, port))
-        self.conn = ConnectionInfo(sock, None)
-        instrument.CONNECTIONS[connid] = self.conn
+        self.conn = get_connection(self._ip, self._port)
+        self.conn.lock.acquire()
+        try:
+            if self.conn.sock is None:
+                self.conn.connect()
+        finally:
+            self.conn.lock.release()
 
     def _close_connection(self):
-        self.sock.close()
+        self.conn.close()
+
+    def _set_option(self, cmd, value):
+        # Controller setting for this instrument, sent with the next
+        # transfer if the controller does not have it yet.
+        for i, (c, v) in enumerate(self._settings):
+            if c == cmd:
+                self._settings[i] = (cmd, value)
+                return
+        self._settings.append((cmd, value))
 
     def _set_read(self):
         self._send("++read eoi")
@@ -166,68 +351,75 @@ class instrument(object):
     def _set_saveconfig(self, On=False):
         # should not be used very frequently
         if On:
-            self._send("++savecfg 1")
+            self._set_option('savecfg', 1)
         else:
-            self._send("++savecfg 0")
+            self._set_option('savecfg', 0)
 
     def _set_gpib_address(self, **kwargs):
-        # GET GPIB address
+        # GET GPIB address, it is set on the device with the next transfer
         self.gpib_addr = kwargs.get("gpib_addr", self.gpib_addr)
-        # SET GPIB address on the device
-        self._send("++addr " + str(self.gpib_addr) + "\n")
 
     def _set_controller_mode(self, C_Mode=True):
         # set gpib_ethernet into controller mode (True) or in device mode (False)
         if C_Mode:
             # controller mode
-            self._send("++mode 1")
+            self._set_option('mode', 1)
         else:
             # device mode
-            self._send("++mode 0")
+            self._set_option('mode', 0)
 
     def _set_read_after_write(self, On=True):
         if On:
             # Turn on read-after-write
-            self.sock.send("++auto 1\r\n")
+            self._set_option('auto', 1)
         else:
             # Turn off read-after-write to avoid "Query Unterminated" errors
-            self.sock.send("++auto 0\r\n")
+            self._set_option('auto', 0)
 
     def _set_read_timeout(self, **kwargs):
         timeout = kwargs.get("timeout", self.timeout)
         # Read timeout is maximal 3 seconds for my device
         if timeout > 3:
                 timeout = 3
-        self._send("++read_tmo_ms "+str(timeout*1000))
+        self._set_option('read_tmo_ms', int(timeout*1000))
 
     def _set_EOI_assert(self, On=True): #
         # Assert EOI signal line with last byte to indicate end of data
         if On:
-            self._send("++eoi 1\n")
+            self._set_option('eoi', 1)
         else:
-            self._send("++eoi 0\n")
+            self._set_option('eoi', 0)
 
     def _set_GPIB_EOS(self, EOS='\n'): # end of signal/string
         EOSs={'\r\n':0, '\r':1, '\n':2, '':3}
-        self.sock.send("++eos"+EOSs.get(EOS)+"\n")
+        self._set_option('eos', EOSs.get(EOS))
 
     def _set_GPIB_EOT(self, EOT=False):
         # send at EOI an EOT (end of transmission) character ?
         if EOT:
-            self.sock.send("++eot_enable 1\n")
+            self._set_option('eot_enable', 1)
         else:
-            self.sock.send("++eot_enable 0\n")
+            self._set_option('eot_enable', 0)
 
     def _set_GPIB_EOT_char(self, EOT_char=42):
         # set the EOT character
-        self.sock.send("++eot_char" + EOT_char + "\n")
+        self._set_option('eot_char', EOT_char)
 
     def _set_ifc(self):
         self._send("++ifc")
 
+    def _set_clear(self):
+        # Selected device clear
+        self._send("++clr")
+
+    def _set_trigger(self):
+        # Group execute trigger for this instrument
+        self._send("++trg")
+
     def _set_reset(self):
-        # Reset Device GPIB endpoint
+        # Reset the controller, it forgets the current settings
         self._send("++rst")
+        self.conn.close()
 
     def _set_GPIB_dev_reset(self):
         # Reset Device GPIB endpoint
@@ -257,22 +449,15 @@ class instrument(object):
 
     def CheckError(self):
         # check for device error
-        self.sock.send("SYST:ERR?\n")
-        self.sock.send("++read eoi\n")
-
         s = None
 
         try:
-            s = self.sock.recv(100)
+            s = self._send_recv("SYST:ERR?", bufflen=100)
         except socket.timeout:
             print "socket timeout"
             s = ""
 
-        except socket.error, e:
-            pass
-
         print s
-        print e
 
 # do some checking ...
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ from lib import config as _config
 from data import Data
 from plot import Plot, plot, plot3, replot_all
 from scripts import Scripts, Script
+from lib.executor import gather
+from lib.bus import get_bus_stats
 
 config = _config.get_config()
 
@@ -23,6 +23,7 @@ import time
 from gettext import gettext as _L
 from lib.misc import exact_time, get_traceback
 from lib.network.object_sharer import SharedGObject
+from lib import bus
 import os
 
 AutoFormattedTB = get_traceback()
@@ -73,6 +74,7 @@ class FlowControl(SharedGObject):
 
         self._measurements_running += 1
         if self._measurements_running == 1:
+            bus.set_measurement_thread()
             self._set_status('running')
             self.emit('measurement-start')
 
@@ -96,6 +98,7 @@ class FlowControl(SharedGObject):
             self._measurements_running -= 1
 
         if self._measurements_running == 0:
+            bus.set_measurement_thread(None)
             self._set_status('stopped')
             self.emit('measurement-end')
 
@@ -18,6 +18,9 @@
 import logging
 import socket
 import select
+import re
+import time
+from lib import bus
 
 try:
     from pyvisa import SerialInstrument
@@ -29,6 +32,9 @@ _drivers = (
     'prologix_ethernet'
 )
 
+_instrument = None
+_get_provider_bus_name = None
+
 def set_visa(name):
     if name not in _drivers:
         raise ValueError('Unknown VISA provider: %s', name)
@@ -38,21 +44,124 @@ def set_visa(name):
             from pyvisa import visa as module
         else:
             module = __import__(name)
-        global instrument
-        instrument = module.instrument
+        global _instrument, _get_provider_bus_name
+        _instrument = module.instrument
+        _get_provider_bus_name = getattr(module, 'get_bus_name', None)
     except:
         logging.warning('Unable to load visa driver %s', name)
 
 set_visa('pyvisa')
 
+def get_bus_name(address, **kwargs):
+    '''
+    Return the name of the controller that the instrument at <address> is
+    connected to. All GPIB instruments on one board share a bus, other
+    interfaces have one bus per resource, e.g. 'GPIB0' for 'GPIB::12' and
+    'TCPIP0::1.2.3.4' for 'TCPIP0::1.2.3.4::inst0::INSTR'. The keyword
+    arguments for the provider are passed on, they can specify the
+    controller.
+    '''
+
+    if _get_provider_bus_name is not None:
+        return _get_provider_bus_name(address, **kwargs)
+
+    parts = address.split('::')
+    m = re.match('([A-Za-z]+)(\d*)$', parts[0])
+    if m is None:
+        return address
+    interface, board = m.groups()
+    interface = interface.upper()
+    if board == '':
+        board = '0'
+    if interface == 'GPIB':
+        return 'GPIB%s' % board
+    return '::'.join(['%s%s' % (interface, board)] + parts[1:2])
+
+class BusInstrument(object):
+    '''
+    Wrapper around a visa instrument that performs every transaction while
+    holding the lock of the bus it is connected to, see lib/bus.py.
+    Other attributes are passed to the wrapped instrument.
+    '''
+
+    _TRANSACTIONS = ('write', 'read', 'ask', 'ask_for_values',
+        'read_values', 'read_raw', 'write_raw', 'clear', 'trigger')
+    _TRANSACTION_ATTRS = ('stb', )
+
+    def __init__(self, ins, bus):
+        object.__setattr__(self, '_ins', ins)
+        object.__setattr__(self, '_bus', bus)
+
+    def get_bus(self):
+        return self._bus
+
+    def get_instrument(self):
+        '''Return the wrapped instrument, access to it is not locked.'''
+        return self._ins
+
+    def __getattr__(self, name):
+        if name in self._TRANSACTION_ATTRS:
+            return self._bus.transaction(getattr, self._ins, name)
+
+        attr = getattr(self._ins, name)
+        if name not in self._TRANSACTIONS:
+            return attr
+
+        bus = self._bus
+        def transaction(*args, **kwargs):
+            return bus.transaction(attr, *args, **kwargs)
+        return transaction
+
+    def __setattr__(self, name, value):
+        setattr(self._ins, name, value)
+
+def instrument(address, **kwargs):
+    '''
+    Create a visa instrument using the current provider (see set_visa).
+    Transactions are scheduled on the bus of the controller, see
+    lib/bus.py.
+
+    Input:
+        address (string): the visa address
+        bus (string): name of the bus, default from get_bus_name()
+        other keyword arguments are passed to the provider
+
+    Output: BusInstrument
+    '''
+
+    if _instrument is None:
+        raise ValueError('No VISA provider available')
+
+    busname = kwargs.pop('bus', None)
+    if busname is None:
+        busname = get_bus_name(address, **kwargs)
+    ins = _instrument(address, **kwargs)
+    return BusInstrument(ins, bus.get_bus(busname))
+
 class TcpIpInstrument:
     '''
-    Class to mimic visa instrument for TCP/IP connected text-based devices.
+    Class to mimic visa instrument for TCP/IP connected devices.
+
+    Received data is kept in a buffer, so replies are split at the
+    termination characters regardless of how they arrive in packets, and
+    binary data can be read with read_raw() and read_block().
     '''
 
+    RECV_SIZE = 65536
+
+    # Time to wait for termination characters after a block, in seconds
+    TERM_WAIT = 0.05
+
     def __init__(self, host, port, timeout=20, termchars='\n'):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((host, port))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._address = '%s:%s' % (host, port)
+
+        # Received data starts at self._start, the part before it has been
+        # read already and is removed when the buffer is compacted.
+        self._buffer = bytearray()
+        self._start = 0
 
         self._termchars = termchars
         self._timeout = timeout
@@ -62,42 +171,193 @@ class TcpIpInstrument:
         self._timeout = timeout
         self._socket.settimeout(timeout)
 
+    def close(self):
+        self._socket.close()
+
     def set_termchars(self, termchars):
         self._termchars = termchars
 
+    def _get_deadline(self, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        return time.time() + timeout
+
+    def _recv(self, deadline):
+        '''
+        Receive available data into the buffer, wait at most until deadline.
+        Returns False on timeout.
+        '''
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        self._socket.settimeout(remaining)
+        try:
+            data = self._socket.recv(self.RECV_SIZE)
+        except socket.timeout:
+            return False
+        if len(data) == 0:
+            raise socket.error('Connection to %s closed' % self._address)
+        self._buffer += data
+        return True
+
+    def _available(self):
+        return len(self._buffer) - self._start
+
+    def _take(self, nbytes):
+        '''Remove and return nbytes from the start of the buffer.'''
+
+        ret = self._buffer[self._start:self._start + nbytes]
+        self._start += nbytes
+        if self._start == len(self._buffer):
+            self._buffer = bytearray()
+            self._start = 0
+        elif self._start > self.RECV_SIZE and \
+                self._start > len(self._buffer) / 2:
+            del self._buffer[:self._start]
+            self._start = 0
+        return ret
+
     def clear(self):
-        rlist, wlist, xlist = select.select([self._socket], [], [], 0)
-        if len(rlist) == 0:
-            return
-        ret = self.read()
+        '''Discard buffered data and data waiting on the socket.'''
+
+        self._buffer = bytearray()
+        self._start = 0
+        while True:
+            rlist, wlist, xlist = select.select([self._socket], [], [], 0)
+            if len(rlist) == 0:
+                return
+            self._socket.settimeout(self._timeout)
+            if len(self._socket.recv(self.RECV_SIZE)) == 0:
+                return
 
     def write(self, data):
-        self.clear()
         if not data.endswith(self._termchars):
             data += self._termchars
-        self._socket.send(data)
+        self._socket.settimeout(self._timeout)
+        self._socket.sendall(data)
+
+    def write_raw(self, data):
+        '''Send data without adding termination characters.'''
+        self._socket.settimeout(self._timeout)
+        self._socket.sendall(data)
 
     def read(self, timeout=None):
-        if timeout is None:
-            timeout = self._timeout
-        start = time()
-        try:
-            ans = ''
-            while len(ans) == 0 and (time() - start) < timeout and not ans.endswith(self._termchars):
-                ans2 = self._socket.recv(8192)
-                ans += ans2
-                if len(ans2) == 0:
-                    sleep(0.005)
-        except socket.timeout, e:
-            logging.warning('TCP/IP instrument read timed out')
-            return ''
-
-        if ans.endswith(self._termchars):
-            ans = ans[:-len(self._termchars)]
-        return ans
-
-    def ask(self, data):
-        self.clear()
+        '''
+        Read up to the termination characters, which are not returned.
+        Returns an empty string if the reply did not arrive in time.
+        '''
+
+        deadline = self._get_deadline(timeout)
+        term = self._termchars
+        scanpos = self._start
+        while True:
+            idx = self._buffer.find(term, scanpos)
+            if idx != -1:
+                ans = self._take(idx - self._start + len(term))
+                return str(ans[:-len(term)])
+
+            # Do not scan the same data again
+            scanpos = max(self._start, len(self._buffer) - len(term) + 1)
+            if not self._recv(deadline):
+                logging.warning('TCP/IP instrument read timed out')
+                self.clear()
+                return ''
+
+    def read_raw(self, nbytes=None, timeout=None):
+        '''
+        Read exactly nbytes, or whatever is available if nbytes is None.
+
+        Output: bytearray
+        '''
+
+        deadline = self._get_deadline(timeout)
+        if nbytes is None:
+            if self._available() == 0:
+                self._recv(deadline)
+            return self._take(self._available())
+
+        if self._available() >= nbytes:
+            return self._take(nbytes)
+
+        # Receive the remaining data directly into the result
+        ret = bytearray(nbytes)
+        n = self._available()
+        ret[:n] = self._take(n)
+        view = memoryview(ret)
+        while n < nbytes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Read of %d bytes timed out' % nbytes)
+            self._socket.settimeout(remaining)
+            try:
+                nrecv = self._socket.recv_into(view[n:])
+            except socket.timeout:
+                continue
+            if nrecv == 0:
+                raise socket.error('Connection to %s closed' % self._address)
+            n += nrecv
+        return ret
+
+    def read_block(self, timeout=None, termchars=True):
+        '''
+        Read an IEEE 488.2 definite length block '#<n><length><data>'.
+        An indefinite length block ('#0<data>') ends at the termination
+        characters.
+
+        Input:
+            timeout (float): timeout in seconds, default the instrument timeout
+            termchars (bool): whether to remove the termination characters
+                sent after the block. They are only removed if they arrive
+                within TERM_WAIT seconds; the data is returned in any case.
+
+        Output: bytearray with the block data
+        '''
+
+        deadline = self._get_deadline(timeout)
+        while True:
+            idx = self._buffer.find('#', self._start)
+            if idx != -1 and len(self._buffer) > idx + 1:
+                break
+            if not self._recv(deadline):
+                raise socket.timeout('Timeout waiting for block header')
+        self._take(idx - self._start)
+
+        ndigits = int(chr(self._buffer[self._start + 1]))
+        if ndigits == 0:
+            self._take(2)
+            term = self._termchars
+            while True:
+                idx = self._buffer.find(term, self._start)
+                if idx != -1:
+                    data = self._take(idx - self._start)
+                    self._take(len(term))
+                    return data
+                if not self._recv(deadline):
+                    raise socket.timeout('Timeout reading block')
+
+        header = self.read_raw(2 + ndigits, timeout=deadline - time.time())
+        length = int(str(header[2:]))
+        data = self.read_raw(length, timeout=deadline - time.time())
+
+        if termchars:
+            term = self._termchars
+            termdeadline = min(deadline, time.time() + self.TERM_WAIT)
+            while self._available() < len(term) and self._buffer.startswith(
+                    term[:self._available()], self._start):
+                if not self._recv(termdeadline):
+                    break
+            if self._buffer.startswith(term, self._start):
+                self._take(len(term))
+            else:
+                logging.debug('No termination characters after block')
+        return data
+
+    def ask(self, data, timeout=None):
         self.write(data)
-        return self.read()
+        return self.read(timeout=timeout)
 
+    def ask_block(self, data, timeout=None):
+        '''Send a query and read the IEEE 488.2 block in the reply.'''
+        self.write(data)
+        return self.read_block(timeout=timeout)